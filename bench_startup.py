@@ -0,0 +1,107 @@
+"""Бенчмарк холодного старта бота.
+
+Запускает main.py в отдельном процессе несколько раз и измеряет:
+- import_s   — время импорта модуля main;
+- startup_s  — время выполнения startup() до готовности обслуживать запросы;
+- total_s    — сумма (то, что видит Render при холодном старте).
+
+Каждый запуск идёт в чистом временном каталоге со снимком состояния
+заданного размера (пользователи, посты, доступы).
+
+Пример:
+    python bench_startup.py --runs 5 --users 5000 --posts 50
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def child():
+    """Один холодный старт: импорт main и startup()"""
+    import asyncio
+
+    started = time.perf_counter()
+    import main
+    imported = time.perf_counter()
+
+    async def run():
+        await main.startup()
+        ready = time.perf_counter()
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+        return ready
+
+    ready = asyncio.run(run())
+    print(json.dumps({
+        "import_s": imported - started,
+        "startup_s": ready - imported,
+        "total_s": ready - started,
+        "channel_access": len(main.channel_access),
+        "known_users": len(main.known_users),
+        "posts": len(main.posts_cache["posts"]),
+    }))
+
+
+def write_snapshot(workdir: str, users: int, posts: int):
+    expiry = (datetime.now() + timedelta(days=30)).isoformat()
+    user_ids = [str(100000000 + i) for i in range(users)]
+    with open(os.path.join(workdir, "state_snapshot.json"), "w") as f:
+        json.dump({
+            "saved_at": datetime.now().isoformat(),
+            "users": user_ids,
+            "posts": [
+                {"post_id": str(i), "text": f"Пост {i}", "photo_id": "", "buttons": "нет"}
+                for i in range(1, posts + 1)
+            ],
+        }, f)
+    with open(os.path.join(workdir, "channel_access.json"), "w") as f:
+        json.dump({uid: {"-1002681575953": expiry} for uid in user_ids}, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--posts", type=int, default=20)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child()
+        return
+
+    env = dict(os.environ)
+    env.setdefault("BOT_TOKEN", "123456:bench")
+    env.setdefault("GSHEET_ID", "bench")
+    env.pop("RENDER", None)
+    env["PYTHONPATH"] = REPO_DIR + os.pathsep + env.get("PYTHONPATH", "")
+
+    results = []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as workdir:
+            write_snapshot(workdir, args.users, args.posts)
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child"],
+                cwd=workdir, env=env, capture_output=True, text=True, check=True
+            )
+            results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    print(f"Холодный старт: {args.runs} запусков, {args.users} пользователей, {args.posts} постов")
+    for key in ("import_s", "startup_s", "total_s"):
+        values = [r[key] for r in results]
+        print(f"  {key:<10} медиана {statistics.median(values):.3f} с, мин {min(values):.3f} с, макс {max(values):.3f} с")
+    last = results[-1]
+    print(f"  загружено: доступов {last['channel_access']}, пользователей {last['known_users']}, постов {last['posts']}")
+
+
+if __name__ == "__main__":
+    main()
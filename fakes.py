@@ -0,0 +1,202 @@
+"""Локальные заглушки Bot API и Google Sheets для нагрузочных тестов.
+
+FakeBotAPI — HTTP-сервер на aiohttp, который отвечает на /bot<token>/<method>
+правдоподобными объектами Telegram и считает вызовы по методам.
+FakeWorksheet — лист gspread в памяти с тем же набором методов, что использует main.py.
+Обе заглушки умеют добавлять задержку, чтобы имитировать сетевые вызовы.
+"""
+import asyncio
+import itertools
+import time
+from collections import Counter
+from typing import List, Optional
+
+from aiohttp import web
+
+SHEET_HEADER = [
+    "id", "username", "file_url", "subscription_type", "subscription_end",
+    "post_id", "post_text", "post_photo", "post_buttons", "channel_access",
+]
+
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "Bot", "username": "fake_bot"}
+
+
+class FakeBotAPI:
+    """Заглушка Bot API: http://host:port/bot<token>/<method>"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081, latency: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params.get("chat_id", 0) or 0)
+        message = {
+            "message_id": int(params.get("message_id") or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "channel"},
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if "caption" in params:
+            message["caption"] = params["caption"]
+        return message
+
+    def _result(self, method: str, params: dict):
+        method = method.lower()
+        if method in ("sendmessage", "sendphoto", "senddocument", "sendvideo", "sendaudio",
+                      "editmessagetext", "editmessagemedia", "editmessagecaption"):
+            return self._message(params)
+        if method == "createchatinvitelink":
+            return {
+                "invite_link": f"https://t.me/+fake{next(self._message_ids)}",
+                "creator": BOT_USER,
+                "creates_join_request": False,
+                "is_primary": False,
+                "is_revoked": False,
+                "member_limit": 1,
+            }
+        if method == "getchatmember":
+            return {"status": "member", "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "U"}}
+        if method == "getchat":
+            chat_id = int(params.get("chat_id", 0))
+            return {"id": chat_id, "type": "channel", "title": f"Канал {chat_id}", "accent_color_id": 0, "max_reaction_count": 0}
+        if method == "getchatmembercount":
+            return 100
+        if method == "getme":
+            return BOT_USER
+        return True
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+
+class FakeSpreadsheet:
+    """Таблица из нескольких листов: worksheets() и add_worksheet(), как у gspread.Spreadsheet"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sheets: List["FakeWorksheet"] = []
+
+    def worksheets(self) -> List["FakeWorksheet"]:
+        return list(self.sheets)
+
+    def add_worksheet(self, title: str, rows: int = 1000, cols: int = 26) -> "FakeWorksheet":
+        return FakeWorksheet([], latency=self.latency, title=title, spreadsheet=self)
+
+    def call_counts(self) -> dict:
+        """Вызовы по всем листам; для всех, кроме первого, метод с префиксом названия листа"""
+        counts = {}
+        for i, sheet in enumerate(self.sheets):
+            prefix = "" if i == 0 else f"{sheet.title}."
+            counts.update({prefix + method: n for method, n in sheet.calls.items()})
+        return counts
+
+
+class FakeWorksheet:
+    """Лист Google Sheets в памяти. Методы синхронные, как у gspread"""
+
+    def __init__(self, rows: Optional[List[list]] = None, latency: float = 0.0, title: str = "Sheet1",
+                 spreadsheet: Optional[FakeSpreadsheet] = None):
+        self.rows = [list(SHEET_HEADER)] if rows is None else [list(r) for r in rows]
+        self.latency = latency
+        self.title = title
+        self.calls = Counter()
+        self.spreadsheet = spreadsheet or FakeSpreadsheet(latency)
+        self.spreadsheet.sheets.append(self)
+
+    def _call(self, name: str):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def _cell(value) -> str:
+        return "" if value is None else str(value)
+
+    def get_all_values(self, *args, **kwargs) -> List[list]:
+        self._call("get_all_values")
+        return [list(r) for r in self.rows]
+
+    def get_values(self, range_name: str = "", *args, **kwargs) -> List[list]:
+        """Поддерживает диапазоны вида A5:F (до конца листа) и A5:F9"""
+        self._call("get_values")
+        if not range_name:
+            return [list(r) for r in self.rows]
+        start, _, end = range_name.split("!")[-1].partition(":")
+        first = int(start[1:] or 1)
+        last = int(end[1:]) if end[1:] else len(self.rows)
+        return [list(r) for r in self.rows[first - 1:last]]
+
+    def row_values(self, row: int) -> list:
+        self._call("row_values")
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def _append(self, values: list) -> int:
+        self.rows.append([self._cell(v) for v in values])
+        return len(self.rows)
+
+    def _updates(self, first: int, last: int) -> dict:
+        return {"updates": {"updatedRange": f"{self.title}!A{first}:J{last}"}}
+
+    def append_row(self, values: list, *args, **kwargs) -> dict:
+        self._call("append_row")
+        row = self._append(values)
+        return self._updates(row, row)
+
+    def append_rows(self, values: List[list], *args, **kwargs) -> dict:
+        self._call("append_rows")
+        first = len(self.rows) + 1
+        for row in values:
+            self._append(row)
+        return self._updates(first, len(self.rows))
+
+    def update_cell(self, row: int, col: int, value) -> dict:
+        self._call("update_cell")
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        cells.extend([""] * (col - len(cells)))
+        cells[col - 1] = self._cell(value)
+        return {}
+
+    def delete_rows(self, start: int, end: Optional[int] = None) -> dict:
+        self._call("delete_rows")
+        del self.rows[start - 1:(end or start)]
+        return {}
+
+
+def seed_rows(users: int, posts: int, channel_id: str, first_user_id: int = 200000000) -> List[list]:
+    """Таблица с пользователями (у каждого второго — доступ к каналу) и постами"""
+    rows = [list(SHEET_HEADER)]
+    for i in range(users):
+        access = f"{channel_id}:forever" if i % 2 == 0 else ""
+        rows.append([str(first_user_id + i), f"user{i}", "", "", "", "", "", "", "", access])
+    for i in range(1, posts + 1):
+        buttons = f"channel|Подписка|990|{channel_id}|30"
+        rows.append(["", "", "", "", "", str(i), f"Пост {i}", "", buttons, ""])
+    return rows
@@ -0,0 +1,194 @@
+"""Хост нескольких ботов (авторов) в одном процессе.
+
+Каждый автор — отдельный экземпляр модуля main.py со своими Bot, Dispatcher, листом Google Sheets
+и каталогом локального состояния. Общие на весь процесс:
+- одна сессия aiohttp (пул HTTP-соединений к Bot API);
+- бакеты квоты Google Sheets (квота считается на сервисный аккаунт, а не на таблицу);
+- планировщик периодических задач (проверка доступов, сверка участников, уплотнение постов,
+  метаданные каналов) с ограничением одновременных запусков и разнесением по времени;
+- сторож event loop.
+
+Маршруты:
+- /webhook/{token}   — апдейты Telegram, бот выбирается по токену;
+- /t/{name}/...      — приложение автора целиком: платёжный вебхук /t/{name}/webhook, API доступов;
+- /                  — состояние всех авторов.
+
+Авторы описываются в JSON-файле TENANTS_FILE (список объектов):
+    [{"name": "reality", "bot_token": "...", "admin_id": 513148972, "gsheet_id": "...",
+      "channels": {"main": "-1002681575953"}, "payform_url": "https://menyayrealnost.payform.ru"}]
+payment_callback_url обязателен, если не задан RENDER_EXTERNAL_HOSTNAME (тогда https://<host>/t/<name>/webhook).
+Необязательные поля: data_dir (по умолчанию tenants/<name>), credentials_file, access_api_token.
+
+Запуск:
+    uvicorn host:app --host 0.0.0.0 --port $PORT
+"""
+import asyncio
+import heapq
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import time
+from typing import Dict, List
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+TENANTS_FILE = os.getenv("TENANTS_FILE", "tenants.json")
+TENANTS_DIR = os.getenv("TENANTS_DIR", "tenants")  # каталоги состояния авторов по умолчанию
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+JOB_CONCURRENCY = int(os.getenv("HOST_JOB_CONCURRENCY", "4"))  # одновременных периодических задач на весь хост
+JOB_STAGGER = 2.0  # сдвиг первого запуска немедленных задач между авторами, с
+
+logger = logging.getLogger("host")
+
+
+def read_tenants(path: str) -> List[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        tenants = json.load(f)
+    names, tokens = set(), set()
+    for cfg in tenants:
+        missing = [key for key in ("name", "bot_token", "gsheet_id") if not cfg.get(key)]
+        if missing:
+            raise RuntimeError(f"У автора {cfg.get('name', '?')} не заданы: {', '.join(missing)}")
+        if cfg["name"] in names or cfg["bot_token"] in tokens:
+            raise RuntimeError(f"Автор {cfg['name']} описан дважды")
+        names.add(cfg["name"])
+        tokens.add(cfg["bot_token"])
+    return tenants
+
+
+def load_tenant(cfg: dict, shared: dict):
+    """Отдельный экземпляр main.py с настройками автора (модуль читает их из глобального TENANT)"""
+    name = cfg["name"]
+    cfg = {**cfg, **shared}
+    cfg.setdefault("data_dir", os.path.join(TENANTS_DIR, name))
+    os.makedirs(cfg["data_dir"], exist_ok=True)
+    hostname = os.getenv("RENDER_EXTERNAL_HOSTNAME")
+    if hostname:
+        cfg.setdefault("payment_callback_url", f"https://{hostname}/t/{name}/webhook")
+    if not cfg.get("payment_callback_url"):
+        # Иначе main.py подставит адрес исходного сервиса, и оплаты автора уйдут не туда
+        raise RuntimeError(f"У автора {name} не задан payment_callback_url (и нет RENDER_EXTERNAL_HOSTNAME)")
+
+    spec = importlib.util.spec_from_file_location(f"main_{name}", MAIN_PATH)
+    module = importlib.util.module_from_spec(spec)
+    module.TENANT = cfg
+    spec.loader.exec_module(module)
+    return module
+
+
+# === Загрузка авторов ===
+shared = {"session": AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else AiohttpSession()}
+tenants: Dict[str, object] = {}
+for tenant_cfg in read_tenants(TENANTS_FILE):
+    tenant = load_tenant(tenant_cfg, shared)
+    # Бакеты квоты Sheets создаёт первый автор, остальные используют их же
+    shared.setdefault("sheets_buckets", tenant.sheets.buckets)
+    tenants[tenant_cfg["name"]] = tenant
+if not tenants:
+    raise RuntimeError(f"В {TENANTS_FILE} нет ни одного автора")
+
+tenants_by_token = {tenant.BOT_TOKEN: tenant for tenant in tenants.values()}
+loop_watchdog = next(iter(tenants.values())).loop_watchdog
+for tenant in tenants.values():
+    tenant.loop_watchdog = loop_watchdog  # /loop_lag и health_check у всех показывают общий сторож
+
+app = FastAPI()
+stop_event = asyncio.Event()
+host_tasks = set()
+
+
+# === Общий планировщик периодических задач ===
+async def run_job(name: str, tenant, job_name: str, job, running: set, slots: asyncio.Semaphore):
+    try:
+        await tenant.run_periodic_job(job_name, job)
+    finally:
+        running.discard((name, job_name))
+        slots.release()
+
+
+async def scheduler():
+    """Одна очередь задач всех авторов вместо отдельных циклов в каждом модуле.
+
+    Первые запуски разнесены по времени, чтобы задачи разных авторов не совпадали;
+    если предыдущий запуск задачи ещё идёт, очередной пропускается.
+    """
+    now = time.monotonic()
+    seq = itertools.count()
+    queue = []
+    for index, (name, tenant) in enumerate(tenants.items()):
+        for job_name, job, interval, immediately in tenant.PERIODIC_JOBS:
+            offset = index * JOB_STAGGER if immediately else interval + interval * index / len(tenants)
+            heapq.heappush(queue, (now + offset, next(seq), name, job_name, job, interval))
+
+    slots = asyncio.Semaphore(JOB_CONCURRENCY)
+    running = set()
+    logger.info("Планировщик: %s задач у %s авторов", len(queue), len(tenants))
+    while queue:
+        due, _, name, job_name, job, interval = queue[0]
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=max(due - time.monotonic(), 0))
+            return
+        except asyncio.TimeoutError:
+            pass
+        heapq.heappop(queue)
+        heapq.heappush(queue, (max(due + interval, time.monotonic()), next(seq), name, job_name, job, interval))
+
+        tenant = tenants[name]
+        if (name, job_name) in running or tenant.shutdown_event.is_set():
+            logger.warning("Планировщик: %s у %s ещё выполняется, пропускаем запуск", job_name, name)
+            continue
+        await slots.acquire()
+        if stop_event.is_set():
+            # Пока ждали слот, началась остановка — новую задачу не начинаем
+            slots.release()
+            return
+        running.add((name, job_name))
+        # Задачу запускает модуль автора — его shutdown() дождётся её завершения
+        tenant.spawn_background(run_job(name, tenant, job_name, job, running, slots), job_name)
+
+
+# === Маршруты ===
+@app.post("/webhook/{token}")
+async def telegram_webhook(token: str, request: Request):
+    tenant = tenants_by_token.get(token)
+    if tenant is None:
+        return JSONResponse({"ok": False}, status_code=404)
+    return await tenant.telegram_webhook(request)
+
+
+@app.get("/")
+async def health_check():
+    return {"status": "ok", "tenants": {name: await tenant.health_check() for name, tenant in tenants.items()}}
+
+
+for tenant_name, tenant in tenants.items():
+    app.mount(f"/t/{tenant_name}", tenant.app)
+
+
+@app.on_event("startup")
+async def startup():
+    # Смонтированные приложения не получают событий жизненного цикла — запускаем авторов сами
+    await asyncio.gather(*(tenant.startup() for tenant in tenants.values()))
+    first = next(iter(tenants.values()))
+    first.spawn_background(loop_watchdog.run(), "loop_watchdog")
+    task = asyncio.create_task(scheduler(), name="scheduler")
+    host_tasks.add(task)
+    task.add_done_callback(host_tasks.discard)
+    logger.info("Хост запущен: %s", ", ".join(tenants))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    stop_event.set()
+    for task in host_tasks:
+        task.cancel()
+    await asyncio.gather(*host_tasks, return_exceptions=True)
+    await asyncio.gather(*(tenant.shutdown() for tenant in tenants.values()), return_exceptions=True)
+    await shared["session"].close()
+    logger.info("Хост остановлен")
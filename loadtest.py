@@ -0,0 +1,244 @@
+"""Нагрузочный тест бота целиком: FastAPI-приложение + заглушки Bot API и Google Sheets.
+
+Поднимает настоящий `main.app` под uvicorn, локальный FakeBotAPI вместо api.telegram.org
+и FakeWorksheet вместо Google Sheets, после чего с заданной частотой (открытая модель
+нагрузки: запросы уходят по расписанию, не дожидаясь ответов) шлёт:
+- синтетические апдейты Telegram на /webhook/{BOT_TOKEN} (/start, кнопка канала, листание ленты);
+- платежи в формате Prodamus (form-data) на /webhook.
+
+В конце печатает p50/p95/p99, пропускную способность и долю ошибок по каждому потоку,
+а также число вызовов Bot API и Google Sheets.
+
+Пример:
+    python loadtest.py --duration 30 --tg-rate 50 --pay-rate 5 --sheets-latency 0.2
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Callable, List
+
+import aiohttp
+import uvicorn
+
+from fakes import FakeBotAPI, FakeWorksheet, seed_rows
+
+BOT_TOKEN = "123456:loadtest"
+
+
+@dataclass
+class StreamStats:
+    name: str
+    latencies: List[float] = field(default_factory=list)
+    errors: int = 0
+    sent: int = 0
+
+    def percentile(self, q: int) -> float:
+        if not self.latencies:
+            return 0.0
+        if len(self.latencies) == 1:
+            return self.latencies[0]
+        return statistics.quantiles(self.latencies, n=100, method="inclusive")[q - 1]
+
+    def summary(self, elapsed: float) -> dict:
+        done = len(self.latencies)
+        return {
+            "stream": self.name,
+            "sent": self.sent,
+            "completed": done,
+            "throughput_rps": round(done / elapsed, 2) if elapsed else 0.0,
+            "error_rate": round(self.errors / self.sent, 4) if self.sent else 0.0,
+            "p50_ms": round(self.percentile(50) * 1000, 1),
+            "p95_ms": round(self.percentile(95) * 1000, 1),
+            "p99_ms": round(self.percentile(99) * 1000, 1),
+            "max_ms": round(max(self.latencies, default=0.0) * 1000, 1),
+        }
+
+
+class TrafficFactory:
+    """Синтетические апдейты Telegram и платежи Prodamus"""
+
+    def __init__(self, users: int, channel_id: str, first_user_id: int = 200000000):
+        self.user_ids = [first_user_id + i for i in range(users)]
+        self.channel_id = channel_id
+        self._update_ids = itertools.count(1)
+        self._orders = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def _message(self, user_id: int, text: str) -> dict:
+        return {
+            "message_id": random.randint(1, 10 ** 6),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+
+    def telegram_update(self) -> dict:
+        user_id = random.choice(self.user_ids)
+        update = {"update_id": next(self._update_ids)}
+        roll = random.random()
+        if roll < 0.6:
+            update["message"] = self._message(user_id, "/start")
+        else:
+            data = f"buy_channel:{self.channel_id}:990:30" if roll < 0.9 else "feed:1"
+            message = self._message(user_id, "Пост")
+            message["from"] = {"id": 100000001, "is_bot": True, "first_name": "Bot"}
+            update["callback_query"] = {
+                "id": str(update["update_id"]),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": message,
+            }
+        return update
+
+    def payment(self) -> dict:
+        user_id = random.choice(self.user_ids)
+        order = f"channel_{user_id}_{self.channel_id}_30"
+        return {
+            "order_id": str(next(self._orders)),
+            "order_num": order,
+            "payment_status": "success",
+            "sum": "990.00",
+            "customer_extra": f"Оплата доступа к каналу {self.channel_id} на 30 дней от пользователя {user_id}",
+        }
+
+
+async def drive(session: aiohttp.ClientSession, stats: StreamStats, rate: float, duration: float,
+                send: Callable[[aiohttp.ClientSession], "asyncio.Future"]):
+    """Открытая модель: запросы отправляются по расписанию rate/с независимо от ответов"""
+    if rate <= 0:
+        return
+
+    async def one():
+        started = time.perf_counter()
+        try:
+            ok = await send(session)
+        except Exception:
+            ok = False
+        stats.latencies.append(time.perf_counter() - started)
+        if not ok:
+            stats.errors += 1
+
+    tasks = []
+    start = time.perf_counter()
+    for i in itertools.count():
+        due = start + i / rate
+        if due - start >= duration:
+            break
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        stats.sent += 1
+        tasks.append(asyncio.create_task(one()))
+    await asyncio.gather(*tasks)
+
+
+async def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="loadtest_")
+    os.chdir(workdir)
+
+    fake_api = FakeBotAPI(port=args.bot_api_port, latency=args.bot_latency)
+    await fake_api.start()
+
+    os.environ.update({"BOT_TOKEN": BOT_TOKEN, "GSHEET_ID": "loadtest", "TELEGRAM_API_URL": fake_api.url})
+    os.environ.pop("RENDER", None)
+    import main
+
+    if not args.verbose:
+        for name in ("main", "aiogram", "aiogram.event", "uvicorn.error"):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+    channel_id = main.CHANNELS["main"]
+    sheet = FakeWorksheet(seed_rows(args.users, args.posts, channel_id), latency=args.sheets_latency)
+    main.connect_sheets = lambda: sheet
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    while not main.sheets_reconciled.is_set():
+        await asyncio.sleep(0.05)
+
+    base = f"http://127.0.0.1:{args.port}"
+    factory = TrafficFactory(args.users, channel_id)
+
+    async def send_update(session):
+        async with session.post(f"{base}/webhook/{BOT_TOKEN}", json=factory.telegram_update()) as resp:
+            await resp.read()
+            return resp.status == 200
+
+    async def send_payment(session):
+        async with session.post(f"{base}/webhook", data=factory.payment()) as resp:
+            body = await resp.json(content_type=None)
+            return resp.status == 200 and body.get("status") == "success"
+
+    telegram = StreamStats("telegram")
+    payments = StreamStats("payment")
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    started = time.perf_counter()
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(
+            drive(session, telegram, args.tg_rate, args.duration, send_update),
+            drive(session, payments, args.pay_rate, args.duration, send_payment),
+        )
+    elapsed = time.perf_counter() - started
+
+    server.should_exit = True
+    await server_task
+    await fake_api.stop()
+
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "json"},
+        "elapsed_s": round(elapsed, 2),
+        "streams": [telegram.summary(elapsed), payments.summary(elapsed)],
+        "bot_api_calls": dict(fake_api.calls),
+        "sheets_calls": sheet.spreadsheet.call_counts(),
+    }
+
+
+def print_report(report: dict):
+    print(f"Длительность: {report['elapsed_s']} с")
+    print(f"{'поток':<10}{'отпр.':>8}{'готово':>8}{'rps':>9}{'ошибки':>9}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}")
+    for s in report["streams"]:
+        print(f"{s['stream']:<10}{s['sent']:>8}{s['completed']:>8}{s['throughput_rps']:>9}"
+              f"{s['error_rate']:>9.2%}{s['p50_ms']:>9}{s['p95_ms']:>9}{s['p99_ms']:>9}")
+    print("Bot API:", ", ".join(f"{k}={v}" for k, v in sorted(report["bot_api_calls"].items())) or "—")
+    print("Sheets: ", ", ".join(f"{k}={v}" for k, v in sorted(report["sheets_calls"].items())) or "—")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=30.0, help="секунд нагрузки")
+    parser.add_argument("--tg-rate", type=float, default=20.0, help="апдейтов Telegram в секунду")
+    parser.add_argument("--pay-rate", type=float, default=2.0, help="платежей в секунду")
+    parser.add_argument("--users", type=int, default=1000, help="пользователей в таблице")
+    parser.add_argument("--posts", type=int, default=20, help="постов в таблице")
+    parser.add_argument("--bot-latency", type=float, default=0.05, help="задержка ответа Bot API, с")
+    parser.add_argument("--sheets-latency", type=float, default=0.2, help="задержка вызова Google Sheets, с")
+    parser.add_argument("--connections", type=int, default=100, help="максимум одновременных соединений")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--bot-api-port", type=int, default=8091)
+    parser.add_argument("--json", action="store_true", help="вывести отчёт в JSON")
+    parser.add_argument("--verbose", action="store_true", help="не приглушать логи бота")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
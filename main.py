@@ -1,64 +1,1001 @@
 import os
 import json
 import logging
+import queue
+import atexit
+import csv
+import tempfile
 import re
+import html
+import hashlib
+import hmac
 import asyncio
+import contextvars
+import functools
+import heapq
+import inspect
+import itertools
+import random
+import sys
+import threading
+import time
+import traceback
 from datetime import datetime, timedelta
 from urllib.parse import unquote
-from typing import List, Optional, Dict
+from typing import Any, Awaitable, Callable, List, Optional, Dict
+from collections import Counter, OrderedDict, deque
+from logging.handlers import QueueHandler, QueueListener
 from fastapi import FastAPI, Request
-from aiogram import Bot, Dispatcher, types, F
+from fastapi.responses import JSONResponse, Response
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove, InputMediaPhoto, FSInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-import gspread
-from google.oauth2.service_account import Credentials
 
 # === CONFIG ===
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_ID = int(os.getenv("ADMIN_ID", "513148972"))
-GSHEET_ID = os.getenv("GSHEET_ID")
-PAYFORM_URL = "https://menyayrealnost.payform.ru"
-USERS_FILE = "paid_users.json"
-CHANNEL_ACCESS_FILE = "channel_access.json"
+# Настройки автора, если модуль загружен хостом нескольких ботов (host.py), иначе — переменные окружения.
+# Хост кладёт словарь TENANT в модуль до его выполнения
+TENANT = globals().get("TENANT") or {}
+BOT_TOKEN = TENANT.get("bot_token") or os.getenv("BOT_TOKEN")
+ADMIN_ID = int(TENANT.get("admin_id") or os.getenv("ADMIN_ID", "513148972"))
+GSHEET_ID = TENANT.get("gsheet_id") or os.getenv("GSHEET_ID")
+PAYFORM_URL = TENANT.get("payform_url") or "https://menyayrealnost.payform.ru"
+# Куда платёжная форма шлёт уведомления об оплате
+PAYMENT_CALLBACK_URL = TENANT.get("payment_callback_url") or "https://telegram-subscribe-bot-5oh7.onrender.com/webhook"
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # свой Bot API сервер (локальный или тестовый)
+DATA_DIR = TENANT.get("data_dir") or "."  # каталог локальных файлов состояния
+USERS_FILE = os.path.join(DATA_DIR, "paid_users.json")
+POSTS_CACHE_TTL = 300  # секунд, сколько живёт кэш постов для ленты
+POSTS_COMPACT_INTERVAL = 6 * 3600  # секунд между удалениями строк-надгробий из таблицы
+CHANNEL_INFO_TTL = 6 * 3600  # секунд, сколько живут название и число участников канала
+POST_TOMBSTONE = "~"  # префикс post_id удалённого поста
+
+# Квоты Google Sheets (запросов в минуту на пользователя сервисного аккаунта)
+SHEETS_READS_PER_MINUTE = int(os.getenv("SHEETS_READS_PER_MINUTE", "60"))
+SHEETS_WRITES_PER_MINUTE = int(os.getenv("SHEETS_WRITES_PER_MINUTE", "60"))
+SHEETS_MAX_RETRIES = 5
+SHEETS_BACKOFF_BASE = 1.0  # секунд
+SHEETS_BACKOFF_CAP = 32.0  # секунд
+
+# Приоритеты запросов к таблице: меньше — важнее
+PRIORITY_PAYMENT = 0
+PRIORITY_ADMIN = 1
+PRIORITY_FEED = 2
+PRIORITY_SWEEP = 3
+PRIORITY_REGISTRATION = 4
+CHANNEL_ACCESS_FILE = os.path.join(DATA_DIR, "channel_access.json")
+UNREACHABLE_FILE = os.path.join(DATA_DIR, "unreachable_users.json")
+STATE_SNAPSHOT_FILE = os.path.join(DATA_DIR, "state_snapshot.json")
+ACCESS_SAVE_DELAY = 1.0  # секунд: изменения доступов за это время сохраняются на диск одной записью
+PAYMENTS_LEDGER_FILE = os.path.join(DATA_DIR, "payments_ledger.jsonl")
+PAYMENTS_ROLLUPS_FILE = os.path.join(DATA_DIR, "payments_rollups.json")
+RECONCILE_STATE_FILE = os.path.join(DATA_DIR, "reconcile_state.json")
+FILE_CATALOG_FILE = os.path.join(DATA_DIR, "file_catalog.json")
+GRANTS_SHEET_TITLE = "grants"
+GRANTS_HEADER = ["ts", "user_id", "channel_id", "event", "expiry", "source"]
+CHANNEL_INFO_FILE = os.path.join(DATA_DIR, "channel_info.json")
+SEEN_UPDATES_FILE = os.path.join(DATA_DIR, "seen_updates.json")
+SEEN_UPDATES_TTL = 3600  # секунд, сколько помним принятый update_id (повторы Telegram приходят в пределах минут)
+SEEN_UPDATES_LIMIT = 20000  # update_id в памяти, самые старые вытесняются
+SEEN_UPDATES_SAVE_INTERVAL = 30  # секунд между сохранениями на диск
+OUTBOX_FILE = os.path.join(DATA_DIR, "outbox.jsonl")
+OUTBOX_MESSAGES_PER_MINUTE = 1200  # общий лимит сообщений из очереди (у Telegram ~30 в секунду на бота)
+OUTBOX_CHAT_INTERVAL = 1.0  # секунд между сообщениями в один чат
+OUTBOX_CONCURRENCY = 10  # одновременных отправок
+OUTBOX_MAX_ATTEMPTS = 10  # после стольких сетевых ошибок сообщение снимается, админу уходит уведомление
+OUTBOX_BACKOFF_BASE = 2.0  # секунд
+OUTBOX_BACKOFF_CAP = 600.0  # секунд
+OUTBOX_COMPACT_AFTER = 1000  # доставленных записей в журнале, после которых он переписывается
+MESSAGE_MAX_LENGTH = 4096
+OUTBOX_ALERT_TEXT_LIMIT = 500  # символов недоставленного текста в уведомлении админу (после html.escape до 6 раз длиннее)
+RECONCILE_BATCH_SIZE = 20  # проверок get_chat_member за один проход
+RECONCILE_INTERVAL = 300  # секунд между проходами
+RECONCILE_CALLS_PER_MINUTE = 30  # общий лимит запросов сверки к Bot API
+RECONCILE_AUTOFIX = os.getenv("RECONCILE_AUTOFIX", "1") == "1"
+# Ограничение частоты запросов одного пользователя: {тип: (запросов в минуту, запас)}
+THROTTLE_RULES = {
+    "start": (6, 3),
+    "buy_channel": (10, 3),
+    "buy_file": (10, 3),
+    "feed": (60, 10),
+    "default": (30, 10),
+}
+BULK_GRANT_MAX_ERRORS = 20  # сколько ошибок CSV показывать в отчёте
+BULK_GRANT_MAX_DAYS = 36500  # больше ста лет — почти наверняка опечатка, да и timedelta переполнится
+BULK_INVITES_PER_MINUTE = 60
+BULK_INVITE_CONCURRENCY = 5
+LOOP_LAG_INTERVAL = 0.1  # секунд между замерами задержки event loop
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.5"))  # с какой задержки (с) снимать стек
+LOOP_LAG_SAMPLES = 3000  # замеров для перцентилей (~5 минут)
+LOOP_LAG_OFFENDERS = 20  # мест блокировки в отчёте
+LOOP_LAG_STACK_DEPTH = 12  # кадров стека на место
+SWEEP_CONCURRENCY = 10  # просроченных доступов, снимаемых одновременно
+THROTTLE_REPEAT_WINDOW = 3.0  # секунд: одинаковый запрос повторно не обрабатываем
+# Только для кнопок, ответ на которые — отдельное сообщение выше (двойное нажатие «Купить»).
+# Листание ленты и команды не подавляем: пользователь остался бы без ответа
+THROTTLE_REPEAT_KINDS = {"buy_channel", "buy_file"}
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "20"))  # секунд на остановку (Render даёт 30)
+ACCESS_API_TOKEN = TENANT.get("access_api_token") or os.getenv("ACCESS_API_TOKEN")  # Bearer-токен API проверки доступа (без него API выключен)
+ACCESS_API_BATCH_LIMIT = 1000  # пользователей в одном пакетном запросе
+TRAFFIC_RECORD_FILE = os.getenv("TRAFFIC_RECORD_FILE")  # журнал входящих вебхуков для replay.py (выключен, если не задан)
+if TRAFFIC_RECORD_FILE:
+    TRAFFIC_RECORD_FILE = os.path.join(DATA_DIR, TRAFFIC_RECORD_FILE)
+# Соль псевдонимов пользователей. Обязательна при записи: со случайной солью после перезапуска
+# у того же пользователя в журнале был бы другой псевдоним
+TRAFFIC_RECORD_SALT = os.getenv("TRAFFIC_RECORD_SALT")
+TRACE_FILE = os.getenv("TRACE_FILE")  # спаны в формате OTLP/JSON для traces.py или OpenTelemetry Collector (выключено, если не задан)
+if TRACE_FILE:
+    TRACE_FILE = os.path.join(DATA_DIR, TRACE_FILE)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))  # доля записываемых трасс
+TRACE_FLUSH_INTERVAL = 5  # секунд между записями буфера спанов в файл
+TRACE_BUFFER_LIMIT = 10000  # спанов в буфере, лишние отбрасываются
+SHEETS_CREDENTIALS_FILE = TENANT.get("credentials_file") or '/etc/secrets/GSPREAD_CREDENTIALS.json'
 
 # Основные каналы
-CHANNELS = {
+CHANNELS = TENANT.get("channels") or {
     "main": "-1002681575953",  # Основной канал "Меняя реальность"
 }
+CHANNEL_NAMES = {channel_id: name for name, channel_id in CHANNELS.items()}
 
 # Проверка переменных
 if not all([BOT_TOKEN, GSHEET_ID]):
     missing = [name for name, val in [("BOT_TOKEN", BOT_TOKEN), ("GSHEET_ID", GSHEET_ID)] if not val]
     raise RuntimeError(f"Не заданы: {', '.join(missing)}")
+if TRAFFIC_RECORD_FILE and not TRAFFIC_RECORD_SALT:
+    raise RuntimeError("Задан TRAFFIC_RECORD_FILE, но не задан TRAFFIC_RECORD_SALT")
 
 # Настройка логгирования
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+LOG_SAMPLE_INTERVAL = 60  # секунд
+LOG_SAMPLE_BURST = 5  # однотипных строк за интервал, остальные отбрасываются
+
+# Стандартные атрибуты LogRecord — всё остальное пришло через extra и попадает в JSON
+_LOG_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "sample"}
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: стандартные поля плюс поля из extra"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LogSampler(logging.Filter):
+    """Сэмплирование повторяющихся строк (extra=SAMPLED): не больше LOG_SAMPLE_BURST за интервал на шаблон"""
+    
+    def __init__(self):
+        super().__init__()
+        self._windows = {}  # {(logger, шаблон): [начало окна, пропущено, отброшено]}
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sample", False):
+            return True
+        
+        now = time.monotonic()
+        key = (record.name, record.msg)
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= LOG_SAMPLE_INTERVAL:
+            if window and window[2]:
+                record.suppressed = window[2]
+            window = self._windows[key] = [now, 0, 0]
+        
+        window[1] += 1
+        if window[1] > LOG_SAMPLE_BURST:
+            window[2] += 1
+            return False
+        return True
+
+class DeferredQueueHandler(QueueHandler):
+    """Кладёт запись в очередь как есть — форматирование и вывод в потоке QueueListener"""
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+SAMPLED = {"sample": True}
+
+log_output = logging.StreamHandler()
+log_output.setFormatter(
+    JsonFormatter() if LOG_FORMAT == "json"
+    else logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 )
+# Модуль может выполняться несколько раз (по экземпляру на автора в host.py) — вывод настраиваем один раз
+if not any(isinstance(handler, QueueHandler) for handler in logging.getLogger().handlers):
+    log_queue = queue.SimpleQueue()
+    log_handler = DeferredQueueHandler(log_queue)
+    log_handler.addFilter(LogSampler())
+    logging.basicConfig(level=logging.INFO, handlers=[log_handler])
+    log_listener = QueueListener(log_queue, log_output, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
+# === Трассировка ===
+# Трасса — один входящий апдейт, платёж или запуск фоновой задачи; спаны — вложенные шаги
+# (выдача доступа, вызовы Bot API и Google Sheets). Текущий спан хранится в contextvar
+# и переходит в дочерние задачи и asyncio.to_thread вместе с контекстом
+SPAN_KIND_INTERNAL, SPAN_KIND_SERVER, SPAN_KIND_CLIENT = 1, 2, 3
+current_span = contextvars.ContextVar(f"{__name__}.current_span", default=None)
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start", "end", "attributes", "error", "sampled")
+    
+    def __init__(self, name: str, kind: int, parent: Optional["Span"], attributes: dict):
+        if parent:
+            self.trace_id, self.sampled = parent.trace_id, parent.sampled
+        else:
+            self.trace_id, self.sampled = f"{random.getrandbits(128):032x}", random.random() < TRACE_SAMPLE_RATE
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent else ""
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.error = None
+        self.start = time.time_ns()
+        self.end = None
+    
+    @staticmethod
+    def _value(value) -> dict:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+    
+    def otlp(self) -> dict:
+        """Спан в JSON-представлении OTLP"""
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [{"key": key, "value": self._value(value)} for key, value in self.attributes.items() if value is not None],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 0},
+        }
+
+class trace_span:
+    """Контекстный менеджер спана: with trace_span("sheets.append_rows", SPAN_KIND_CLIENT, priority=0): ..."""
+    
+    def __init__(self, name: str, kind: int = SPAN_KIND_INTERNAL, **attributes):
+        self.span = Span(name, kind, current_span.get(), attributes)
+        self._token = None
+    
+    def __enter__(self) -> Span:
+        self._token = current_span.set(self.span)
+        return self.span
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None and self.span.error is None:
+            self.span.error = f"{exc_type.__name__}: {exc}"
+        self.span.end = time.time_ns()
+        current_span.reset(self._token)
+        span_exporter.add(self.span)
+
+def traced(name: str, *arg_names: str, kind: int = SPAN_KIND_INTERNAL):
+    """Декоратор корутины: вызов — спан name с аргументами arg_names в атрибутах"""
+    def decorator(fn):
+        signature = inspect.signature(fn)
+        
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            attributes = {}
+            if arg_names:
+                bound = signature.bind_partial(*args, **kwargs).arguments
+                attributes = {key: bound[key] for key in arg_names if key in bound}
+            with trace_span(name, kind, **attributes):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def trace_set(**attributes):
+    """Добавляет атрибуты текущему спану"""
+    span = current_span.get()
+    if span:
+        span.attributes.update(attributes)
+
+def trace_error(error: Exception):
+    """Помечает текущий спан ошибкой, если исключение обработано и дальше не летит"""
+    span = current_span.get()
+    if span:
+        span.error = f"{type(error).__name__}: {error}"
+
+class SpanExporter:
+    """Законченные спаны копятся в памяти и раз в TRACE_FLUSH_INTERVAL дописываются в TRACE_FILE.
+    
+    Строка файла — запрос экспорта OTLP/JSON (resourceSpans), как у файлового экспортёра
+    OpenTelemetry Collector: файл читает traces.py или receiver otlpjsonfile.
+    """
+    
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.buffer = []
+        self.exported = 0
+        self.dropped = 0
+        self.resource = {"attributes": [
+            {"key": "service.name", "value": {"stringValue": "telegram-subscribe-bot"}},
+            {"key": "service.instance.id", "value": {"stringValue": TENANT.get("name") or "default"}},
+        ]}
+    
+    def add(self, span: Span):
+        if not self.path or not span.sampled:
+            return
+        if len(self.buffer) >= TRACE_BUFFER_LIMIT:
+            self.dropped += 1
+            return
+        self.buffer.append(span)
+    
+    def _write(self, spans: List[Span]):
+        request = {"resourceSpans": [{
+            "resource": self.resource,
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": [span.otlp() for span in spans]}],
+        }]}
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(request, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.exported += len(spans)
+    
+    async def flush(self):
+        spans, self.buffer = self.buffer, []
+        if spans:
+            await asyncio.to_thread(self._write, spans)
+    
+    def flush_sync(self):
+        spans, self.buffer = self.buffer, []
+        if spans:
+            self._write(spans)
+    
+    def stats(self) -> dict:
+        return {"enabled": bool(self.path), "exported": self.exported, "buffered": len(self.buffer), "dropped": self.dropped}
+
+span_exporter = SpanExporter(TRACE_FILE)
+
+class TraceLogFilter(logging.Filter):
+    """trace_id и span_id текущего спана в каждой записи лога — по ним строки лога находятся в трассе"""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        span = current_span.get()
+        if span:
+            record.trace_id = span.trace_id
+            record.span_id = span.span_id
+        return True
+
+logger.addFilter(TraceLogFilter())
+
 # Инициализация бота
+# На хосте все боты используют одну сессию — общий пул HTTP-соединений
 bot = Bot(
     token=BOT_TOKEN,
+    session=TENANT.get("session") or (AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None),
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
 dp = Dispatcher(storage=MemoryStorage())
 app = FastAPI()
 
+class BotApiTracing(BaseRequestMiddleware):
+    """Спан на каждый вызов Bot API. Сессия на хосте общая — чужие боты проходят мимо"""
+    
+    async def __call__(self, make_request, request_bot: Bot, method):
+        if request_bot is not bot:
+            return await make_request(request_bot, method)
+        with trace_span(f"telegram.{method.__api_method__}", SPAN_KIND_CLIENT, chat_id=getattr(method, "chat_id", None)):
+            return await make_request(request_bot, method)
+
+bot.session.middleware(BotApiTracing())
+
 # Хранилища
 paid_files = {}
-file_id_mapping = {}
+file_catalog = {"files": {}, "next_id": 1}  # {короткий id: {file_id, kind, size, name, added}}
+file_short_ids = {}  # {file_id: короткий id} — обратный индекс каталога
+channel_info = {}  # {channel_id: {title, username, invite_link, join_by_request, member_count, fetched_at}}
+channel_ids_by_name = {}  # {имя или название в нижнем регистре: channel_id}
 channel_access = {}  # {user_id: {channel_id: expiry_date}}
+unreachable_users = {}  # {user_id: {"reason": str, "since": iso}}
+posts_cache = {"posts": [], "loaded_at": 0.0}  # кэш опубликованных постов для ленты
+known_users = set()  # id пользователей, уже записанных в таблицу
+post_index = {"rows": {}, "next_id": 1, "tombstones": 0}  # {post_id: номер строки}, счётчик id, число надгробий
+pending_registrations = {}  # {user_id: username} — написали боту до подключения к таблице
+sheets_reconciled = asyncio.Event()  # таблица подключена и сверена с локальным состоянием
+boot_stats = {"started": time.monotonic()}
+payment_rollups = {}  # агрегаты по платежам, см. empty_rollups()
+# Сверка участников каналов: курсор, бывшие подписчики и статистика прохода
+reconcile_state = {"cursor": None, "former_members": {}, "pass": {}, "last_pass": None}
+
+# === Клиент Google Sheets с учётом квот ===
+class TokenBucket:
+    """Token bucket: ожидающие получают токены в порядке приоритета"""
+    
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._waiters = []  # heap: (priority, seq, future)
+        self._seq = itertools.count()
+        self._pump_task = None
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def try_acquire(self) -> bool:
+        """Забирает токен без ожидания, если он есть"""
+        self._refill()
+        if self.tokens >= 1 and not self._waiters:
+            self.tokens -= 1
+            return True
+        return False
+    
+    def drain(self):
+        """Обнуляет запас токенов (например, после ответа 429)"""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+    
+    async def acquire(self, priority: int = 0) -> float:
+        """Ждёт токен и возвращает время ожидания в секундах"""
+        if self.try_acquire():
+            return 0.0
+        
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await future
+        return time.monotonic() - started
+    
+    async def _pump(self):
+        while self._waiters:
+            self._refill()
+            if self.tokens >= 1:
+                _, _, future = heapq.heappop(self._waiters)
+                if not future.done():
+                    self.tokens -= 1
+                    future.set_result(None)
+            else:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def sheets_error_status(error: Exception) -> Optional[int]:
+    """HTTP-статус ошибки gspread (APIError хранит ответ в .response)"""
+    return getattr(getattr(error, "response", None), "status_code", None)
+
+class SheetsClient:
+    """Единая точка доступа к Google Sheets: квоты, повторы, приоритеты и метрики"""
+    
+    def __init__(self, worksheet=None, buckets: Optional[Dict[str, TokenBucket]] = None):
+        self.worksheet = worksheet
+        self.grants_worksheet = None  # лист журнала выдачи доступов
+        # Квота Google считается на сервисный аккаунт: на хосте бакеты общие для всех авторов
+        self.buckets = buckets or {
+            "read": TokenBucket(SHEETS_READS_PER_MINUTE),
+            "write": TokenBucket(SHEETS_WRITES_PER_MINUTE),
+        }
+        self.metrics = {
+            kind: {"requests": 0, "retries": 0, "errors": 0, "rate_limited": 0, "throttled_seconds": 0.0}
+            for kind in self.buckets
+        }
+        self.pending_writes = 0
+        self._writes_idle = asyncio.Event()
+        self._writes_idle.set()
+    
+    @property
+    def ready(self) -> bool:
+        return self.worksheet is not None
+    
+    @property
+    def grants_ready(self) -> bool:
+        return self.grants_worksheet is not None
+    
+    async def read(self, op: str, *args, priority: int = PRIORITY_ADMIN, grants: bool = False, **kwargs):
+        """Чтение: вызывает метод листа op (grants=True — листа журнала доступов), расходуя квоту на чтение"""
+        with trace_span(f"sheets.{op}", SPAN_KIND_CLIENT, priority=priority, grants=grants):
+            return await self._call("read", op, args, kwargs, priority, grants)
+    
+    async def write(self, op: str, *args, priority: int = PRIORITY_ADMIN, grants: bool = False, **kwargs):
+        """Запись: вызывает метод листа op, расходуя квоту на запись"""
+        self.pending_writes += 1
+        self._writes_idle.clear()
+        try:
+            with trace_span(f"sheets.{op}", SPAN_KIND_CLIENT, priority=priority, grants=grants):
+                return await self._call("write", op, args, kwargs, priority, grants)
+        finally:
+            self.pending_writes -= 1
+            if not self.pending_writes:
+                self._writes_idle.set()
+    
+    async def drain(self, timeout: float) -> bool:
+        """Ждёт завершения начатых записей. Возвращает False, если не успели"""
+        try:
+            await asyncio.wait_for(self._writes_idle.wait(), timeout=max(timeout, 0))
+            return True
+        except asyncio.TimeoutError:
+            return False
+    
+    async def _call(self, kind: str, op: str, args: tuple, kwargs: dict, priority: int, grants: bool = False):
+        worksheet = self.grants_worksheet if grants else self.worksheet
+        if worksheet is None:
+            raise RuntimeError("Google Sheets не подключен")
+        
+        bucket = self.buckets[kind]
+        stats = self.metrics[kind]
+        method = getattr(worksheet, op)
+        
+        throttled = 0.0
+        for attempt in range(SHEETS_MAX_RETRIES + 1):
+            waited = await bucket.acquire(priority)
+            throttled += waited
+            stats["throttled_seconds"] += waited
+            stats["requests"] += 1
+            trace_set(attempts=attempt + 1, throttled_s=round(throttled, 3))
+            try:
+                # gspread синхронный — выполняем вне event loop
+                return await asyncio.to_thread(method, *args, **kwargs)
+            except Exception as e:
+                status = sheets_error_status(e)
+                if status == 429:
+                    stats["rate_limited"] += 1
+                    bucket.drain()
+                # 429, 5xx и сетевые ошибки (requests наследует их от OSError) повторяем
+                retriable = status == 429 or (status or 0) >= 500 or (status is None and isinstance(e, OSError))
+                if not retriable or attempt == SHEETS_MAX_RETRIES:
+                    stats["errors"] += 1
+                    raise
+                
+                delay = random.uniform(0, min(SHEETS_BACKOFF_CAP, SHEETS_BACKOFF_BASE * 2 ** attempt))
+                stats["retries"] += 1
+                logger.warning("Google Sheets %s: статус %s, повтор %s через %.1f с", op, status, attempt + 1, delay)
+                await asyncio.sleep(delay)
+    
+    def stats(self) -> dict:
+        return {
+            kind: {
+                **{k: round(v, 2) if isinstance(v, float) else v for k, v in self.metrics[kind].items()},
+                "tokens_available": round(self.buckets[kind].tokens, 1),
+                "waiting": len(self.buckets[kind]._waiters),
+            }
+            for kind in self.buckets
+        }
+
+sheets = SheetsClient(buckets=TENANT.get("sheets_buckets"))
+# Журнал доступов: прочитано строк, свои добавленные строки, события, ещё не записанные в лист
+grants_state = {"rows_seen": 0, "own_rows": set(), "backlog": []}
+grants_lock = asyncio.Lock()
+
+# === Жизненный цикл фоновых задач ===
+shutdown_event = asyncio.Event()  # выставляется при остановке: новые задачи не берём
+background_tasks = set()
+
+def spawn_background(coro, name: str) -> asyncio.Task:
+    """Запускает фоновую задачу, которую остановка дождётся или отменит"""
+    task = asyncio.create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def sleep_or_shutdown(seconds: float) -> bool:
+    """Спит seconds секунд. Возвращает True, если началась остановка"""
+    try:
+        await asyncio.wait_for(shutdown_event.wait(), timeout=seconds)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+# === Единственный писатель доступов ===
+class WorkingStore(dict):
+    """Рабочая копия хранилища на время пачки: помнит прежние значения изменённых ключей,
+    чтобы изменения упавшей операции можно было откатить"""
+    
+    _MISSING = object()
+    
+    def __init__(self, data: dict):
+        super().__init__(data)
+        self.undo = {}
+    
+    def _remember(self, key):
+        if key not in self.undo:
+            self.undo[key] = dict.get(self, key, self._MISSING)
+    
+    def __setitem__(self, key, value):
+        self._remember(key)
+        super().__setitem__(key, value)
+    
+    def __delitem__(self, key):
+        self._remember(key)
+        super().__delitem__(key)
+    
+    def pop(self, key, *default):
+        self._remember(key)
+        return super().pop(key, *default)
+    
+    def rollback(self):
+        for key, value in self.undo.items():
+            if value is self._MISSING:
+                super().pop(key, None)
+            else:
+                super().__setitem__(key, value)
+        self.undo = {}
+
+class AccessState:
+    """Актор — единственный, кто меняет channel_access и paid_files.
+    
+    Изменения ставятся в очередь и применяются по порядку одной задачей-владельцем.
+    После каждой пачки публикуются новые словари (version увеличивается): вложенные словари
+    не меняются на месте, так что опубликованный снимок можно обходить через await без гонок.
+    Операция применяется целиком или никак: если она упала, её изменения откатываются.
+    На диск изменения пишутся не после каждой пачки, а раз в ACCESS_SAVE_DELAY и в потоке.
+    """
+    
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.version = 0
+        self.applied = 0
+        self.stores = {}  # рабочие копии {"channels": ..., "files": ...} на время пачки
+        self.dirty = False  # есть изменения, ещё не записанные на диск
+        self._task = None
+        self._saver = None
+    
+    def start(self):
+        if self._task is None or self._task.done():
+            # Свой контекст: иначе актор унаследует трассу запроса, который его запустил
+            self._task = asyncio.create_task(self._run(), name="access_state", context=contextvars.Context())
+    
+    async def submit(self, op: Callable, *args):
+        """Ставит изменение op(state, *args) в очередь и возвращает его результат"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((op, args, future))
+        return await future
+    
+    async def _run(self):
+        global channel_access, paid_files
+        while True:
+            batch = [await self.queue.get()]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            
+            self.stores = {"channels": WorkingStore(channel_access), "files": WorkingStore(paid_files)}
+            for op, args, future in batch:
+                before = dict(self.stores)
+                try:
+                    result = op(self, *args)
+                except Exception as e:
+                    self.stores = before
+                    for store in before.values():
+                        store.rollback()
+                    logger.error("Ошибка изменения доступов %s, изменения операции отменены: %s", op.__name__, e, exc_info=True)
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                for name, store in list(self.stores.items()):
+                    if isinstance(store, WorkingStore):
+                        store.undo = {}
+                    else:
+                        self.stores[name] = WorkingStore(store)  # операция подменила хранилище целиком
+                if not future.done():
+                    future.set_result(result)
+            
+            channel_access, paid_files = self.stores["channels"], self.stores["files"]
+            self.version += 1
+            self.applied += len(batch)
+            self.dirty = True
+            if self._saver is None or self._saver.done():
+                self._saver = spawn_background(self._save_later(), "access_save")
+    
+    async def _save_later(self):
+        """Отложенная запись: изменения нескольких пачек — одной записью, сериализация вне event loop"""
+        while self.dirty:
+            await asyncio.sleep(ACCESS_SAVE_DELAY)
+            self.dirty = False
+            await asyncio.to_thread(write_state, *state_payload())
+    
+    # Примитивы для операций: вложенный словарь пользователя всегда заменяется копией
+    def get(self, store: str, user_id: str, target: str):
+        return self.stores[store].get(user_id, {}).get(target)
+    
+    def set(self, store: str, user_id: str, target: str, expiry):
+        data = self.stores[store]
+        data[user_id] = {**data.get(user_id, {}), target: expiry}
+    
+    def remove(self, store: str, user_id: str, target: str) -> bool:
+        data = self.stores[store]
+        entries = data.get(user_id)
+        if not entries or target not in entries:
+            return False
+        entries = {k: v for k, v in entries.items() if k != target}
+        if entries:
+            data[user_id] = entries
+        else:
+            del data[user_id]
+        return True
+
+access_state = AccessState()
+
+def set_access(state: AccessState, store: str, user_id: str, target: str, expiry):
+    state.set(store, user_id, target, expiry)
+    return expiry
+
+def revoke_access(state: AccessState, store: str, user_id: str, target: str, expected) -> bool:
+    """Снимает доступ, только если срок не изменился: продление во время проверки не теряется"""
+    if state.get(store, user_id, target) != expected:
+        return False
+    return state.remove(store, user_id, target)
+
+def extend_access(state: AccessState, user_id: str, channel_id: str, days: int):
+    """Продлевает доступ к каналу от текущего срока, если он ещё не истёк. Возвращает новый срок"""
+    current = state.get("channels", user_id, channel_id)
+    if current == "forever":
+        return "forever"
+    if days == 0:
+        expiry = "forever"
+    else:
+        start = current if isinstance(current, datetime) and current > datetime.now() else datetime.now()
+        expiry = start + timedelta(days=days)
+    state.set("channels", user_id, channel_id, expiry)
+    return expiry
+
+def apply_grant_events(state: AccessState, rows: List[list]) -> int:
+    return fold_grant_events(rows, state.stores["channels"])
+
+def merge_sheet_access(state: AccessState, sheet_access: dict):
+    """Журнал из таблицы — основной источник, локальные доступы дополняют его"""
+    for user_id, channels in state.stores["channels"].items():
+        sheet_access[user_id] = {**sheet_access.get(user_id, {}), **channels}
+    state.stores["channels"] = sheet_access
+
+# === Журнал выдачи доступов (лист grants) ===
+# Одна строка — одно событие: выдача (grant) со сроком или отзыв (revoke).
+# Запись — только append_rows без предварительного чтения; текущее состояние — свёртка событий по порядку строк.
+def connect_grants_sheet(worksheet):
+    """Лист журнала доступов в той же таблице; создаётся при первом подключении"""
+    spreadsheet = worksheet.spreadsheet
+    for sheet in spreadsheet.worksheets():
+        if sheet.title == GRANTS_SHEET_TITLE:
+            return sheet
+    sheet = spreadsheet.add_worksheet(title=GRANTS_SHEET_TITLE, rows=1000, cols=len(GRANTS_HEADER))
+    sheet.append_row(GRANTS_HEADER)
+    logger.info("Создан лист журнала доступов %s", GRANTS_SHEET_TITLE)
+    return sheet
+
+def grant_event(user_id, channel_id: str, expiry, source: str) -> list:
+    """Строка события: expiry=None — отзыв доступа"""
+    if expiry is None:
+        event, expiry = "revoke", ""
+    else:
+        event = "grant"
+        expiry = expiry.isoformat() if isinstance(expiry, datetime) else expiry
+    return [datetime.now().isoformat(timespec="seconds"), str(user_id), channel_id, event, expiry, source]
+
+def fold_grant_events(rows: List[list], access: dict) -> int:
+    """Применяет события к словарю доступов по порядку. Возвращает число применённых событий.
+    
+    Вложенные словари заменяются, а не меняются на месте — годится для рабочей копии AccessState.
+    """
+    applied = 0
+    for row in rows:
+        if len(row) < 4:
+            continue
+        user_id, channel_id, event = str(row[1]).strip(), str(row[2]).strip(), str(row[3]).strip()
+        if not user_id.isdigit() or not channel_id:
+            continue  # заголовок и посторонние строки
+        
+        if event == "grant":
+            expiry_str = str(row[4]).strip() if len(row) > 4 else ""
+            try:
+                expiry = "forever" if expiry_str == "forever" else datetime.fromisoformat(expiry_str)
+            except ValueError:
+                logger.error("Неверный срок в журнале доступов: %s", expiry_str)
+                continue
+            access[user_id] = {**access.get(user_id, {}), channel_id: expiry}
+        elif event == "revoke":
+            channels = {k: v for k, v in access.get(user_id, {}).items() if k != channel_id}
+            if channels:
+                access[user_id] = channels
+            else:
+                access.pop(user_id, None)
+        else:
+            continue
+        applied += 1
+    return applied
+
+def appended_rows(response) -> range:
+    """Номера строк, добавленных append_rows (из updatedRange ответа API)"""
+    try:
+        match = re.search(r"![A-Z]+(\d+)(?::[A-Z]+(\d+))?", response["updates"]["updatedRange"])
+    except (KeyError, TypeError):
+        return range(0)
+    if not match:
+        return range(0)
+    first = int(match.group(1))
+    return range(first, int(match.group(2) or first) + 1)
+
+@traced("grants.append", "priority")
+async def append_grant_events(events: List[list], priority: int = PRIORITY_ADMIN):
+    """Слепое добавление событий в журнал. Одновременные вызовы объединяются в один append_rows.
+    
+    Если лист недоступен, события остаются в очереди и уйдут со следующей записью.
+    """
+    grants_state["backlog"].extend(events)
+    if not sheets.grants_ready:
+        return
+    
+    async with grants_lock:
+        rows = grants_state["backlog"]
+        if not rows:
+            return  # наши события уже записал предыдущий вызов
+        grants_state["backlog"] = []
+        try:
+            response = await sheets.write("append_rows", rows, priority=priority, grants=True)
+        except Exception as e:
+            grants_state["backlog"] = rows + grants_state["backlog"]
+            logger.error("Ошибка записи в журнал доступов (%s событий отложено): %s", len(rows), e)
+            return
+        # Свои строки уже применены в памяти — при инкрементальном чтении их пропускаем
+        grants_state["own_rows"].update(appended_rows(response))
+
+@traced("grants.read", "priority")
+async def read_grant_events(priority: int) -> int:
+    """Дочитывает новые строки журнала (добавленные другими экземплярами или вручную)"""
+    async with grants_lock:
+        first = grants_state["rows_seen"] + 1
+        rows = await sheets.read("get_values", f"A{first}:F", priority=priority, grants=True)
+        own_rows = grants_state["own_rows"]
+        foreign = [row for number, row in enumerate(rows, start=first) if number not in own_rows]
+        applied = await access_state.submit(apply_grant_events, foreign) if foreign else 0
+        grants_state["rows_seen"] = first + len(rows) - 1
+        grants_state["own_rows"] = {number for number in own_rows if number > grants_state["rows_seen"]}
+    return applied
+
+# === Сторож event loop ===
+class LoopWatchdog:
+    """Измеряет задержку event loop и ловит код, который его блокирует.
+    
+    Задача в loop раз в LOOP_LAG_INTERVAL обновляет «пульс» и замеряет, насколько позже
+    положенного проснулась. Вспомогательный поток следит за пульсом: если loop молчит дольше
+    LOOP_LAG_THRESHOLD, снимает стек потока loop через sys._current_frames — это и есть виновник.
+    """
+    
+    def __init__(self):
+        self.lags = deque(maxlen=LOOP_LAG_SAMPLES)
+        self.offenders = {}  # {место: {"count", "max_lag", "last_seen", "stack"}}
+        self.stalls = 0
+        self.heartbeat = time.monotonic()
+        self._loop_thread = None
+        self._captured = None  # (пульс, место): место, пойманное в зависании после этого пульса
+        self._stop = threading.Event()
+        self._lock = threading.Lock()  # offenders меняет и поток-наблюдатель
+    
+    async def run(self):
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        thread.start()
+        try:
+            while not shutdown_event.is_set():
+                started = time.monotonic()
+                self.heartbeat = started
+                await asyncio.sleep(LOOP_LAG_INTERVAL)
+                lag = time.monotonic() - started - LOOP_LAG_INTERVAL
+                self.lags.append(lag)
+                if lag >= LOOP_LAG_THRESHOLD:
+                    self._stall_finished(lag, started)
+        finally:
+            self._stop.set()
+    
+    def _stall_finished(self, lag: float, beat: float):
+        self.stalls += 1
+        # Снимок от прошлого зависания (поток мог записать его уже после сброса) не считаем
+        captured = self._captured
+        place = captured[1] if captured and captured[0] == beat else "не поймано (короче интервала проверки)"
+        with self._lock:
+            offender = self.offenders.setdefault(place, {"count": 0, "max_lag": 0.0, "last_seen": None, "stack": []})
+            offender["count"] += 1
+            offender["max_lag"] = max(offender["max_lag"], round(lag, 3))
+            offender["last_seen"] = datetime.now().isoformat(timespec="seconds")
+            # Держим только самых тяжёлых
+            if len(self.offenders) > LOOP_LAG_OFFENDERS:
+                lightest = min(self.offenders, key=lambda key: self.offenders[key]["max_lag"])
+                del self.offenders[lightest]
+        logger.warning("Event loop заблокирован на %.2f с: %s", lag, place, extra={"loop_lag": round(lag, 3)})
+    
+    def _watch(self):
+        """Поток-наблюдатель: снимает стек loop, пока тот ещё висит"""
+        while not self._stop.wait(LOOP_LAG_INTERVAL):
+            beat = self.heartbeat
+            silent = time.monotonic() - beat - LOOP_LAG_INTERVAL
+            if silent < LOOP_LAG_THRESHOLD or (self._captured and self._captured[0] == beat):
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            if self.heartbeat != beat:
+                continue  # loop успел ожить — стек уже не от зависания
+            place = self._place(stack)
+            with self._lock:
+                offender = self.offenders.setdefault(place, {"count": 0, "max_lag": 0.0, "last_seen": None, "stack": []})
+                offender["stack"] = traceback.format_list(stack[-LOOP_LAG_STACK_DEPTH:])
+            self._captured = (beat, place)
+    
+    @staticmethod
+    def _place(stack: traceback.StackSummary) -> str:
+        """Последний кадр нашего кода и самый глубокий кадр: «main.py:812 save_data → encoder.py:258 iterencode»"""
+        leaf = stack[-1]
+        own = next((f for f in reversed(stack) if f.filename == __file__), None)
+        leaf_text = f"{os.path.basename(leaf.filename)}:{leaf.lineno} {leaf.name}"
+        if own is None or own is leaf:
+            return leaf_text
+        return f"{os.path.basename(own.filename)}:{own.lineno} {own.name} → {leaf_text}"
+    
+    def percentiles(self) -> dict:
+        lags = sorted(self.lags)
+        if not lags:
+            return {}
+        pick = lambda q: round(lags[min(len(lags) - 1, int(q * len(lags)))] * 1000, 1)
+        return {"p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": round(lags[-1] * 1000, 1)}
+    
+    def top_offenders(self, limit: int = 5) -> List[tuple]:
+        with self._lock:
+            items = [(place, dict(info)) for place, info in self.offenders.items()]
+        return sorted(items, key=lambda item: item[1]["max_lag"], reverse=True)[:limit]
+    
+    def stats(self) -> dict:
+        return {
+            **self.percentiles(),
+            "samples": len(self.lags),
+            "stalls": self.stalls,
+            "offenders": {place: {k: v for k, v in info.items() if k != "stack"} for place, info in self.top_offenders()},
+        }
+
+loop_watchdog = LoopWatchdog()
 
 # === Загрузка/сохранение данных ===
-def load_data():
-    global paid_files, channel_access
+def parse_channel_access(records: List[list]) -> dict:
+    """Собирает доступы к каналам из 10-го столбца таблицы (старый формат, только для переноса в журнал)"""
+    access = {}
+    for row in records[1:]:  # пропускаем заголовок
+        if len(row) > 9 and row[9]:  # channel_access в 10-м столбце
+            user_id = str(row[0])
+            accesses = row[9].split(';')
+            
+            if user_id not in access:
+                access[user_id] = {}
+            
+            for item in accesses:
+                if ':' in item:
+                    channel_id, expiry_str = item.split(':', 1)
+                    if expiry_str == "forever":
+                        access[user_id][channel_id] = "forever"
+                    else:
+                        try:
+                            access[user_id][channel_id] = datetime.fromisoformat(expiry_str)
+                        except ValueError:
+                            logger.error("Неверный формат даты: %s", expiry_str)
+    return access
+
+def load_local_state():
+    """Загрузка из локальных файлов без обращения к Google Sheets — бот готов к работе сразу"""
+    global paid_files, channel_access, unreachable_users
     # Загрузка оплаченных файлов
     if os.path.exists(USERS_FILE):
         try:
@@ -69,86 +1006,222 @@ def load_data():
                         if expiry_str and expiry_str != "forever":
                             paid_files[user_id][file_id] = datetime.fromisoformat(expiry_str)
         except Exception as e:
-            logger.error(f"Ошибка загрузки файлов оплаты: {e}")
+            logger.error("Ошибка загрузки файлов оплаты: %s", e)
             paid_files = {}
     
-    # Загрузка доступа к каналам из Google Sheets
+    # Доступы к каналам из локальной копии (таблица подтянется в фоне)
     channel_access = {}
-    if ws:
+    if os.path.exists(CHANNEL_ACCESS_FILE):
         try:
-            records = ws.get_all_values()
-            for row in records[1:]:  # пропускаем заголовок
-                if len(row) > 9 and row[9]:  # channel_access в 10-м столбце
-                    user_id = str(row[0])
-                    accesses = row[9].split(';')
-                    
-                    if user_id not in channel_access:
-                        channel_access[user_id] = {}
-                    
-                    for access in accesses:
-                        if ':' in access:
-                            channel_id, expiry_str = access.split(':', 1)
-                            if expiry_str == "forever":
-                                channel_access[user_id][channel_id] = "forever"
-                            else:
-                                try:
-                                    channel_access[user_id][channel_id] = datetime.fromisoformat(expiry_str)
-                                except ValueError:
-                                    logger.error(f"Неверный формат даты: {expiry_str}")
-            
-            logger.info(f"Загружено {sum(len(v) for v in channel_access.values())} доступов к каналам из Google Sheets")
+            with open(CHANNEL_ACCESS_FILE, "r") as f:
+                channel_access = load_local_channel_access(json.load(f))
         except Exception as e:
-            logger.error(f"Ошибка загрузки доступа к каналам из Google Sheets: {e}")
+            logger.error("Ошибка загрузки доступа к каналам из локального файла: %s", e)
     
-    # Дополнительная загрузка из локального файла (для обратной совместимости)
-    if os.path.exists(CHANNEL_ACCESS_FILE):
+    # Загрузка недоступных пользователей (заблокировали бота / удалили аккаунт)
+    if os.path.exists(UNREACHABLE_FILE):
         try:
-            with open(CHANNEL_ACCESS_FILE, "r") as f:
-                local_access = json.load(f)
-                for user_id, channels in local_access.items():
-                    if user_id not in channel_access:
-                        channel_access[user_id] = {}
-                    
-                    for channel_id, expiry_str in channels.items():
-                        if expiry_str != "forever":
-                            channel_access[user_id][channel_id] = datetime.fromisoformat(expiry_str)
-                        else:
-                            channel_access[user_id][channel_id] = "forever"
+            with open(UNREACHABLE_FILE, "r") as f:
+                unreachable_users = json.load(f)
+            logger.info("Загружено %s недоступных пользователей", len(unreachable_users))
         except Exception as e:
-            logger.error(f"Ошибка загрузки доступа к каналам из локального файла: {e}")
+            logger.error("Ошибка загрузки недоступных пользователей: %s", e)
+            unreachable_users = {}
+    
+    # Снимок пользователей и постов с прошлого запуска
+    if os.path.exists(STATE_SNAPSHOT_FILE):
+        try:
+            with open(STATE_SNAPSHOT_FILE, "r") as f:
+                snapshot = json.load(f)
+            known_users.update(snapshot.get("users", []))
+            posts_cache["posts"] = snapshot.get("posts", [])
+            post_index.update(snapshot.get("post_index", {}))
+            grants_state["backlog"] = snapshot.get("grant_backlog", [])
+            pending_registrations.update(snapshot.get("pending_registrations", {}))
+            logger.info(
+                "Снимок состояния: %s пользователей, %s постов (сохранён %s)",
+                len(known_users), len(posts_cache["posts"]), snapshot.get("saved_at")
+            )
+        except Exception as e:
+            logger.error("Ошибка загрузки снимка состояния: %s", e)
+    
+    logger.info("Загружено %s доступов к каналам из локальной копии", sum(len(v) for v in channel_access.values()))
+    
+    load_payment_rollups()
+    load_file_catalog()
+    load_channel_info()
+    
+    if os.path.exists(RECONCILE_STATE_FILE):
+        try:
+            with open(RECONCILE_STATE_FILE, "r") as f:
+                reconcile_state.update(json.load(f))
+        except Exception as e:
+            logger.error("Ошибка загрузки состояния сверки: %s", e)
+    
+    seen_updates.load()
+    outbox.load()
 
-async def reload_channel_access():
-    """Принудительно перезагружает доступы из Google Sheets"""
-    global channel_access
-    channel_access = {}
+def load_local_channel_access(local_access: dict) -> dict:
+    access = {}
+    for user_id, channels in local_access.items():
+        access[user_id] = {}
+        for channel_id, expiry_str in channels.items():
+            if expiry_str != "forever":
+                access[user_id][channel_id] = datetime.fromisoformat(expiry_str)
+            else:
+                access[user_id][channel_id] = "forever"
+    return access
+
+def connect_sheets():
+    """Подключение к Google Sheets. Тяжёлые импорты Google auth — только здесь"""
+    import gspread
+    from google.oauth2.service_account import Credentials
     
-    if ws:
+    creds = Credentials.from_service_account_file(SHEETS_CREDENTIALS_FILE, scopes=[
+        "https://www.googleapis.com/auth/spreadsheets"
+    ])
+    gc = gspread.authorize(creds)
+    sh = gc.open_by_key(GSHEET_ID)
+    return sh.sheet1
+
+async def connect_and_reconcile():
+    """Фоновое подключение к Google Sheets и сверка локального состояния с таблицей.
+    Повторяет, пока не получится: до сверки регистрации копятся в pending_registrations
+    """
+    attempt = 0
+    while not sheets_reconciled.is_set():
         try:
-            records = ws.get_all_values()
-            for row in records[1:]:  # пропускаем заголовок
-                if len(row) > 9 and row[9]:  # channel_access в 10-м столбце
-                    user_id = str(row[0])
-                    accesses = row[9].split(';')
-                    
-                    if user_id not in channel_access:
-                        channel_access[user_id] = {}
-                    
-                    for access in accesses:
-                        if ':' in access:
-                            channel_id, expiry_str = access.split(':', 1)
-                            if expiry_str == "forever":
-                                channel_access[user_id][channel_id] = "forever"
-                            else:
-                                try:
-                                    channel_access[user_id][channel_id] = datetime.fromisoformat(expiry_str)
-                                except ValueError:
-                                    logger.error(f"Неверный формат даты: {expiry_str}")
-            
-            logger.info(f"✅ Перезагружено {sum(len(v) for v in channel_access.values())} доступов из Google Sheets")
+            if not sheets.ready:
+                worksheet = await asyncio.to_thread(connect_sheets)
+                sheets.grants_worksheet = await asyncio.to_thread(connect_grants_sheet, worksheet)
+                sheets.worksheet = worksheet
+                logger.info("Успешное подключение к Google Sheets!")
+            if await reconcile_with_sheets():
+                sheets_reconciled.set()
+                boot_stats["sheets_reconciled_after"] = round(time.monotonic() - boot_stats["started"], 3)
+                logger.info("Сверка с Google Sheets завершена через %s с после старта", boot_stats['sheets_reconciled_after'])
+                return
         except Exception as e:
-            logger.error(f"❌ Ошибка перезагрузки доступов: {e}")
+            logger.error("Ошибка Google Sheets: %s", e)
+        
+        delay = min(SHEETS_BACKOFF_CAP, SHEETS_BACKOFF_BASE * 2 ** attempt)
+        attempt += 1
+        logger.warning("Google Sheets: повтор подключения и сверки через %.1f с (попытка %s)", delay, attempt + 1)
+        if await sleep_or_shutdown(delay):
+            return
+
+async def reconcile_with_sheets() -> bool:
+    """Два чтения: основной лист (пользователи и посты) и журнал доступов"""
+    try:
+        async with grants_lock:
+            records = await sheets.read("get_all_values", priority=PRIORITY_ADMIN)
+            grant_rows = await sheets.read("get_all_values", priority=PRIORITY_ADMIN, grants=True)
+            grants_state["rows_seen"] = len(grant_rows)
+            grants_state["own_rows"].clear()
+    except Exception as e:
+        logger.error("Ошибка загрузки доступа к каналам из Google Sheets: %s", e)
+        return False
+    
+    sheet_access = {}
+    events = fold_grant_events(grant_rows, sheet_access)
+    if not events:
+        # Журнал пуст — однократно переносим доступы из 10-го столбца основного листа
+        sheet_access = parse_channel_access(records)
+        migrated = [
+            grant_event(user_id, channel_id, expiry, "migration")
+            for user_id, channels in sheet_access.items()
+            for channel_id, expiry in channels.items()
+        ]
+        if migrated:
+            logger.info("Перенесено в журнал доступов: %s записей из столбца channel_access", len(migrated))
+    else:
+        migrated = []
+    # Заодно отправляем события, накопленные до подключения к таблице
+    await append_grant_events(migrated, PRIORITY_ADMIN)
+    logger.info(
+        "Загружено %s доступов к каналам из Google Sheets (%s событий журнала)",
+        sum(len(v) for v in sheet_access.values()), events
+    )
+    
+    # Локальная копия дополняет журнал: выдачи, не дошедшие до таблицы
+    await access_state.submit(merge_sheet_access, sheet_access)
+    
+    known_users.update(str(row[0]).strip() for row in records[1:] if row and str(row[0]).strip())
+    apply_post_rows(records)
+    
+    # Регистрируем тех, кто успел написать боту до подключения к таблице
+    for user_id, username in list(pending_registrations.items()):
+        if user_id not in known_users:
+            try:
+                await append_user_row(user_id, username)
+            except Exception as e:
+                logger.error("Ошибка регистрации пользователя: %s", e)
+                continue
+        pending_registrations.pop(user_id, None)
+    
+    save_data()
+    return True
+
+async def reload_channel_access():
+    """Дочитывает новые события журнала доступов из Google Sheets"""
+    if not sheets.grants_ready or not sheets_reconciled.is_set():
+        return
+    
+    try:
+        # Сначала отправляем отложенные события, чтобы не перечитать их как чужие
+        await append_grant_events([], PRIORITY_SWEEP)
+        applied = await read_grant_events(PRIORITY_SWEEP)
+        logger.info("✅ Из журнала применено %s новых событий, доступов: %s", applied, sum(len(v) for v in channel_access.values()))
+    except Exception as e:
+        logger.error("❌ Ошибка перезагрузки доступов: %s", e)
+
+state_write_lock = threading.Lock()  # файлы состояния пишет и loop, и поток отложенной записи
+
+def snapshot_payload() -> dict:
+    """Снимок пользователей и постов — копии, которые можно сериализовать в потоке"""
+    return {
+        "saved_at": datetime.now().isoformat(),
+        "users": sorted(known_users),
+        "posts": list(posts_cache["posts"]),
+        "post_index": {**post_index, "rows": dict(post_index["rows"])},
+        "grant_backlog": list(grants_state["backlog"]),
+        "pending_registrations": dict(pending_registrations),
+    }
+
+def write_snapshot(snapshot: dict):
+    """Атомарно сохраняет снимок пользователей и постов для быстрого старта"""
+    try:
+        with state_write_lock:
+            tmp_path = f"{STATE_SNAPSHOT_FILE}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, STATE_SNAPSHOT_FILE)
+    except Exception as e:
+        logger.error("Ошибка сохранения снимка состояния: %s", e)
+
+def save_snapshot():
+    write_snapshot(snapshot_payload())
+
+def state_payload() -> tuple:
+    """Состояние для write_state. Опубликованные словари доступов не меняются на месте — их не копируем"""
+    return paid_files, channel_access, dict(unreachable_users), snapshot_payload()
 
 def save_data():
+    write_state(*state_payload())
+
+def write_json_atomic(path: str, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def write_state(paid_files: dict, channel_access: dict, unreachable_users: dict, snapshot: dict):
+    """Пишет файлы состояния. Аргументы никто не меняет, поэтому можно вызывать из потока"""
+    with state_write_lock:
+        write_state_files(paid_files, channel_access, unreachable_users)
+    write_snapshot(snapshot)
+
+def write_state_files(paid_files: dict, channel_access: dict, unreachable_users: dict):
     # Сохранение оплаченных файлов
     try:
         save_files = {}
@@ -157,10 +1230,9 @@ def save_data():
             for file_id, expiry in files.items():
                 save_files[user_id][file_id] = expiry.isoformat() if isinstance(expiry, datetime) else expiry
         
-        with open(USERS_FILE, "w") as f:
-            json.dump(save_files, f)
+        write_json_atomic(USERS_FILE, save_files)
     except Exception as e:
-        logger.error(f"Ошибка сохранения файлов оплаты: {e}")
+        logger.error("Ошибка сохранения файлов оплаты: %s", e)
     
     # Сохранение доступа к каналам в локальный файл (оставляем для резервной копии)
     try:
@@ -170,156 +1242,779 @@ def save_data():
             for channel_id, expiry in channels.items():
                 save_access[user_id][channel_id] = expiry.isoformat() if isinstance(expiry, datetime) else expiry
         
-        with open(CHANNEL_ACCESS_FILE, "w") as f:
-            json.dump(save_access, f)
+        write_json_atomic(CHANNEL_ACCESS_FILE, save_access)
+    except Exception as e:
+        logger.error("Ошибка сохранения доступа к каналам: %s", e)
+    
+    # Сохранение флагов недоступности пользователей
+    try:
+        write_json_atomic(UNREACHABLE_FILE, unreachable_users)
+    except Exception as e:
+        logger.error("Ошибка сохранения недоступных пользователей: %s", e)
+
+# === Учёт недоступных пользователей ===
+def is_unreachable_error(error: Exception) -> bool:
+    """Ошибка означает, что пользователь заблокировал бота или удалил аккаунт"""
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    if isinstance(error, TelegramBadRequest):
+        text = str(error).lower()
+        return "chat not found" in text or "user is deactivated" in text
+    return False
+
+def mark_unreachable(user_id, error: Exception):
+    """Помечает пользователя недоступным, чтобы не тратить на него запросы к API"""
+    unreachable_users[str(user_id)] = {
+        "reason": type(error).__name__,
+        "since": datetime.now().isoformat()
+    }
+    logger.info("🚫 [НЕДОСТУПЕН] Пользователь %s: %s", user_id, error, extra=SAMPLED)
+
+def mark_reachable(user_id) -> bool:
+    """Снимает флаг недоступности. Возвращает True, если флаг был"""
+    return unreachable_users.pop(str(user_id), None) is not None
+
+# === Очередь важных сообщений (outbox) ===
+class Outbox:
+    """Сообщения, которые нельзя потерять: подтверждения оплаты, ссылки-приглашения, уведомления об истечении.
+    
+    put() сначала дописывает сообщение в журнал OUTBOX_FILE и только потом ставит в очередь;
+    доставляет задача run(): общий лимит частоты, не чаще раза в OUTBOX_CHAT_INTERVAL на чат,
+    несколько ожидающих сообщений одному чату склеиваются в одно. Сообщение с file_id — это файл
+    с подписью text, он уходит отдельно. Сетевые ошибки и 5xx повторяются
+    с экспоненциальной задержкой, 429 — через указанный Telegram retry_after.
+    Доставка «хотя бы один раз»: если процесс упал между отправкой и отметкой в журнале, сообщение уйдёт повторно.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.messages = {}  # id -> {"id", "chat_id", "text", "created", "attempts"[, "file_id"]}
+        self.chats = {}  # chat_id -> [id] в порядке постановки
+        self.schedule = []  # heap: (когда можно отправлять, seq, chat_id)
+        self.scheduled = set()  # чаты, у которых есть запись в schedule
+        self.in_flight = set()  # чаты, которым сейчас идёт отправка
+        self.bucket = TokenBucket(OUTBOX_MESSAGES_PER_MINUTE, capacity=OUTBOX_CONCURRENCY)
+        self.slots = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        self.wake = asyncio.Event()
+        self.metrics = Counter()
+        self.latencies = deque(maxlen=1000)  # от постановки до доставки, с
+        self.done_records = 0
+        self._seq = itertools.count()
+        self._ids = itertools.count(1)
+        self._file = None
+    
+    # Журнал: {"op": "add", "msg": {...}} и {"op": "done", "id": ...}
+    def _journal(self, entry: dict):
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a", buffering=1, encoding="utf-8")
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logger.error("Ошибка записи в журнал исходящих сообщений: %s", e)
+    
+    def load(self):
+        """Недоставленные сообщения с прошлого запуска; журнал переписывается без доставленных"""
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        entry = json.loads(line)
+                        if entry["op"] == "add":
+                            self.messages[entry["msg"]["id"]] = entry["msg"]
+                        else:
+                            self.messages.pop(entry["id"], None)
+            except Exception as e:
+                logger.error("Ошибка загрузки журнала исходящих сообщений: %s", e)
+        
+        for message in sorted(self.messages.values(), key=lambda m: m["created"]):
+            self.chats.setdefault(message["chat_id"], []).append(message["id"])
+        for chat_id in self.chats:
+            self._schedule(chat_id, time.monotonic())
+        self.compact()
+        if self.messages:
+            logger.info("📮 Недоставленных сообщений с прошлого запуска: %s", len(self.messages))
+    
+    def compact(self):
+        try:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for message in self.messages.values():
+                    f.write(json.dumps({"op": "add", "msg": message}, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
+            self.done_records = 0
+        except Exception as e:
+            logger.error("Ошибка уплотнения журнала исходящих сообщений: %s", e)
+    
+    def put(self, chat_id, text: str, file_id: Optional[str] = None) -> str:
+        """Ставит сообщение (или файл с подписью text) в очередь. Сразу на диск — после этого оно не потеряется при сбое"""
+        message = {
+            "id": f"{int(time.time() * 1000):x}-{next(self._ids)}",
+            "chat_id": int(chat_id),
+            "text": text,
+            "created": time.time(),
+            "attempts": 0,
+        }
+        if file_id:
+            message["file_id"] = file_id
+        self._journal({"op": "add", "msg": message})
+        self.messages[message["id"]] = message
+        self.chats.setdefault(message["chat_id"], []).append(message["id"])
+        self._schedule(message["chat_id"], time.monotonic())
+        return message["id"]
+    
+    def _schedule(self, chat_id: int, when: float):
+        if chat_id in self.scheduled or chat_id in self.in_flight:
+            return
+        self.scheduled.add(chat_id)
+        heapq.heappush(self.schedule, (when, next(self._seq), chat_id))
+        self.wake.set()
+    
+    def _batch(self, chat_id: int) -> List[dict]:
+        """Первые сообщения чата, которые помещаются в одно сообщение Telegram.
+        Файлы и сообщения из отклонённой склейки (solo) отправляются по одному.
+        """
+        batch, length = [], 0
+        for message_id in self.chats[chat_id]:
+            message = self.messages[message_id]
+            solo = message.get("solo") or message.get("file_id")
+            length += len(message["text"]) + (2 if batch else 0)
+            if batch and (length > MESSAGE_MAX_LENGTH or solo):
+                break
+            batch.append(message)
+            if solo:
+                break
+        return batch
+    
+    def _finish(self, chat_id: int, batch: List[dict], outcome: str):
+        now = time.time()
+        done = {message["id"] for message in batch}
+        self.chats[chat_id] = [message_id for message_id in self.chats[chat_id] if message_id not in done]
+        if not self.chats[chat_id]:
+            del self.chats[chat_id]
+        for message in batch:
+            del self.messages[message["id"]]
+            self._journal({"op": "done", "id": message["id"]})
+            if outcome == "delivered":
+                self.latencies.append(now - message["created"])
+        self.metrics[outcome] += len(batch)
+        if outcome == "delivered" and len(batch) > 1:
+            self.metrics["coalesced"] += len(batch) - 1
+        self.done_records += len(batch)
+        if self.done_records >= OUTBOX_COMPACT_AFTER:
+            self.compact()
+    
+    async def _deliver(self, chat_id: int):
+        delay = OUTBOX_CHAT_INTERVAL
+        try:
+            batch = self._batch(chat_id)
+            text = "\n\n".join(message["text"] for message in batch)
+            try:
+                if batch[0].get("file_id"):
+                    await send_file(chat_id, batch[0]["file_id"], text)
+                else:
+                    await bot.send_message(chat_id, text)
+            except TelegramRetryAfter as e:
+                self.metrics["rate_limited"] += 1
+                self.bucket.drain()
+                delay = max(delay, e.retry_after)
+            except Exception as e:
+                if is_unreachable_error(e):
+                    mark_unreachable(chat_id, e)
+                    self._finish(chat_id, batch, "undeliverable")
+                elif isinstance(e, TelegramBadRequest) and len(batch) > 1:
+                    # Одно битое сообщение не должно утянуть за собой остальные — разбираем склейку
+                    logger.warning("📮 Telegram отклонил склейку из %s сообщений для %s, отправляем по одному: %s", len(batch), chat_id, e)
+                    for message in batch:
+                        message["solo"] = True
+                    self.metrics["split"] += 1
+                elif isinstance(e, TelegramBadRequest):
+                    logger.error("📮 Telegram отклонил сообщение для %s: %s", chat_id, e)
+                    self._finish(chat_id, batch, "rejected")
+                    if batch[0].get("file_id"):
+                        self.put(chat_id, "❌ Не удалось отправить файл. Свяжитесь с администратором.")
+                        self.put(
+                            ADMIN_ID,
+                            f"🚨 Telegram отклонил файл {html.escape(batch[0]['file_id'])} для пользователя {chat_id}: "
+                            f"{html.escape(str(e)[:200])}"
+                        )
+                else:
+                    attempts = max(message["attempts"] for message in batch) + 1
+                    for message in batch:
+                        message["attempts"] = attempts
+                    if attempts >= OUTBOX_MAX_ATTEMPTS:
+                        logger.error("📮 Сообщение для %s не доставлено за %s попыток: %s", chat_id, attempts, e)
+                        self._finish(chat_id, batch, "dead")
+                        if chat_id != ADMIN_ID:
+                            self.put(
+                                ADMIN_ID,
+                                f"🚨 Не удалось доставить сообщение пользователю {chat_id} после {attempts} попыток "
+                                f"({html.escape(str(e)[:200])}):\n\n{html.escape(text[:OUTBOX_ALERT_TEXT_LIMIT])}"
+                            )
+                    else:
+                        self.metrics["retries"] += 1
+                        delay = random.uniform(0, min(OUTBOX_BACKOFF_CAP, OUTBOX_BACKOFF_BASE * 2 ** attempts))
+                        logger.warning("📮 Ошибка отправки %s, повтор %s через %.1f с: %s", chat_id, attempts, delay, e)
+            else:
+                self._finish(chat_id, batch, "delivered")
+        except Exception as e:
+            logger.error("📮 Ошибка очереди сообщений для %s: %s", chat_id, e, exc_info=True)
+        finally:
+            self.in_flight.discard(chat_id)
+            self.slots.release()
+            if self.chats.get(chat_id):
+                self._schedule(chat_id, time.monotonic() + delay)
+    
+    async def _wait(self, timeout: Optional[float]):
+        """Ждёт новое сообщение, наступление срока или остановку"""
+        self.wake.clear()
+        waiters = [asyncio.ensure_future(self.wake.wait()), asyncio.ensure_future(shutdown_event.wait())]
+        try:
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+    
+    async def run(self):
+        """Доставка. При остановке новые отправки не начинаются: очередь уже на диске"""
+        while not shutdown_event.is_set():
+            if not self.schedule:
+                await self._wait(None)
+                continue
+            when, _, chat_id = self.schedule[0]
+            if when > time.monotonic():
+                await self._wait(when - time.monotonic())
+                continue
+            heapq.heappop(self.schedule)
+            self.scheduled.discard(chat_id)
+            if not self.chats.get(chat_id):
+                continue
+            await self.slots.acquire()
+            await self.bucket.acquire()
+            self.in_flight.add(chat_id)
+            spawn_background(self._deliver(chat_id), "outbox_send")
+    
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        pick = lambda q: round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 1) if latencies else 0.0
+        oldest = min((message["created"] for message in self.messages.values()), default=None)
+        return {
+            "pending": len(self.messages),
+            "chats": len(self.chats),
+            "oldest_pending_s": round(time.time() - oldest, 1) if oldest else 0.0,
+            **dict(self.metrics),
+            "latency_p50_ms": pick(0.5),
+            "latency_p95_ms": pick(0.95),
+            "latency_max_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+        }
+
+outbox = Outbox(OUTBOX_FILE)
+
+# === Журнал платежей и агрегаты по выручке ===
+def empty_rollups() -> dict:
+    return {
+        "total": {"count": 0, "amount": 0.0},
+        "by_day": {},     # {"2024-05-01": {...}}
+        "by_target": {},  # {"channel:-100...": {...}, "file:<file_id>": {...}}
+        "by_period": {},  # {"30": {...}, "0": {...} (навсегда), "file": {...}}
+        "orders": {},     # {ключ заказа: дата} — уже учтённые платежи, повторы вебхука пропускаем
+    }
+
+def parse_amount(value) -> float:
+    try:
+        return float(str(value).replace(",", ".").strip())
+    except (TypeError, ValueError):
+        return 0.0
+
+def payment_order_key(data: dict) -> str:
+    """Ключ оплаты для отсева повторных вебхуков: номер заказа в платёжной системе (order_id).
+    
+    order_num — наш номер из ссылки (channel_<user>_<канал>_<дни>), он одинаков у всех оплат по одной
+    ссылке, поэтому в ключ не входит. Если вместо своего номера платёжная система вернула наш,
+    ключа нет — такие вебхуки не отсеиваем, иначе продление по той же ссылке потерялось бы.
+    """
+    order_id = str(data.get("order_id") or "").strip()
+    if not order_id or order_id == str(data.get("order_num") or "").strip() or order_id.startswith(("channel_", "file_")):
+        return ""
+    return order_id
+
+def payment_recorded(order_key: str) -> bool:
+    return bool(order_key) and order_key in payment_rollups.get("orders", {})
+
+def apply_payment_to_rollups(rollups: dict, entry: dict):
+    """Инкрементально добавляет платёж во все агрегаты"""
+    buckets = [
+        rollups["total"],
+        rollups["by_day"].setdefault(entry["ts"][:10], {"count": 0, "amount": 0.0}),
+        rollups["by_target"].setdefault(f"{entry['type']}:{entry['target_id']}", {"count": 0, "amount": 0.0}),
+        rollups["by_period"].setdefault(
+            "file" if entry["type"] == "file" else str(entry["days"]), {"count": 0, "amount": 0.0}
+        ),
+    ]
+    for bucket in buckets:
+        bucket["count"] += 1
+        bucket["amount"] = round(bucket["amount"] + entry["amount"], 2)
+    if entry.get("order_key"):
+        rollups.setdefault("orders", {})[entry["order_key"]] = entry["ts"][:10]
+
+def load_payment_rollups():
+    """Загружает агрегаты; если их нет — один раз пересчитывает по журналу"""
+    global payment_rollups
+    if os.path.exists(PAYMENTS_ROLLUPS_FILE):
+        try:
+            with open(PAYMENTS_ROLLUPS_FILE, "r") as f:
+                payment_rollups = json.load(f)
+            payment_rollups.setdefault("orders", {})  # файл агрегатов старого формата
+            return
+        except Exception as e:
+            logger.error("Ошибка загрузки агрегатов платежей: %s", e)
+    
+    payment_rollups = empty_rollups()
+    if os.path.exists(PAYMENTS_LEDGER_FILE):
+        with open(PAYMENTS_LEDGER_FILE, "r") as f:
+            for line in f:
+                if line.strip():
+                    apply_payment_to_rollups(payment_rollups, json.loads(line))
+        save_payment_rollups()
+        logger.info("Агрегаты платежей пересчитаны по журналу: %s платежей", payment_rollups["total"]["count"])
+
+def save_payment_rollups():
+    try:
+        tmp_path = f"{PAYMENTS_ROLLUPS_FILE}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(payment_rollups, f)
+        os.replace(tmp_path, PAYMENTS_ROLLUPS_FILE)
     except Exception as e:
-        logger.error(f"Ошибка сохранения доступа к каналам: {e}")
+        logger.error("Ошибка сохранения агрегатов платежей: %s", e)
+
+def record_payment(payment_type: str, user_id: str, target_id: str, days: Optional[int], data: dict, order_key: str):
+    """Дописывает выданный платёж в журнал (только добавление), обновляет агрегаты и отмечает заказ учтённым"""
+    if not payment_rollups:
+        payment_rollups.update(empty_rollups())
+    
+    entry = {
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "type": payment_type,
+        "user_id": str(user_id),
+        "target_id": target_id,
+        "days": days,
+        "amount": parse_amount(data.get("amount") or data.get("sum")),
+        "order_id": data.get("order_id", ""),
+        "order_key": order_key,
+    }
+    try:
+        with open(PAYMENTS_LEDGER_FILE, "a") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    except Exception as e:
+        # Агрегаты не трогаем: иначе они разойдутся с журналом и пересчёт по журналу их не восстановит.
+        # Заказ всё же помечаем учтённым, чтобы повтор вебхука не выдал доступ второй раз
+        logger.error("Ошибка записи в журнал платежей: %s", e)
+        if order_key:
+            payment_rollups["orders"][order_key] = entry["ts"][:10]
+            save_payment_rollups()
+        return
+    
+    apply_payment_to_rollups(payment_rollups, entry)
+    save_payment_rollups()
+
+# === Каталог файлов ===
+FILE_KIND_NAMES = {"document": "документ", "photo": "фото", "video": "видео", "audio": "аудио"}
+
+def load_file_catalog():
+    """Каталог файлов с диска и обратный индекс file_id → короткий id"""
+    if not os.path.exists(FILE_CATALOG_FILE):
+        return
+    try:
+        with open(FILE_CATALOG_FILE, "r") as f:
+            file_catalog.update(json.load(f))
+        file_short_ids.clear()
+        file_short_ids.update({entry["file_id"]: short_id for short_id, entry in file_catalog["files"].items()})
+        logger.info("Каталог файлов: %s файлов", len(file_catalog["files"]))
+    except Exception as e:
+        logger.error("Ошибка загрузки каталога файлов: %s", e)
+
+def save_file_catalog():
+    try:
+        tmp_path = f"{FILE_CATALOG_FILE}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(file_catalog, f, ensure_ascii=False)
+        os.replace(tmp_path, FILE_CATALOG_FILE)
+    except Exception as e:
+        logger.error("Ошибка сохранения каталога файлов: %s", e)
+
+def register_file(file_id: str, kind: str, size: Optional[int] = None, name: Optional[str] = None) -> str:
+    """Возвращает постоянный короткий id файла, при необходимости добавляя его в каталог"""
+    short_id = file_short_ids.get(file_id)
+    if short_id:
+        return short_id
+    
+    # Префикс «f» не пересекается с числовыми id старых кнопок на hash()
+    short_id = f"f{file_catalog['next_id']}"
+    file_catalog["next_id"] += 1
+    file_catalog["files"][short_id] = {
+        "file_id": file_id,
+        "kind": kind,
+        "size": size,
+        "name": name,
+        "added": datetime.now().isoformat(),
+    }
+    file_short_ids[file_id] = short_id
+    save_file_catalog()
+    return short_id
+
+def catalog_file(short_id: str) -> Optional[dict]:
+    return file_catalog["files"].get(short_id)
+
+def message_file(message: Message) -> Optional[tuple]:
+    """(file_id, kind, size, name) вложения сообщения"""
+    if message.document:
+        doc = message.document
+        return doc.file_id, "document", doc.file_size, doc.file_name
+    if message.photo:
+        photo = message.photo[-1]
+        return photo.file_id, "photo", photo.file_size, None
+    if message.video:
+        video = message.video
+        return video.file_id, "video", video.file_size, video.file_name
+    if message.audio:
+        audio = message.audio
+        return audio.file_id, "audio", audio.file_size, audio.file_name
+    return None
 
 # === Универсальная функция отправки файла ===
+async def send_file(chat_id: int, file_id: str, caption: str):
+    """Отправка файла любого типа: тип из каталога первым, без него — документ, фото, видео, аудио по очереди.
+    
+    TelegramBadRequest (file_id другого типа) — пробуем следующий тип; остальные ошибки
+    (сеть, 429, 5xx) пробрасываются сразу, чтобы вызывающий мог повторить.
+    """
+    kinds = ["document", "photo", "video", "audio"]
+    entry = catalog_file(file_short_ids.get(file_id, ""))
+    if entry and entry.get("kind") in kinds:
+        kinds.remove(entry["kind"])
+        kinds.insert(0, entry["kind"])
+    
+    errors = []
+    for kind in kinds:
+        try:
+            await getattr(bot, f"send_{kind}")(chat_id, file_id, caption=caption)
+            logger.info("Файл отправлен как %s: %s", FILE_KIND_NAMES[kind], file_id, extra=SAMPLED)
+            return
+        except TelegramBadRequest as e:
+            errors.append(e)
+    logger.error("Не удалось отправить файл %s: %s", file_id, ", ".join(str(e) for e in errors))
+    raise errors[-1]
+
+@traced("send_file_to_user", "user_id", "file_id")
 async def send_file_to_user(user_id: int, file_id: str, caption: str = "Ваш файл"):
-    """Универсальная функция отправки файла любого типа"""
+    """Отправка файла сразу, в ответ на нажатие; при ошибке — сообщение пользователю через очередь"""
+    try:
+        await send_file(user_id, file_id, caption)
+    except Exception as e:
+        logger.error("Ошибка отправки файла %s пользователю %s: %s", file_id, user_id, e)
+        outbox.put(user_id, "❌ Не удалось отправить файл. Свяжитесь с администратором.")
+
+# === Метаданные каналов ===
+def load_channel_info():
+    if os.path.exists(CHANNEL_INFO_FILE):
+        try:
+            with open(CHANNEL_INFO_FILE, "r") as f:
+                channel_info.update(json.load(f))
+        except Exception as e:
+            logger.error("Ошибка загрузки метаданных каналов: %s", e)
+    rebuild_channel_index()
+
+def save_channel_info():
     try:
-        await bot.send_document(user_id, file_id, caption=caption)
-        logger.info(f"Файл отправлен как документ: {file_id}")
-    except Exception as doc_error:
+        tmp_path = f"{CHANNEL_INFO_FILE}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(channel_info, f, ensure_ascii=False)
+        os.replace(tmp_path, CHANNEL_INFO_FILE)
+    except Exception as e:
+        logger.error("Ошибка сохранения метаданных каналов: %s", e)
+
+def rebuild_channel_index():
+    """Обратный индекс: имя из CHANNELS или название канала (без учёта регистра) → ID"""
+    channel_ids_by_name.clear()
+    for channel_id, info in channel_info.items():
+        if info.get("title"):
+            channel_ids_by_name[info["title"].lower()] = channel_id
+    for name, channel_id in CHANNELS.items():
+        channel_ids_by_name[name.lower()] = channel_id
+
+def channel_title(channel_id: str) -> str:
+    """Название канала для сообщений пользователю — только из кэша, без запросов к API"""
+    info = channel_info.get(channel_id)
+    if info and info.get("title"):
+        return info["title"]
+    return CHANNEL_NAMES.get(channel_id, channel_id)
+
+@traced("refresh_channel_info", "force")
+async def refresh_channel_info(force: bool = False) -> int:
+    """Обновляет устаревшие записи кэша через get_chat. Возвращает число обновлённых каналов"""
+    channel_ids = set(CHANNELS.values())
+    for channels in channel_access.values():
+        channel_ids.update(channels)
+    
+    now = time.time()
+    refreshed = 0
+    for channel_id in sorted(channel_ids):
+        info = channel_info.get(channel_id)
+        if not force and info and now - info.get("fetched_at", 0) < CHANNEL_INFO_TTL:
+            continue
         try:
-            await bot.send_photo(user_id, file_id, caption=caption)
-            logger.info(f"Файл отправлен как фото: {file_id}")
-        except Exception as photo_error:
-            try:
-                await bot.send_video(user_id, file_id, caption=caption)
-                logger.info(f"Файл отправлен как видео: {file_id}")
-            except Exception as video_error:
-                try:
-                    await bot.send_audio(user_id, file_id, caption=caption)
-                    logger.info(f"Файл отправлен как аудио: {file_id}")
-                except Exception as audio_error:
-                    logger.error(f"Не удалось отправить файл {file_id}: {doc_error}, {photo_error}, {video_error}, {audio_error}")
-                    await bot.send_message(user_id, "❌ Не удалось отправить файл. Свяжитесь с администратором.")
+            chat = await bot.get_chat(int(channel_id))
+            member_count = await bot.get_chat_member_count(int(channel_id))
+        except Exception as e:
+            logger.warning("Не удалось получить данные канала %s: %s", channel_id, e)
+            continue
+        channel_info[channel_id] = {
+            "title": chat.title,
+            "username": chat.username,
+            "invite_link": chat.invite_link,
+            "join_by_request": bool(chat.join_by_request),
+            "member_count": member_count,
+            "fetched_at": now,
+        }
+        refreshed += 1
+    
+    if refreshed:
+        rebuild_channel_index()
+        save_channel_info()
+        logger.info("Обновлены метаданные %s каналов", refreshed)
+    return refreshed
 
 # === Проверка и удаление просроченных доступов ===
+@traced("check_expired_access")
 async def check_expired_access():
     # ПЕРЕЗАГРУЖАЕМ ДАННЫЕ ПЕРЕД КАЖДОЙ ПРОВеркой
     await reload_channel_access()
     
     now = datetime.now()
-    logger.info(f"🔍 [ПРОВЕРКА] Начало проверки в {now}")
-    logger.info(f"🔍 [ДАННЫЕ] Загружено доступов: {len(channel_access)}")
+    # Опубликованный снимок не меняется на месте — его можно обходить через await
+    files_snapshot, access_snapshot = paid_files, channel_access
+    logger.info("🔍 [ПРОВЕРКА] Начало проверки в %s", now)
+    logger.info("🔍 [ДАННЫЕ] Загружено доступов: %s", len(access_snapshot))
     
     # Проверка файлов
     expired_files = []
-    for user_id, files in paid_files.items():
+    for user_id, files in files_snapshot.items():
         for file_id, expiry in files.items():
             if isinstance(expiry, datetime) and now >= expiry:
-                expired_files.append((user_id, file_id))
-                logger.info(f"📁 [ПРОСРОЧКА] Файл {file_id} у пользователя {user_id}")
+                expired_files.append((user_id, file_id, expiry))
+                logger.info("📁 [ПРОСРОЧКА] Файл %s у пользователя %s", file_id, user_id, extra=SAMPLED)
     
-    for user_id, file_id in expired_files:
-        try:
-            del paid_files[user_id][file_id]
-            if not paid_files[user_id]:
-                del paid_files[user_id]
-            logger.info(f"✅ [УДАЛЕНО] Файл {file_id} у пользователя {user_id}")
-        except Exception as e:
-            logger.error(f"Ошибка при удалении доступа к файлу: {e}")
+    for user_id, file_id, expiry in expired_files:
+        if await access_state.submit(revoke_access, "files", user_id, file_id, expiry):
+            logger.info("✅ [УДАЛЕНО] Файл %s у пользователя %s", file_id, user_id, extra=SAMPLED)
     
     # Проверка доступа к каналам
     expired_channels = []
-    for user_id, channels in channel_access.items():
+    forever_count = 0
+    for user_id, channels in access_snapshot.items():
         for channel_id, expiry in channels.items():
             if isinstance(expiry, datetime) and now >= expiry:
-                expired_channels.append((user_id, channel_id))
-                logger.info(f"📢 [ПРОСРОЧКА] Канал {channel_id} у пользователя {user_id}")
+                expired_channels.append((user_id, channel_id, expiry))
+                logger.info("📢 [ПРОСРОЧКА] Канал %s у пользователя %s", channel_id, user_id, extra=SAMPLED)
             elif expiry == "forever":
-                logger.info(f"✅ [БЕССРОЧНЫЙ] Канал {channel_id} у пользователя {user_id}")
+                forever_count += 1
+    logger.info("✅ [БЕССРОЧНЫЙ] Бессрочных доступов: %s", forever_count, extra={"forever_count": forever_count})
+    
+    # Просроченные доступы снимаем параллельно: кик с паузой и уведомление не ждут друг друга
+    semaphore = asyncio.Semaphore(SWEEP_CONCURRENCY)
+    
+    async def expire(user_id: str, channel_id: str, expiry):
+        async with semaphore:
+            # При остановке не начинаем новый кик: оставшиеся обработает следующий запуск
+            if shutdown_event.is_set():
+                return None
+            return await expire_channel_access(user_id, channel_id, expiry, now)
+    
+    results = await asyncio.gather(*(expire(*item) for item in expired_channels))
+    revoked = [event for event in results if event]
+    if shutdown_event.is_set() and len(revoked) < len(expired_channels):
+        logger.info("⏹ [ПРОВЕРКА] Прервана остановкой, осталось обработать позже")
+    
+    if revoked:
+        await append_grant_events(revoked, PRIORITY_SWEEP)
+        logger.info("✅ [GSHEET] В журнал записано %s отзывов доступа", len(revoked))
+    
+    logger.info("🔍 [ПРОВЕРКА] Завершена. Найдено: %s файлов, %s каналов", len(expired_files), len(expired_channels))
+
+@traced("expire_channel_access", "user_id", "channel_id")
+async def expire_channel_access(user_id: str, channel_id: str, expiry, now: datetime) -> Optional[list]:
+    """Снимает один просроченный доступ: удаление, кик, уведомление. Возвращает событие отзыва для журнала"""
+    # Доступ могли продлить, пока шла проверка, — тогда срок уже другой и снимать нечего
+    if not await access_state.submit(revoke_access, "channels", user_id, channel_id, expiry):
+        logger.info("↩️ [ПРОДЛЁН] Доступ %s к каналу %s продлён во время проверки", user_id, channel_id)
+        return None
+    
+    # Запоминаем бывшего подписчика: сверка проверит, что он действительно вышел из канала
+    reconcile_state["former_members"].setdefault(channel_id, {})[user_id] = now.isoformat()
+    
+    # ПЫТАЕМСЯ КИКНУТЬ ПОЛЬЗОВАТЕЛЯ ИЗ КАНАЛА
+    try:
+        await bot.ban_chat_member(chat_id=int(channel_id), user_id=int(user_id))
+        await asyncio.sleep(1)
+        await bot.unban_chat_member(chat_id=int(channel_id), user_id=int(user_id))
+        logger.info("✅ [КИК] Пользователь %s кикнут из канала %s", user_id, channel_id, extra=SAMPLED)
+    except Exception as ban_error:
+        logger.error("❌ Ошибка кика пользователя %s из канала %s: %s", user_id, channel_id, ban_error)
+    
+    # Уведомляем пользователя
+    outbox.put(
+        user_id,
+        f"⏰ Срок вашего доступа к каналу истёк.\n"
+        f"📢 Канал: {html.escape(channel_title(channel_id))}\n"
+        f"💳 Для продления доступа оплатите подписку снова."
+    )
+    logger.info("✉️ [УВЕДОМЛЕНИЕ] Поставлено в очередь для пользователя %s", user_id, extra=SAMPLED)
+    
+    logger.info("✅ [УДАЛЕНО] Пользователь %s удалён из канала %s", user_id, channel_id, extra=SAMPLED)
+    return grant_event(user_id, channel_id, None, "expired")
+
+# === Сверка доступов с реальными участниками каналов ===
+reconcile_bucket = TokenBucket(RECONCILE_CALLS_PER_MINUTE, capacity=RECONCILE_BATCH_SIZE)
+reconcile_fixes = asyncio.Queue()  # (действие, channel_id, user_id)
+
+def reconcile_targets() -> List[tuple]:
+    """Все пары (канал, пользователь) с ожидаемым состоянием, в порядке обхода"""
+    targets = []
+    for channel_id in CHANNELS.values():
+        for user_id, channels in channel_access.items():
+            if channel_id in channels:
+                targets.append((channel_id, user_id, "member"))
+        for user_id in reconcile_state["former_members"].get(channel_id, {}):
+            if channel_id not in channel_access.get(user_id, {}):
+                targets.append((channel_id, user_id, "absent"))
+    targets.sort()
+    return targets
+
+def new_reconcile_pass() -> dict:
+    return {"started": datetime.now().isoformat(timespec="seconds"), "checked": 0, "errors": 0, "drift": {}, "fixed": 0, "fix_failed": 0}
+
+def save_reconcile_state():
+    try:
+        tmp_path = f"{RECONCILE_STATE_FILE}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(reconcile_state, f)
+        os.replace(tmp_path, RECONCILE_STATE_FILE)
+    except Exception as e:
+        logger.error("Ошибка сохранения состояния сверки: %s", e)
+
+async def check_membership(channel_id: str, user_id: str, expected: str, stats: dict):
+    """Сравнивает статус участника с ожидаемым и ставит исправление в очередь"""
+    await reconcile_bucket.acquire()
+    try:
+        member = await bot.get_chat_member(int(channel_id), int(user_id))
+        status = member.status.value if hasattr(member.status, "value") else str(member.status)
+    except TelegramBadRequest as e:
+        # Пользователь никогда не был в канале или удалил аккаунт
+        if "not found" in str(e).lower() or "invalid" in str(e).lower():
+            status = "left"
+        else:
+            stats["errors"] += 1
+            logger.error("Ошибка сверки %s в канале %s: %s", user_id, channel_id, e)
+            return
+    except Exception as e:
+        stats["errors"] += 1
+        logger.error("Ошибка сверки %s в канале %s: %s", user_id, channel_id, e)
+        return
+    
+    stats["checked"] += 1
+    in_channel = status in ("member", "restricted", "administrator", "creator")
     
-    for user_id, channel_id in expired_channels:
+    drift = None
+    if expected == "absent" and in_channel and status not in ("administrator", "creator"):
+        drift = "expired_still_member"
+        await reconcile_fixes.put(("kick", channel_id, user_id))
+    elif expected == "absent" and not in_channel:
+        # Подтверждено: бывший подписчик вне канала
+        reconcile_state["former_members"].get(channel_id, {}).pop(user_id, None)
+    elif expected == "member" and status == "kicked":
+        drift = "banned_with_access"
+        await reconcile_fixes.put(("unban", channel_id, user_id))
+    elif expected == "member" and status == "left":
+        drift = "paid_not_joined"
+    
+    if drift:
+        stats["drift"][drift] = stats["drift"].get(drift, 0) + 1
+        logger.info("🔎 [СВЕРКА] %s: пользователь %s, канал %s", drift, user_id, channel_id, extra=SAMPLED)
+
+async def apply_reconcile_fixes(stats: dict):
+    """Применяет накопленные исправления с тем же ограничением частоты"""
+    while not reconcile_fixes.empty():
+        action, channel_id, user_id = reconcile_fixes.get_nowait()
         try:
-            # ПЫТАЕМСЯ КИКНУТЬ ПОЛЬЗОВАТЕЛЯ ИЗ КАНАЛА
-            try:
+            await reconcile_bucket.acquire()
+            if action == "kick":
                 await bot.ban_chat_member(chat_id=int(channel_id), user_id=int(user_id))
                 await asyncio.sleep(1)
                 await bot.unban_chat_member(chat_id=int(channel_id), user_id=int(user_id))
-                logger.info(f"✅ [КИК] Пользователь {user_id} кикнут из канала {channel_id}")
-            except Exception as ban_error:
-                logger.error(f"❌ Ошибка кика пользователя {user_id} из канала {channel_id}: {ban_error}")
-            
-            # Уведомляем пользователя
-            try:
-                await bot.send_message(
-                    int(user_id), 
-                    f"⏰ Срок вашего доступа к каналу истёк.\n"
-                    f"📢 Канал: {CHANNELS.get(channel_id, channel_id)}\n"
-                    f"💳 Для продления доступа оплатите подписку снова."
-                )
-                logger.info(f"✉️ [УВЕДОМЛЕНИЕ] Отправлено пользователю {user_id}")
-            except Exception as notify_error:
-                logger.error(f"❌ Не удалось отправить уведомление пользователю {user_id}: {notify_error}")
-            
-            # Удаляем из хранилища
-            del channel_access[user_id][channel_id]
-            if not channel_access[user_id]:
-                del channel_access[user_id]
-            
-            # Удаляем из Google Sheets
-            if ws:
-                try:
-                    records = ws.get_all_values()
-                    for idx, row in enumerate(records[1:], start=2):
-                        if str(row[0]) == user_id:
-                            current_access = row[9] if len(row) > 9 else ""
-                            if current_access:
-                                accesses = current_access.split(';')
-                                new_accesses = [
-                                    acc for acc in accesses 
-                                    if not acc.startswith(f"{channel_id}:")
-                                ]
-                                ws.update_cell(idx, 10, ';'.join(new_accesses))
-                                logger.info(f"✅ [GSHEET] Удален доступ к {channel_id} для {user_id}")
-                            break
-                except Exception as e:
-                    logger.error(f"Ошибка удаления доступа из Google Sheets: {e}")
-                
-            logger.info(f"✅ [УДАЛЕНО] Пользователь {user_id} удалён из канала {channel_id}")
+                reconcile_state["former_members"].get(channel_id, {}).pop(user_id, None)
+            elif action == "unban":
+                await bot.unban_chat_member(chat_id=int(channel_id), user_id=int(user_id), only_if_banned=True)
+            stats["fixed"] += 1
+            logger.info("✅ [СВЕРКА] %s: пользователь %s, канал %s", action, user_id, channel_id, extra=SAMPLED)
         except Exception as e:
-            logger.error(f"❌ [ОШИБКА] При удалении доступа к каналу: {e}")
-            try:
-                del channel_access[user_id][channel_id]
-                if not channel_access[user_id]:
-                    del channel_access[user_id]
-                logger.info(f"✅ [БАЗА] Пользователь {user_id} удален из базы (канал {channel_id})")
-                
-                try:
-                    await bot.send_message(
-                        int(user_id), 
-                        f"⏰ Срок вашего доступа к каналу истёк.\n"
-                        f"📢 Канал: {CHANNELS.get(channel_id, channel_id)}\n"
-                        f"💳 Для продления доступа оплатите подписку снова."
-                    )
-                    logger.info(f"✉️ [УВЕДОМЛЕНИЕ] Отправлено пользователю {user_id} (после ошибки)")
-                except Exception as notify_error:
-                    logger.error(f"❌ Не удалось отправить уведомление пользователю {user_id}: {notify_error}")
-                    
-            except:
-                pass
+            stats["fix_failed"] += 1
+            logger.error("❌ [СВЕРКА] Не удалось выполнить %s для %s в канале %s: %s", action, user_id, channel_id, e)
+
+@traced("reconcile_membership_batch")
+async def reconcile_membership_batch() -> bool:
+    """Проверяет следующую порцию пар после курсора. Возвращает True, если проход завершён"""
+    if not reconcile_state["pass"]:
+        reconcile_state["pass"] = new_reconcile_pass()
+    stats = reconcile_state["pass"]
+    
+    cursor = tuple(reconcile_state["cursor"]) if reconcile_state["cursor"] else None
+    batch = [t for t in reconcile_targets() if cursor is None or (t[0], t[1]) > cursor][:RECONCILE_BATCH_SIZE]
+    
+    for channel_id, user_id, expected in batch:
+        if shutdown_event.is_set():
+            break
+        await check_membership(channel_id, user_id, expected, stats)
+        reconcile_state["cursor"] = [channel_id, user_id]
+    
+    if RECONCILE_AUTOFIX:
+        await apply_reconcile_fixes(stats)
     
-    if expired_files or expired_channels:
-        save_data()
-        logger.info(f"💾 [СОХРАНЕНО] Данные обновлены")
+    finished = len(batch) < RECONCILE_BATCH_SIZE and not shutdown_event.is_set()
+    if finished:
+        stats["finished"] = datetime.now().isoformat(timespec="seconds")
+        reconcile_state["last_pass"] = stats
+        reconcile_state["pass"] = {}
+        reconcile_state["cursor"] = None
+        
+        drift_total = sum(stats["drift"].values())
+        logger.info("🔎 [СВЕРКА] Проход завершён: проверено %s, расхождений %s", stats["checked"], drift_total, extra={"reconcile": stats})
+        if drift_total:
+            try:
+                await bot.send_message(ADMIN_ID, "🔎 Сверка участников каналов\n\n" + format_reconcile_stats(stats))
+            except Exception as e:
+                logger.error("Не удалось отправить отчёт о сверке: %s", e)
     
-    logger.info(f"🔍 [ПРОВЕРКА] Завершена. Найдено: {len(expired_files)} файлов, {len(expired_channels)} каналов")
+    save_reconcile_state()
+    return finished
 
-# === Фоновая проверка ===
-async def check_expired_access_task():
-    """Фоновая задача проверки доступов"""
-    logger.info("[BACKGROUND] Запущен мониторинг доступов")
-    while True:
-        try:
-            await check_expired_access()
-            await asyncio.sleep(60)
-        except Exception as e:
-            logger.error(f"❌ [BACKGROUND] Ошибка: {e}")
-            await asyncio.sleep(60)
+def format_reconcile_stats(stats: dict) -> str:
+    titles = {
+        "expired_still_member": "срок истёк, но в канале",
+        "banned_with_access": "заблокирован при активном доступе",
+        "paid_not_joined": "оплатил, но не вступил",
+    }
+    lines = [
+        f"Начат: {stats.get('started')}",
+        f"Проверено: {stats.get('checked', 0)}, ошибок: {stats.get('errors', 0)}",
+    ]
+    for kind, count in stats.get("drift", {}).items():
+        lines.append(f"⚠️ {titles.get(kind, kind)}: {count}")
+    lines.append(f"🛠 Исправлено: {stats.get('fixed', 0)}, не удалось: {stats.get('fix_failed', 0)}")
+    return "\n".join(lines)
 
 # === Генерация ссылок на оплату ===
 def generate_file_payment_link(user_id: int, file_id: str, price: int, file_name: str):
@@ -331,7 +2026,7 @@ def generate_file_payment_link(user_id: int, file_id: str, price: int, file_name
         "order_id": f"file_{user_id}_{file_id}",
         "order_num": f"file_{user_id}_{file_id}",
         "customer_extra": f"Оплата файла {file_id} от пользователя {user_id}",
-        "callback_url": "https://telegram-subscribe-bot-5oh7.onrender.com/webhook"
+        "callback_url": PAYMENT_CALLBACK_URL
     }
     query = "&".join([f"{k}={v}" for k, v in params.items()])
     return f"{PAYFORM_URL}/?{query}"
@@ -346,7 +2041,7 @@ def generate_channel_payment_link(user_id: int, channel_id: str, price: int, day
         "order_id": f"channel_{user_id}_{channel_id}_{days}",
         "order_num": f"channel_{user_id}_{channel_id}_{days}",
         "customer_extra": f"Оплата доступа к каналу {channel_id} на {period} от пользователя {user_id}",
-        "callback_url": "https://telegram-subscribe-bot-5oh7.onrender.com/webhook"
+        "callback_url": PAYMENT_CALLBACK_URL
     }
     query = "&".join([f"{k}={v}" for k, v in params.items()])
     return f"{PAYFORM_URL}/?{query}"
@@ -358,7 +2053,7 @@ def extract_payment_info(data: dict) -> tuple:
     order_num = data.get('order_num', '')
     customer_extra = unquote(data.get('customer_extra', ''))
     
-    logger.info(f"DEBUG: order_id={order_id}, order_num={order_num}, customer_extra={customer_extra}")
+    logger.debug("order_id=%s, order_num=%s, customer_extra=%s", order_id, order_num, customer_extra)
     
     if order_num.startswith('channel_'):
         parts = order_num.split('_')
@@ -392,7 +2087,7 @@ def extract_payment_info(data: dict) -> tuple:
     for pattern in patterns:
         match = re.search(pattern, customer_extra, re.IGNORECASE)
         if match:
-            logger.info(f"DEBUG: Pattern {pattern} matched: {match.groups()}")
+            logger.debug("Pattern %s matched: %s", pattern, match.groups())
             
             if 'канала' in pattern or 'channel' in pattern:
                 if len(match.groups()) >= 3:
@@ -412,7 +2107,7 @@ def extract_payment_info(data: dict) -> tuple:
                 if len(match.groups()) >= 2:
                     return "file", match.group(2), match.group(1), None
     
-    logger.warning(f"Нестандартный формат данных, пробуем извлечь вручную...")
+    logger.warning("Нестандартный формат данных, пробуем извлечь вручную...")
     
     user_id_match = re.search(r'(\d{8,10})', customer_extra)
     if user_id_match:
@@ -431,83 +2126,270 @@ def extract_payment_info(data: dict) -> tuple:
         if file_match:
             return "file", user_id, file_match.group(1), None
     
-    raise ValueError(f"Не могу извлечь данные из: order_id={order_id}, order_num={order_num}, customer_extra={customer_extra}")
-
-# === Функции для работы с каналами ===
-async def grant_channel_access(user_id: int, channel_id: str, days: int):
-    """Предоставляет доступ к каналу и сохраняет в Google Sheets"""
-    try:
-        await bot.unban_chat_member(int(channel_id), user_id)
-        
-        invite = await bot.create_chat_invite_link(
-            chat_id=int(channel_id),
-            expire_date=None,
-            member_limit=1
-        )
-        
-        if str(user_id) not in channel_access:
-            channel_access[str(user_id)] = {}
-        
-        if days == 0:
-            channel_access[str(user_id)][channel_id] = "forever"
-            expiry_date = "forever"
-        else:
-            expiry_date = datetime.now() + timedelta(days=days)
-            channel_access[str(user_id)][channel_id] = expiry_date
+    raise ValueError(f"Не могу извлечь данные из: order_id={order_id}, order_num={order_num}, customer_extra={customer_extra}")
+
+# === Функции для работы с каналами ===
+@traced("grant_channel_access", "user_id", "channel_id", "days")
+async def grant_channel_access(user_id: int, channel_id: str, days: int):
+    """Предоставляет доступ к каналу и сохраняет в Google Sheets"""
+    try:
+        await bot.unban_chat_member(int(channel_id), user_id)
+        
+        invite = await bot.create_chat_invite_link(
+            chat_id=int(channel_id),
+            expire_date=None,
+            member_limit=1
+        )
+        reconcile_state["former_members"].get(channel_id, {}).pop(str(user_id), None)
+        
+        expiry_date = "forever" if days == 0 else datetime.now() + timedelta(days=days)
+        await access_state.submit(set_access, "channels", str(user_id), channel_id, expiry_date)
+        
+        # Событие в журнал без предварительного чтения; новому пользователю — строка в основном листе
+        await append_grant_events([grant_event(user_id, channel_id, expiry_date, "payment")], PRIORITY_PAYMENT)
+        await ensure_user_row(str(user_id))
+        
+        return invite.invite_link
+        
+    except Exception as e:
+        logger.error("Ошибка предоставления доступа к каналу: %s", e)
+        raise
+
+async def resend_invite_link(user_id: int, channel_id: str) -> str:
+    """Ссылка для пользователя с активным доступом: без разбана, Google Sheets и сохранения состояния.
+    
+    Ссылка одноразовая, поэтому каждый раз новая: прежняя могла быть уже использована
+    (пользователь вошёл, вышел и просит снова). Частоту запросов ограничивает ThrottlingMiddleware.
+    """
+    invite = await bot.create_chat_invite_link(
+        chat_id=int(channel_id),
+        expire_date=None,
+        member_limit=1
+    )
+    return invite.invite_link
+
+# === Массовая выдача доступа из CSV ===
+def resolve_channel_id(value: str) -> Optional[str]:
+    """ID канала из CSV: имя из CHANNELS, название канала или числовой -100…"""
+    value = value.strip()
+    if value.lower() in channel_ids_by_name:
+        return channel_ids_by_name[value.lower()]
+    if value.startswith("-100") and value[1:].isdigit():
+        return value
+    return None
+
+def parse_bulk_grants(path: str) -> dict:
+    """Потоковая проверка CSV user_id,channel_id,days. Файл не читается в память целиком"""
+    result = {"rows": 0, "grants": {}, "invalid": 0, "errors": [], "duplicates": 0}
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        for line_no, row in enumerate(csv.reader(f), start=1):
+            if not row or not any(cell.strip() for cell in row):
+                continue
+            # Заголовок пропускаем
+            if line_no == 1 and not row[0].strip().isdigit():
+                continue
+            result["rows"] += 1
+            
+            error = None
+            if len(row) < 3:
+                error = "нужно 3 столбца: user_id,channel_id,days"
+            elif not row[0].strip().isdigit():
+                error = f"неверный user_id: {row[0]!r}"
+            elif resolve_channel_id(row[1]) is None:
+                error = f"неизвестный канал: {row[1]!r}"
+            elif not row[2].strip().isdigit():
+                error = f"неверное число дней: {row[2]!r}"
+            elif int(row[2]) > BULK_GRANT_MAX_DAYS:
+                error = f"слишком много дней: {row[2].strip()} (не больше {BULK_GRANT_MAX_DAYS}, 0 — навсегда)"
+            
+            if error:
+                result["invalid"] += 1
+                if len(result["errors"]) < BULK_GRANT_MAX_ERRORS:
+                    result["errors"].append(f"строка {line_no}: {error}")
+                continue
+            
+            key = (row[0].strip(), resolve_channel_id(row[1]))
+            if key in result["grants"]:
+                result["duplicates"] += 1
+            # При повторе пары пользователь+канал действует последняя строка
+            result["grants"][key] = int(row[2])
+    return result
+
+def apply_bulk_grants(state: AccessState, grants: dict) -> tuple:
+    """Все выдачи из CSV одной операцией актора.
+    
+    Возвращает новые сроки {(user_id, channel_id): срок} и число уже бессрочных доступов.
+    """
+    expiries = {}
+    forever_kept = 0
+    for (user_id, channel_id), days in grants.items():
+        if state.get("channels", user_id, channel_id) == "forever":
+            forever_kept += 1
+        expiries[(user_id, channel_id)] = extend_access(state, user_id, channel_id, days)
+        reconcile_state["former_members"].get(channel_id, {}).pop(user_id, None)
+    return expiries, forever_kept
+
+async def write_bulk_grants_to_sheet(expiries: dict) -> tuple:
+    """Одна запись событий в журнал доступов + одно добавление строк для новых пользователей, без чтения"""
+    events = [
+        grant_event(user_id, channel_id, expiry, "bulk")
+        for (user_id, channel_id), expiry in expiries.items()
+    ]
+    await append_grant_events(events, PRIORITY_ADMIN)
+    
+    new_users = sorted({user_id for user_id, _ in expiries} - known_users)
+    if new_users:
+        await sheets.write("append_rows", [[user_id] + [""] * 9 for user_id in new_users], priority=PRIORITY_ADMIN)
+        known_users.update(new_users)
+    return len(events), len(new_users)
+
+async def deliver_bulk_invites(expiries: dict, report: dict):
+    """Ссылки-приглашения с ограничением частоты и параллельности.
+    
+    В сообщении — срок после выдачи: у кого доступ уже был, он продлён от прежнего срока.
+    """
+    bucket = TokenBucket(BULK_INVITES_PER_MINUTE, capacity=BULK_INVITE_CONCURRENCY)
+    semaphore = asyncio.Semaphore(BULK_INVITE_CONCURRENCY)
+    
+    async def deliver(user_id: str, channel_id: str, expiry):
+        if shutdown_event.is_set():
+            report["links_skipped"] += 1
+            return
+        async with semaphore:
+            try:
+                await bucket.acquire()
+                await bot.unban_chat_member(int(channel_id), int(user_id), only_if_banned=True)
+                invite = await bot.create_chat_invite_link(chat_id=int(channel_id), expire_date=None, member_limit=1)
+                report["links_created"] += 1
+            except Exception as e:
+                report["links_failed"] += 1
+                logger.error("Массовая выдача: ссылка для %s в канал %s: %s", user_id, channel_id, e)
+                return
+            
+            if user_id in unreachable_users:
+                return
+            period = "навсегда" if expiry == "forever" else f"до {expiry.strftime('%d.%m.%Y %H:%M')}"
+            outbox.put(
+                user_id,
+                f"🎁 Вам предоставлен доступ к каналу «{html.escape(channel_title(channel_id))}» {period}.\n"
+                f"Ссылка для входа: {invite.invite_link}"
+            )
+            report["queued"] += 1
+    
+    await asyncio.gather(*(deliver(user_id, channel_id, expiry) for (user_id, channel_id), expiry in expiries.items()))
+
+async def run_bulk_grant(path: str):
+    """Фоновая массовая выдача: при любом сбое админ получает сообщение, а не тишину"""
+    try:
+        await bulk_grant(path)
+    except Exception as e:
+        logger.exception("Массовая выдача прервана: %s", e)
+        outbox.put(ADMIN_ID, f"❌ Массовая выдача прервана: {html.escape(str(e)[:500])}\nЧасть доступов могла быть уже выдана — проверьте /export_access")
+
+async def bulk_grant(path: str):
+    """Проверка, применение в памяти, одна запись в таблицу, рассылка ссылок и отчёт админу"""
+    started = time.monotonic()
+    try:
+        parsed = await asyncio.to_thread(parse_bulk_grants, path)
+    finally:
+        os.remove(path)
+    
+    grants = parsed["grants"]
+    report = {"extended": 0, "forever_kept": 0, "links_created": 0, "links_failed": 0,
+              "links_skipped": 0, "queued": 0, "events": 0, "rows_added": 0}
+    
+    expiries, report["forever_kept"] = await access_state.submit(apply_bulk_grants, grants)
+    report["extended"] = len(expiries)
+    
+    sheet_error = None
+    if grants and sheets.ready:
+        try:
+            report["events"], report["rows_added"] = await write_bulk_grants_to_sheet(expiries)
+        except Exception as e:
+            sheet_error = str(e)
+            logger.error("Массовая выдача: ошибка записи в Google Sheets: %s", e)
+    
+    await deliver_bulk_invites(expiries, report)
+    
+    lines = [
+        "📥 Массовая выдача доступа",
+        f"Строк: {parsed['rows']}, корректных: {len(grants)}, ошибок: {parsed['invalid']}, повторов: {parsed['duplicates']}",
+        f"✅ Выдано/продлено: {report['extended']} (бессрочных без изменений: {report['forever_kept']})",
+        f"📊 Таблица: событий в журнале {report['events']}, новых пользователей {report['rows_added']}"
+        + (f"\n⚠️ Ошибка таблицы: {html.escape(sheet_error)}" if sheet_error else ""),
+        f"🔗 Ссылок: {report['links_created']}, ошибок: {report['links_failed']}, отложено: {report['links_skipped']}",
+        f"✉️ Сообщений со ссылками в очереди на отправку: {report['queued']}",
+        f"⏱ {time.monotonic() - started:.1f} с",
+    ]
+    if parsed["errors"]:
+        lines.append("\nОшибки:\n" + html.escape("\n".join(parsed["errors"])))
+    await bot.send_message(ADMIN_ID, "\n".join(lines))
+
+# === Защита от флуда ===
+class ThrottlingMiddleware(BaseMiddleware):
+    """Token bucket на пользователя и тип запроса; повторное нажатие кнопки покупки в коротком окне пропускается"""
+    
+    def __init__(self):
+        self.buckets = {}  # {(user_id, тип): TokenBucket}
+        self.recent = {}   # {(user_id, запрос): время}
+        self.dropped = Counter()
+    
+    @staticmethod
+    def classify(event) -> tuple:
+        """(тип запроса, полный запрос) для сообщения или нажатия кнопки"""
+        if isinstance(event, types.CallbackQuery):
+            payload = event.data or ""
+            return payload.split(":", 1)[0], f"cb:{payload}"
+        text = (event.text or "").strip()
+        if text.startswith("/"):
+            return text[1:].split()[0].split("@")[0], f"msg:{text}"
+        return "message", None
+    
+    def _prune(self, now: float):
+        if len(self.recent) > 10000:
+            self.recent = {k: t for k, t in self.recent.items() if now - t < THROTTLE_REPEAT_WINDOW}
+        if len(self.buckets) > 10000:
+            self.buckets = {k: b for k, b in self.buckets.items() if now - b.updated < 600}
+    
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or user.id == ADMIN_ID:
+            return await handler(event, data)
         
-        if ws:
-            try:
-                records = ws.get_all_values()
-                for idx, row in enumerate(records[1:], start=2):
-                    if str(row[0]) == str(user_id):
-                        current_access = row[9] if len(row) > 9 else ""
-                        new_access = f"{channel_id}:{expiry_date}"
-                        
-                        if current_access:
-                            accesses = current_access.split(';')
-                            updated = False
-                            for i, acc in enumerate(accesses):
-                                if acc.startswith(f"{channel_id}:"):
-                                    accesses[i] = new_access
-                                    updated = True
-                                    break
-                            
-                            if not updated:
-                                accesses.append(new_access)
-                            
-                            ws.update_cell(idx, 10, ';'.join(accesses))
-                        else:
-                            ws.update_cell(idx, 10, new_access)
-                        break
-                else:
-                    ws.append_row([
-                        user_id, "", "", "", "", "", "", "", "", 
-                        f"{channel_id}:{expiry_date}"
-                    ])
-            except Exception as e:
-                logger.error(f"Ошибка сохранения доступа в Google Sheets: {e}")
+        kind, payload = self.classify(event)
+        now = time.monotonic()
+        self._prune(now)
         
-        save_data()
+        # Та же кнопка покупки только что обработана — ответ уже у пользователя
+        if payload and kind in THROTTLE_REPEAT_KINDS and now - self.recent.get((user.id, payload), -THROTTLE_REPEAT_WINDOW) < THROTTLE_REPEAT_WINDOW:
+            self.dropped["repeat"] += 1
+            if isinstance(event, types.CallbackQuery):
+                await event.answer("✅ Уже отправлено — смотрите сообщение выше")
+            return None
         
-        return invite.invite_link
+        rate, burst = THROTTLE_RULES.get(kind, THROTTLE_RULES["default"])
+        bucket = self.buckets.get((user.id, kind))
+        if bucket is None:
+            bucket = self.buckets[(user.id, kind)] = TokenBucket(rate, capacity=burst)
+        if not bucket.try_acquire():
+            self.dropped[kind] += 1
+            logger.info("⏳ [ФЛУД] Пользователь %s, запрос %s", user.id, kind, extra=SAMPLED)
+            if isinstance(event, types.CallbackQuery):
+                await event.answer("⏳ Слишком часто, попробуйте через минуту")
+            return None
         
-    except Exception as e:
-        logger.error(f"Ошибка предоставления доступа к каналу: {e}")
-        raise
+        if payload and kind in THROTTLE_REPEAT_KINDS:
+            self.recent[(user.id, payload)] = now
+        return await handler(event, data)
 
-# Подключение к Google Sheets
-try:
-    creds_path = '/etc/secrets/GSPREAD_CREDENTIALS.json'
-    creds = Credentials.from_service_account_file(creds_path, scopes=[
-        "https://www.googleapis.com/auth/spreadsheets"
-    ])
-    gc = gspread.authorize(creds)
-    sh = gc.open_by_key(GSHEET_ID)
-    ws = sh.sheet1
-    logger.info("Успешное подключение к Google Sheets!")
-except Exception as e:
-    logger.error(f"Ошибка Google Sheets: {e}")
-    ws = None
+throttling = ThrottlingMiddleware()
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
 
 # Клавиатуры
 def admin_kb() -> InlineKeyboardMarkup:
@@ -569,11 +2451,176 @@ def create_buttons_keyboard(buttons_data: str) -> Optional[InlineKeyboardMarkup]
             i += 1
                         
     except Exception as e:
-        logger.error(f"Ошибка создания клавиатуры: {e}")
+        logger.error("Ошибка создания клавиатуры: %s", e)
         return None
     
     return InlineKeyboardMarkup(inline_keyboard=keyboard) if keyboard else None
 
+# === Лента постов ===
+async def get_posts(force: bool = False) -> List[dict]:
+    """Возвращает опубликованные посты из кэша, при устаревании перечитывает таблицу"""
+    if not force and posts_cache["loaded_at"] and time.monotonic() - posts_cache["loaded_at"] < POSTS_CACHE_TTL:
+        return posts_cache["posts"]
+    
+    if not sheets.ready:
+        return posts_cache["posts"]
+    
+    records = await sheets.read("get_all_values", priority=PRIORITY_FEED)
+    apply_post_rows(records)
+    save_snapshot()
+    return posts_cache["posts"]
+
+def posts_from_rows(records: List[list]) -> List[dict]:
+    """Посты из строк таблицы: post_id, post_text, post_photo, post_buttons в столбцах 6-9"""
+    posts = []
+    for row in records[1:]:
+        row = row + [""] * (9 - len(row))
+        post_id = str(row[5]).strip()
+        if post_id and not post_id.startswith(POST_TOMBSTONE):
+            posts.append({
+                "post_id": post_id,
+                "text": row[6] or "Без текста",
+                "photo_id": str(row[7]).strip(),
+                "buttons": str(row[8]).strip(),
+            })
+    return posts
+
+# === Индекс постов ===
+posts_lock = asyncio.Lock()  # создание, удаление и уплотнение постов — по одному
+
+def apply_post_rows(records: List[list]):
+    """Пересобирает кэш постов и индекс post_id → строка по полному чтению таблицы"""
+    posts_cache["posts"] = posts_from_rows(records)
+    posts_cache["loaded_at"] = time.monotonic()
+    
+    rows = {}
+    max_id = 0
+    tombstones = 0
+    for idx, row in enumerate(records[1:], start=2):
+        post_id = str(row[5]).strip() if len(row) > 5 else ""
+        if not post_id:
+            continue
+        if post_id.startswith(POST_TOMBSTONE):
+            tombstones += 1
+            post_id = post_id[len(POST_TOMBSTONE):]
+        else:
+            rows[post_id] = idx
+        if post_id.isdigit():
+            max_id = max(max_id, int(post_id))
+    
+    post_index["rows"] = rows
+    post_index["tombstones"] = tombstones
+    # Счётчик только растёт: id удалённых постов не переиспользуются
+    post_index["next_id"] = max(post_index["next_id"], max_id + 1)
+
+def appended_row_number(response) -> Optional[int]:
+    """Номер строки, добавленной append_row (из updatedRange ответа API)"""
+    try:
+        match = re.search(r"![A-Z]+(\d+)", response["updates"]["updatedRange"])
+        return int(match.group(1)) if match else None
+    except (KeyError, TypeError):
+        return None
+
+async def create_post(text: str, photo_id: str, buttons_str: str) -> int:
+    """Добавляет пост одной записью в таблицу, без чтения"""
+    async with posts_lock:
+        post_id = post_index["next_id"]
+        post_index["next_id"] += 1
+        response = await sheets.write(
+            "append_row", ["", "", "", "", "", post_id, text, photo_id, buttons_str, ""], priority=PRIORITY_ADMIN
+        )
+        row = appended_row_number(response)
+        if row:
+            post_index["rows"][str(post_id)] = row
+        posts_cache["posts"].append({
+            "post_id": str(post_id), "text": text or "Без текста", "photo_id": photo_id, "buttons": buttons_str,
+        })
+    save_snapshot()
+    return post_id
+
+async def post_row_matches(row: int, post_id: str) -> bool:
+    values = await sheets.read("row_values", row, priority=PRIORITY_ADMIN)
+    return len(values) > 5 and str(values[5]).strip() == post_id
+
+async def delete_post(post_id: str) -> bool:
+    """Помечает пост удалённым (надгробие в столбце post_id) — строки таблицы не сдвигаются"""
+    async with posts_lock:
+        row = post_index["rows"].get(post_id)
+        if not row or not await post_row_matches(row, post_id):
+            # Поста нет в индексе или строка не та (таблицу правили вручную, append не вернул номер
+            # строки) — один раз перестраиваем индекс по таблице
+            apply_post_rows(await sheets.read("get_all_values", priority=PRIORITY_ADMIN))
+            row = post_index["rows"].get(post_id)
+        if not row:
+            return False
+        
+        await sheets.write("update_cell", row, 6, f"{POST_TOMBSTONE}{post_id}", priority=PRIORITY_ADMIN)
+        del post_index["rows"][post_id]
+        post_index["tombstones"] += 1
+        posts_cache["posts"] = [p for p in posts_cache["posts"] if p["post_id"] != post_id]
+    save_snapshot()
+    return True
+
+@traced("compact_posts")
+async def compact_posts() -> int:
+    """Удаляет строки-надгробия из таблицы и перестраивает индекс. Возвращает число удалённых строк"""
+    async with posts_lock:
+        if not post_index["tombstones"] or not sheets.ready:
+            return 0
+        
+        records = await sheets.read("get_all_values", priority=PRIORITY_SWEEP)
+        dead = [
+            idx for idx, row in enumerate(records[1:], start=2)
+            if len(row) > 5 and str(row[5]).startswith(POST_TOMBSTONE) and not str(row[0]).strip()
+        ]
+        
+        # Непрерывные диапазоны, снизу вверх — чтобы номера оставшихся не сдвигались по ходу
+        ranges = []
+        for idx in dead:
+            if ranges and ranges[-1][1] == idx - 1:
+                ranges[-1][1] = idx
+            else:
+                ranges.append([idx, idx])
+        for start, end in reversed(ranges):
+            await sheets.write("delete_rows", start, end, priority=PRIORITY_SWEEP)
+        
+        dead_rows = set(dead)
+        apply_post_rows([row for idx, row in enumerate(records, start=1) if idx not in dead_rows])
+    save_snapshot()
+    logger.info("🧹 Уплотнение постов: удалено строк %s", len(dead))
+    return len(dead)
+
+def render_feed_page(posts: List[dict], page: int, is_admin: bool):
+    """Готовит страницу ленты: (страница, текст, фото, клавиатура)"""
+    page = max(0, min(page, len(posts) - 1))
+    post = posts[page]
+    
+    keyboard = create_buttons_keyboard(post["buttons"])
+    rows = list(keyboard.inline_keyboard) if keyboard else []
+    if not rows and is_admin:
+        rows = list(delete_kb(post["post_id"]).inline_keyboard)
+    
+    if len(posts) > 1:
+        rows.append([
+            InlineKeyboardButton(text="◀️", callback_data=f"feed:{page - 1}" if page > 0 else "feed:noop"),
+            InlineKeyboardButton(text=f"{page + 1}/{len(posts)}", callback_data="feed:noop"),
+            InlineKeyboardButton(text="▶️", callback_data=f"feed:{page + 1}" if page < len(posts) - 1 else "feed:noop"),
+        ])
+    
+    return page, post["text"], post["photo_id"], InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+
+async def send_feed_page(message: Message, posts: List[dict], page: int, is_admin: bool):
+    """Отправляет страницу ленты новым сообщением"""
+    page, text, photo_id, keyboard = render_feed_page(posts, page, is_admin)
+    try:
+        if photo_id:
+            await message.answer_photo(photo=photo_id, caption=text, reply_markup=keyboard)
+        else:
+            await message.answer(text=text, reply_markup=keyboard)
+    except Exception as e:
+        logger.error("Ошибка отправки поста %s: %s", posts[page]['post_id'], e)
+        await message.answer(f"📄 {text[:300]}" + ("..." if len(text) > 300 else ""), reply_markup=keyboard)
+
 # Состояния FSM
 class PostStates(StatesGroup):
     waiting_text = State()
@@ -587,73 +2634,70 @@ class PostStates(StatesGroup):
     waiting_button_days = State()
     waiting_button_url = State()
 
+class BulkGrantStates(StatesGroup):
+    waiting_file = State()
+
 # Регистрация пользователя
 async def register_user(user: types.User):
-    if not ws:
+    user_id = str(user.id)
+    if not user_id.isdigit():
+        logger.error("Invalid user_id: %s", user_id)
         return
-        
-    try:
-        user_id = str(user.id)
-        if not user_id.isdigit():
-            logger.error(f"Invalid user_id: {user_id}")
-            return
+    
+    await ensure_user_row(user_id, user.username or "")
 
-        records = ws.get_all_records()
+async def ensure_user_row(user_id: str, username: str = ""):
+    """Добавляет строку пользователя в основной лист, если её ещё нет"""
+    # Уже в таблице — без обращения к Google Sheets
+    if user_id in known_users:
+        return
+    
+    # Таблица ещё не сверена после старта — зарегистрируем после сверки
+    if not sheets_reconciled.is_set():
+        pending_registrations[user_id] = username or pending_registrations.get(user_id, "")
+        return
         
-        if not any(str(r.get("id", "")).strip() == user_id for r in records):
-            ws.append_row([
-                user_id,
-                user.username or "",
-                "",  # file_url
-                "",  # subscription_type
-                "",  # subscription_end
-                "",  # post_id
-                "",  # post_text
-                "",  # post_photo
-                "",  # post_buttons
-                ""   # channel_access
-            ])
-            logger.info(f"Зарегистрирован новый пользователь: {user_id}")
+    try:
+        await append_user_row(user_id, username)
+        save_snapshot()
     except Exception as e:
-        logger.error(f"Ошибка регистрации пользователя: {e}")
+        logger.error("Ошибка регистрации пользователя: %s", e)
+
+async def append_user_row(user_id: str, username: str):
+    await sheets.write("append_row", [
+        user_id,
+        username,
+        "",  # file_url
+        "",  # subscription_type
+        "",  # subscription_end
+        "",  # post_id
+        "",  # post_text
+        "",  # post_photo
+        "",  # post_buttons
+        ""   # channel_access
+    ], priority=PRIORITY_REGISTRATION)
+    known_users.add(user_id)
+    logger.info("Зарегистрирован новый пользователь: %s", user_id, extra=SAMPLED)
 
 # Обработчики команд
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
     try:
         await register_user(message.from_user)
-        records = ws.get_all_records() if ws else []
-        posts = [p for p in records if str(p.get("post_id", "")).strip()]
+        # Пользователь снова пишет боту — значит, он доступен для рассылок
+        if mark_reachable(message.from_user.id):
+            save_data()
+        posts = await get_posts()
         
         if not posts:
             await message.answer("📭 Пока нет опубликованных постов")
             return
-            
-        for post in posts:
-            text = post.get("post_text", "Без текста")
-            photo_id = post.get("post_photo", "").strip()
-            buttons_data = post.get("post_buttons", "").strip()
-            
-            keyboard = create_buttons_keyboard(buttons_data)
-            
-            try:
-                if photo_id:
-                    await message.answer_photo(
-                        photo=photo_id,
-                        caption=text,
-                        reply_markup=keyboard if keyboard else (delete_kb(post["post_id"]) if message.from_user.id == ADMIN_ID else None)
-                    )
-                else:
-                    await message.answer(
-                        text=text,
-                        reply_markup=keyboard if keyboard else (delete_kb(post["post_id"]) if message.from_user.id == ADMIN_ID else None)
-                    )
-            except Exception as e:
-                logger.error(f"Ошибка отправки поста {post.get('post_id')}: {e}")
-                await message.answer(f"📄 {text[:300]}" + ("..." if len(text) > 300 else ""))
+        
+        # Одна страница ленты вместо отдельного сообщения на каждый пост
+        await send_feed_page(message, posts, 0, message.from_user.id == ADMIN_ID)
                 
     except Exception as e:
-        logger.error(f"Ошибка в /start: {e}", exc_info=True)
+        logger.error("Ошибка в /start: %s", e, exc_info=True)
         await message.answer("⚠️ Ошибка загрузки постов")
 
 @dp.message(Command("admin"))
@@ -691,8 +2735,7 @@ async def cmd_myaccess(message: Message):
         access_list = []
         for channel_id, expiry in channel_access[user_id].items():
             status = "✅ Бессрочный" if expiry == "forever" else f"⏰ До {expiry.strftime('%d.%m.%Y %H:%M')}"
-            channel_name = next((name for name, cid in CHANNELS.items() if cid == channel_id), channel_id)
-            access_list.append(f"📢 {channel_name} - {status}")
+            access_list.append(f"📢 {html.escape(channel_title(channel_id))} - {status}")
         
         await message.answer(
             "🔐 Ваши активные доступы:\n\n" + "\n".join(access_list) +
@@ -729,15 +2772,102 @@ async def cmd_debug_access(message: Message):
         return
         
     debug_info = []
+    length = 0
+    truncated = False
     for user_id, channels in channel_access.items():
         for channel_id, expiry in channels.items():
-            debug_info.append(f"👤 {user_id} -> 📢 {channel_id} -> ⏰ {expiry}")
+            line = f"👤 {user_id} -> 📢 {channel_id} -> ⏰ {expiry}"
+            length += len(line) + 1
+            if length > 3800:
+                truncated = True
+                break
+            debug_info.append(line)
+        if truncated:
+            break
     
     if debug_info:
-        await message.answer("\n".join(debug_info)[:4000])
+        if truncated:
+            debug_info.append("… полный список: /export_access")
+        await message.answer("\n".join(debug_info))
     else:
         await message.answer("📭 Нет активных доступов")
 
+# === Выгрузка доступов и покупок в CSV ===
+def iter_access_rows(channels_snapshot: dict, files_snapshot: dict, channel_id: Optional[str] = None, before: Optional[datetime] = None):
+    """Построчно отдаёт доступы к каналам и оплаченные файлы с учётом фильтров.
+    
+    Принимает копии словарей доступов, поэтому обход можно вести в потоке.
+    """
+    for user_id, channels in channels_snapshot.items():
+        for cid, expiry in channels.items():
+            if channel_id and cid != channel_id:
+                continue
+            if before and not (isinstance(expiry, datetime) and expiry < before):
+                continue
+            yield ("channel", user_id, cid, expiry.isoformat() if isinstance(expiry, datetime) else expiry)
+    
+    # Фильтр по каналу к файлам не относится
+    if channel_id:
+        return
+    for user_id, files in files_snapshot.items():
+        for file_id, expiry in files.items():
+            if before and not (isinstance(expiry, datetime) and expiry < before):
+                continue
+            yield ("file", user_id, file_id, expiry.isoformat() if isinstance(expiry, datetime) else expiry)
+
+def write_access_csv(path: str, rows) -> int:
+    """Пишет строки в CSV на диск, не собирая их в памяти. Возвращает число строк"""
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["kind", "user_id", "target_id", "expiry"])
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+@dp.message(Command("export_access"))
+async def cmd_export_access(message: Message):
+    """Выгрузка доступов и покупок в CSV: /export_access [channel=ID|имя] [before=ГГГГ-ММ-ДД]"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    channel_id = None
+    before = None
+    try:
+        for arg in (message.text or "").split()[1:]:
+            key, _, value = arg.partition("=")
+            if key == "channel":
+                channel_id = channel_ids_by_name.get(value.lower(), value)
+            elif key == "before":
+                before = datetime.fromisoformat(value)
+                if before.tzinfo:
+                    # Сроки доступа хранятся в местном времени без пояса — приводим к нему
+                    before = before.astimezone().replace(tzinfo=None)
+            else:
+                raise ValueError(arg)
+    except ValueError:
+        await message.answer("❌ Формат: /export_access [channel=ID|имя] [before=ГГГГ-ММ-ДД]")
+        return
+    
+    fd, path = tempfile.mkstemp(prefix="access_", suffix=".csv")
+    os.close(fd)
+    try:
+        # Запись большого CSV — в потоке, чтобы не задерживать вебхуки. Обходим копии на момент команды:
+        # вложенные словари AccessState не меняет на месте, так что хватает копии верхнего уровня
+        rows = iter_access_rows(dict(channel_access), dict(paid_files), channel_id, before)
+        count = await asyncio.to_thread(write_access_csv, path, rows)
+        filename = f"access_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"
+        await message.answer_document(
+            FSInputFile(path, filename=filename),
+            caption=f"📄 Строк: {count}"
+        )
+    except Exception as e:
+        logger.error("Ошибка выгрузки доступов: %s", e, exc_info=True)
+        await message.answer("⚠️ Ошибка выгрузки")
+    finally:
+        os.remove(path)
+
 @dp.message(Command("reload"))
 async def cmd_reload(message: Message):
     """Принудительная перезагрузка данных из Google Sheets"""
@@ -745,8 +2875,145 @@ async def cmd_reload(message: Message):
         return
         
     await reload_channel_access()
+    await refresh_channel_info(force=True)
     await message.answer("✅ Данные перезагружены из Google Sheets!")
 
+@dp.message(Command("sheets_stats"))
+async def cmd_sheets_stats(message: Message):
+    """Использование квот Google Sheets"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    lines = []
+    for kind, stats in sheets.stats().items():
+        title = "📖 Чтение" if kind == "read" else "✍️ Запись"
+        lines.append(
+            f"{title}: запросов {stats['requests']}, повторов {stats['retries']}, "
+            f"429: {stats['rate_limited']}, ошибок {stats['errors']}\n"
+            f"   ожидание квоты: {stats['throttled_seconds']} с, "
+            f"токенов: {stats['tokens_available']}, в очереди: {stats['waiting']}"
+        )
+    await message.answer("📊 Google Sheets:\n\n" + "\n".join(lines))
+
+@dp.message(Command("loop_lag"))
+async def cmd_loop_lag(message: Message):
+    """Задержка event loop и места, которые его блокировали"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    lag = loop_watchdog.percentiles()
+    if not lag:
+        await message.answer("⏳ Замеров пока нет")
+        return
+    
+    lines = [
+        f"⏱ Задержка event loop за последние {len(loop_watchdog.lags)} замеров:",
+        f"p50 {lag['p50_ms']} мс, p95 {lag['p95_ms']} мс, p99 {lag['p99_ms']} мс, макс {lag['max_ms']} мс",
+        f"Блокировок дольше {LOOP_LAG_THRESHOLD:g} с: {loop_watchdog.stalls}",
+    ]
+    for place, info in loop_watchdog.top_offenders(3):
+        lines.append(f"\n🐢 {html.escape(place)}\n{info['count']} раз, до {info['max_lag']} с, последний {info['last_seen']}")
+        if info["stack"]:
+            lines.append("<pre>" + html.escape("".join(info["stack"][-3:])[:900]) + "</pre>")
+    await message.answer("\n".join(lines))
+
+@dp.message(Command("stats"))
+async def cmd_stats(message: Message):
+    """Выручка из готовых агрегатов — без просмотра истории платежей"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    if not payment_rollups or not payment_rollups["total"]["count"]:
+        await message.answer("📭 Платежей пока нет")
+        return
+    
+    def fmt(bucket: dict) -> str:
+        return f"{bucket['count']} шт. / {round(bucket['amount'], 2):g}₽"
+    
+    today = datetime.now().date()
+    empty = {"count": 0, "amount": 0.0}
+    week = {"count": 0, "amount": 0.0}
+    for i in range(7):
+        day = payment_rollups["by_day"].get((today - timedelta(days=i)).isoformat(), empty)
+        week["count"] += day["count"]
+        week["amount"] += day["amount"]
+    
+    top_targets = sorted(payment_rollups["by_target"].items(), key=lambda item: item[1]["amount"], reverse=True)[:5]
+    target_lines = []
+    for key, bucket in top_targets:
+        kind, target_id = key.split(":", 1)
+        title = f"📢 {target_id}" if kind == "channel" else f"📁 {target_id[:20]}"
+        target_lines.append(f"  {title}: {fmt(bucket)}")
+    
+    period_lines = []
+    for period, bucket in sorted(payment_rollups["by_period"].items()):
+        title = "файлы" if period == "file" else ("навсегда" if period == "0" else f"{period} дн.")
+        period_lines.append(f"  {title}: {fmt(bucket)}")
+    
+    await message.answer(
+        f"💰 Выручка\n\n"
+        f"Всего: {fmt(payment_rollups['total'])}\n"
+        f"Сегодня: {fmt(payment_rollups['by_day'].get(today.isoformat(), empty))}\n"
+        f"За 7 дней: {fmt(week)}\n\n"
+        f"🏆 Топ:\n" + "\n".join(target_lines) + "\n\n"
+        f"⏰ По срокам:\n" + "\n".join(period_lines)
+    )
+
+@dp.message(Command("bulk_grant"))
+async def cmd_bulk_grant(message: Message, state: FSMContext):
+    """Массовая выдача/продление доступа из CSV"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    # Продление считается от текущих сроков — нужна сверенная с таблицей картина доступов
+    if not sheets_reconciled.is_set():
+        await message.answer("⏳ Идёт сверка с Google Sheets после старта, повторите через минуту")
+        return
+    
+    await state.set_state(BulkGrantStates.waiting_file)
+    await message.answer(
+        "📎 Отправьте CSV-файл со столбцами user_id,channel_id,days\n"
+        "channel_id — ID канала или его имя, days — 0 для бессрочного доступа.\n"
+        "Действующий доступ продлевается от текущего срока."
+    )
+
+@dp.message(BulkGrantStates.waiting_file)
+async def process_bulk_grant_file(message: Message, state: FSMContext):
+    if not message.document:
+        await message.answer("❌ Отправьте CSV-файл документом")
+        return
+    
+    await state.clear()
+    fd, path = tempfile.mkstemp(prefix="bulk_", suffix=".csv")
+    os.close(fd)
+    try:
+        await bot.download(message.document, destination=path)
+    except Exception as e:
+        os.remove(path)
+        logger.error("Ошибка загрузки CSV: %s", e)
+        await message.answer("❌ Не удалось загрузить файл")
+        return
+    
+    await message.answer("⏳ Файл принят, обрабатываю. Отчёт придёт отдельным сообщением.")
+    spawn_background(run_bulk_grant(path), "bulk_grant")
+
+@dp.message(Command("reconcile"))
+async def cmd_reconcile(message: Message):
+    """Отчёт о сверке участников каналов; /reconcile now — проверить следующую порцию сразу"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    if "now" in (message.text or "").split()[1:]:
+        await reconcile_membership_batch()
+    
+    parts = [f"🔎 Сверка участников каналов\nОчередь исправлений: {reconcile_fixes.qsize()}"]
+    if reconcile_state["pass"]:
+        cursor = reconcile_state["cursor"]
+        parts.append(f"⏳ Текущий проход (курсор: {cursor[1] if cursor else '—'})\n" + format_reconcile_stats(reconcile_state["pass"]))
+    if reconcile_state["last_pass"]:
+        parts.append(f"✅ Последний проход (завершён {reconcile_state['last_pass'].get('finished')})\n" + format_reconcile_stats(reconcile_state["last_pass"]))
+    await message.answer("\n\n".join(parts))
+
 # Обработчики кнопок
 @dp.callback_query(F.data.startswith("buy_file:"))
 async def buy_file_callback(callback: types.CallbackQuery):
@@ -760,11 +3027,11 @@ async def buy_file_callback(callback: types.CallbackQuery):
         price = parts[2]
         user_id = str(callback.from_user.id)
         
-        # Находим file_id по short_id
-        file_id = file_id_mapping.get(short_id)
-        if not file_id:
+        entry = catalog_file(short_id)
+        if not entry:
             await callback.answer("❌ Файл не найден")
             return
+        file_id = entry["file_id"]
         
         # Проверяем, есть ли уже доступ к файлу
         if user_id in paid_files and file_id in paid_files[user_id]:
@@ -785,14 +3052,14 @@ async def buy_file_callback(callback: types.CallbackQuery):
         ])
         
         await callback.message.answer(
-            f"📦 Для получения файла необходимо оплатить {price}₽\n"
+            f"📦 Для получения файла{' «' + html.escape(entry['name']) + '»' if entry.get('name') else ''} необходимо оплатить {price}₽\n"
             f"После оплаты файл будет доступен для скачивания",
             reply_markup=keyboard
         )
         await callback.answer()
         
     except Exception as e:
-        logger.error(f"Ошибка обработки покупки файла: {e}")
+        logger.error("Ошибка обработки покупки файла: %s", e)
         await callback.answer("❌ Ошибка при обработке запроса")
 
 @dp.callback_query(F.data.startswith("buy_channel:"))
@@ -813,11 +3080,11 @@ async def buy_channel_callback(callback: types.CallbackQuery):
         if user_id in channel_access and channel_id in channel_access[user_id]:
             expiry = channel_access[user_id][channel_id]
             if expiry == "forever" or (isinstance(expiry, datetime) and datetime.now() < expiry):
-                # Обновляем ссылку
-                invite_link = await grant_channel_access(callback.from_user.id, channel_id, days)
+                # Только выдаём ссылку: срок доступа и таблица не меняются
+                invite_link = await resend_invite_link(callback.from_user.id, channel_id)
                 await callback.message.answer(
                     f"✅ У вас уже есть доступ к каналу!\n"
-                    f"Новая ссылка: {invite_link}"
+                    f"Ссылка для входа: {invite_link}"
                 )
                 await callback.answer()
                 return
@@ -838,9 +3105,44 @@ async def buy_channel_callback(callback: types.CallbackQuery):
         await callback.answer()
         
     except Exception as e:
-        logger.error(f"Ошибка обработки покупки канала: {e}")
+        logger.error("Ошибка обработки покупки канала: %s", e)
         await callback.answer("❌ Ошибка при обработке запроса")
 
+@dp.callback_query(F.data.startswith("feed:"))
+async def feed_page_callback(callback: types.CallbackQuery):
+    """Листание ленты постов: редактирует сообщение на месте"""
+    target = callback.data.split(":", 1)[1]
+    if target == "noop":
+        await callback.answer()
+        return
+    
+    try:
+        posts = await get_posts()
+        if not posts:
+            await callback.answer("📭 Пока нет опубликованных постов")
+            return
+        
+        page, text, photo_id, keyboard = render_feed_page(posts, int(target), callback.from_user.id == ADMIN_ID)
+        message = callback.message
+        
+        if photo_id and message.photo:
+            await message.edit_media(InputMediaPhoto(media=photo_id, caption=text), reply_markup=keyboard)
+        elif not photo_id and not message.photo:
+            await message.edit_text(text, reply_markup=keyboard)
+        else:
+            # Telegram не умеет превращать текстовое сообщение в фото и наоборот
+            await message.delete()
+            await send_feed_page(message, posts, page, callback.from_user.id == ADMIN_ID)
+        await callback.answer()
+        
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            logger.error("Ошибка листания ленты: %s", e)
+        await callback.answer()
+    except Exception as e:
+        logger.error("Ошибка листания ленты: %s", e)
+        await callback.answer("⚠️ Ошибка загрузки постов")
+
 @dp.callback_query(F.data == "add_post")
 async def add_post_callback(callback: types.CallbackQuery, state: FSMContext):
     if callback.from_user.id != ADMIN_ID:
@@ -857,18 +3159,17 @@ async def list_posts_callback(callback: types.CallbackQuery):
         await callback.answer("🚫 Нет доступа")
         return
         
-    posts = ws.get_all_records() if ws else []
-    posts = [p for p in posts if str(p.get("post_id", "")).strip()]
+    posts = await get_posts()
     
     if not posts:
         await callback.message.answer("📭 Нет постов для отображения")
         return
         
     for post in posts:
-        text = post.get("post_text", "Без текста")
-        photo_id = post.get("post_photo", "").strip()
-        post_id = post.get("post_id", "N/A")
-        buttons_data = post.get("post_buttons", "").strip()
+        text = post["text"]
+        photo_id = post["photo_id"]
+        post_id = post["post_id"]
+        buttons_data = post["buttons"]
         
         keyboard = create_buttons_keyboard(buttons_data)
         
@@ -883,7 +3184,7 @@ async def list_posts_callback(callback: types.CallbackQuery):
                     f"{text}\n\nID: {post_id}\nКнопки: {buttons_data if buttons_data else 'нет'}",
                     reply_markup=keyboard if keyboard else delete_kb(post_id))
         except Exception as e:
-            logger.error(f"Ошибка отправки поста {post_id}: {e}")
+            logger.error("Ошибка отправки поста %s: %s", post_id, e)
             await callback.message.answer(
                 f"📄 {text[:300]}...\n\nID: {post_id}\nКнопки: {buttons_data if buttons_data else 'нет'}",
                 reply_markup=delete_kb(post_id))
@@ -897,17 +3198,13 @@ async def delete_post_callback(callback: types.CallbackQuery):
         
     post_id = callback.data.split("_")[1]
     try:
-        if ws:
-            records = ws.get_all_values()
-            for idx, row in enumerate(records[1:], start=2):
-                if str(row[5]) == str(post_id):
-                    ws.delete_rows(idx)
-                    await callback.message.delete()
-                    await callback.answer("✅ Пост удален")
-                    return
+        if sheets.ready and await delete_post(post_id):
+            await callback.message.delete()
+            await callback.answer("✅ Пост удален")
+            return
         await callback.answer("❌ Пост не найден")
     except Exception as e:
-        logger.error(f"Ошибка удаления: {e}")
+        logger.error("Ошибка удаления: %s", e)
         await callback.answer("⚠️ Ошибка удаления")
 
 # Обработчики состояний
@@ -937,7 +3234,7 @@ async def process_post_photo(message: Message, state: FSMContext):
         await message.answer("📌 Хотите добавить кнопки к посту?", reply_markup=keyboard)
             
     except Exception as e:
-        logger.error(f"Ошибка обработки фото: {e}")
+        logger.error("Ошибка обработки фото: %s", e)
         await message.answer("❌ Ошибка обработки")
         await state.clear()
 
@@ -960,7 +3257,7 @@ async def process_buttons_choice(callback: types.CallbackQuery, state: FSMContex
         
         await callback.answer()
     except Exception as e:
-        logger.error(f"Ошибка выбора кнопок: {e}")
+        logger.error("Ошибка выбора кнопок: %s", e)
         await callback.message.answer("❌ Ошибка")
 
 @dp.callback_query(PostStates.waiting_button_type, F.data.startswith("button_type_"))
@@ -977,7 +3274,7 @@ async def process_button_type(callback: types.CallbackQuery, state: FSMContext):
         
         await callback.answer()
     except Exception as e:
-        logger.error(f"Ошибка выбора типа: {e}")
+        logger.error("Ошибка выбора типа: %s", e)
         await callback.message.answer("❌ Ошибка")
 
 @dp.message(PostStates.waiting_button_text)
@@ -995,7 +3292,7 @@ async def process_button_text(message: Message, state: FSMContext):
             await message.answer("🔗 Введите URL:")
             
     except Exception as e:
-        logger.error(f"Ошибка текста кнопки: {e}")
+        logger.error("Ошибка текста кнопки: %s", e)
         await message.answer("❌ Ошибка")
 
 @dp.message(PostStates.waiting_button_price)
@@ -1021,7 +3318,7 @@ async def process_button_price(message: Message, state: FSMContext):
             await message.answer("🔗 Введите URL:")
             
     except Exception as e:
-        logger.error(f"Ошибка цены: {e}")
+        logger.error("Ошибка цены: %s", e)
         await message.answer("❌ Ошибка")
 
 @dp.message(PostStates.waiting_button_channel)
@@ -1036,7 +3333,7 @@ async def process_button_channel(message: Message, state: FSMContext):
         await message.answer("📅 Введите количество дней доступа (0 для бессрочного):")
             
     except Exception as e:
-        logger.error(f"Ошибка ID канала: {e}")
+        logger.error("Ошибка ID канала: %s", e)
         await message.answer("❌ Ошибка")
 
 @dp.message(PostStates.waiting_button_days)
@@ -1061,27 +3358,26 @@ async def process_button_days(message: Message, state: FSMContext):
         await offer_more_buttons(message, state)
             
     except Exception as e:
-        logger.error(f"Ошибка дней: {e}")
+        logger.error("Ошибка дней: %s", e)
         await message.answer("❌ Ошибка")
 
 @dp.message(PostStates.waiting_button_file)
 async def process_button_file(message: Message, state: FSMContext):
     try:
-        if not (message.document or message.photo):
+        attachment = message_file(message)
+        if not attachment:
             await message.answer("❌ Отправьте файл или фото:")
             return
             
-        file_id = message.document.file_id if message.document else message.photo[-1].file_id
+        file_id = attachment[0]
         await state.update_data(current_button_file=file_id)
         
         data = await state.get_data()
         buttons_data = data.get("buttons_data", [])
         text = data.get("current_button_text")
         price = data.get("current_button_price")
-        file_id = data.get("current_button_file")
         
-        short_id = hash(file_id) % 10000
-        file_id_mapping[str(short_id)] = file_id
+        short_id = register_file(*attachment)
         
         buttons_data.append(f"file|{text}|{price}|{short_id}")
         await state.update_data(buttons_data=buttons_data)
@@ -1089,7 +3385,7 @@ async def process_button_file(message: Message, state: FSMContext):
         await offer_more_buttons(message, state)
             
     except Exception as e:
-        logger.error(f"Ошибка файла: {e}")
+        logger.error("Ошибка файла: %s", e)
         await message.answer("❌ Ошибка")
 
 @dp.message(PostStates.waiting_button_url)
@@ -1110,7 +3406,7 @@ async def process_button_url(message: Message, state: FSMContext):
         await offer_more_buttons(message, state)
             
     except Exception as e:
-        logger.error(f"Ошибка URL: {e}")
+        logger.error("Ошибка URL: %s", e)
         await message.answer("❌ Ошибка")
 
 async def offer_more_buttons(message: Message, state: FSMContext):
@@ -1135,27 +3431,18 @@ async def process_final_post(message: Message, state: FSMContext):
         photo_id = data.get("photo_id", "")
         buttons_data = data.get("buttons_data", [])
         
-        if ws:
-            records = ws.get_all_records()
-            
-            post_ids = []
-            for p in records:
-                try:
-                    post_id_str = str(p.get("post_id", "")).strip()
-                    if post_id_str:
-                        post_ids.append(int(post_id_str))
-                except (ValueError, AttributeError):
-                    continue
-            post_id = max(post_ids + [0]) + 1
-            
-            user_ids = {str(r["id"]) for r in records if str(r.get("id", "")).strip()}
+        if sheets.ready and sheets_reconciled.is_set():
+            user_ids = set(known_users)
+            # Пропускаем пользователей, которые заблокировали бота или удалили аккаунт
+            reachable_ids = [uid for uid in user_ids if uid not in unreachable_users]
             
             buttons_str = "|".join(buttons_data) if buttons_data else "нет"
-            ws.append_row(["", "", "", "", "", post_id, text, photo_id, buttons_str, ""])
+            post_id = await create_post(text, photo_id, buttons_str)
             keyboard = create_buttons_keyboard(buttons_str)
             
             success = 0
-            for user_id in user_ids:
+            pruned = 0
+            for user_id in reachable_ids:
                 try:
                     if photo_id:
                         await bot.send_photo(
@@ -1172,109 +3459,463 @@ async def process_final_post(message: Message, state: FSMContext):
                         )
                     success += 1
                 except Exception as e:
-                    logger.error(f"Не удалось отправить пост пользователю {user_id}: {e}")
-
+                    if is_unreachable_error(e):
+                        mark_unreachable(user_id, e)
+                        pruned += 1
+                    else:
+                        logger.error("Не удалось отправить пост пользователю %s: %s", user_id, e)
+            
+            if pruned:
+                save_data()
+            
+            skipped = len(user_ids) - len(reachable_ids)
             await message.answer(
                 f"✅ Пост добавлен (ID: {post_id})\n"
                 f"Кнопки: {len(buttons_data)} шт.\n"
-                f"Отправлено: {success}/{len(user_ids)}"
+                f"Отправлено: {success}/{len(reachable_ids)}\n"
+                f"👥 Доступны: {len(reachable_ids) - pruned}, исключены: {skipped + pruned} "
+                f"(новых в этой рассылке: {pruned})"
             )
         else:
             await message.answer("⚠️ База данных недоступна")
             
     except Exception as e:
-        logger.error(f"Ошибка добавления поста: {e}", exc_info=True)
+        logger.error("Ошибка добавления поста: %s", e, exc_info=True)
         await message.answer("❌ Ошибка при добавлении поста")
     finally:
         await state.clear()
 
+# === Запись трафика для воспроизведения (replay.py) ===
+class TrafficRecorder:
+    """Журнал входящих вебхуков в JSONL с псевдонимизацией пользователей.
+    
+    Строка журнала: {"t": секунды от начала записи, "k": "tg" | "pay", "d": данные}.
+    Первая строка — {"k": "meta", ...} с псевдонимом админа, чтобы replay.py мог его подставить.
+    """
+    
+    PRIVATE_KEYS = {"username", "first_name", "last_name", "phone_number", "email", "bio"}
+    ID_KEYS = {"id", "user_id", "chat_id", "sender_chat_id"}
+    PRIVATE_PAYMENT_KEYS = {"customer_phone", "customer_email", "customer_name", "customer_ip"}
+    # Поля платежа, где встречается user_id. Остальные (сумма, товары) пишем как есть
+    PAYMENT_ID_KEYS = {"order_id", "order_num", "customer_extra"}
+    NUMBER_RE = re.compile(r"(?<![-\d])\d{5,15}(?!\d)")
+    
+    def __init__(self, path: str, salt: str):
+        self.path = path
+        self.salt = salt.encode()
+        self.started = time.monotonic()
+        self.recorded = 0
+        self._file = open(path, "a", buffering=1, encoding="utf-8")
+        self._write({"k": "meta", "started": datetime.now().isoformat(), "admin": self.pseudonym(ADMIN_ID)})
+    
+    def pseudonym(self, value) -> int:
+        """Стабильный в пределах соли псевдоним: один пользователь — один id в журнале"""
+        digest = hashlib.sha256(self.salt + str(value).encode()).digest()
+        return 10 ** 9 + int.from_bytes(digest[:6], "big") % (9 * 10 ** 9)
+    
+    def _numbers(self, text: str) -> str:
+        return self.NUMBER_RE.sub(lambda m: str(self.pseudonym(m.group())), text)
+    
+    def _scrub(self, value, key: str = ""):
+        if isinstance(value, dict):
+            return {k: self._scrub(v, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._scrub(v, key) for v in value]
+        if key in self.PRIVATE_KEYS and isinstance(value, str):
+            return "x" * len(value)
+        # Положительные id — пользователи и личные чаты; каналы (-100…) оставляем как есть
+        if key in self.ID_KEYS and isinstance(value, int) and value > 0:
+            return self.pseudonym(value)
+        if key in ("text", "caption") and isinstance(value, str) and not value.startswith("/"):
+            return "x" * len(value)
+        if isinstance(value, str):
+            return self._numbers(value)
+        return value
+    
+    def _scrub_payment(self, key: str, value: str) -> str:
+        if key in self.PRIVATE_PAYMENT_KEYS:
+            return "x"
+        return self._numbers(value) if key in self.PAYMENT_ID_KEYS else value
+    
+    def _write(self, entry: dict):
+        self._file.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+    
+    def record(self, kind: str, data: dict):
+        try:
+            if kind == "pay":
+                data = {k: self._scrub_payment(k, str(v)) for k, v in data.items()}
+            else:
+                data = self._scrub(data)
+            self._write({"t": round(time.monotonic() - self.started, 3), "k": kind, "d": data})
+            self.recorded += 1
+        except Exception as e:
+            logger.error("Ошибка записи трафика: %s", e)
+    
+    def close(self):
+        self._file.close()
+
+traffic_recorder = TrafficRecorder(TRAFFIC_RECORD_FILE, TRAFFIC_RECORD_SALT) if TRAFFIC_RECORD_FILE else None
+
 # === Универсальный вебхук для всех платежей ===
+payments_in_progress = set()  # ключи заказов, по которым выдача идёт прямо сейчас
+
+async def fulfil_payment(payment_type: str, user_id: str, target_id: str, days: Optional[int], data: dict):
+    """Выдача оплаченного: файл или доступ к каналу, сообщения пользователю и админу"""
+    if payment_type == "file":
+        await access_state.submit(set_access, "files", str(user_id), target_id, "forever")
+        
+        # Файл — через очередь: временная ошибка Bot API не теряет оплаченную отправку.
+        # Подтверждение — в подписи к файлу, чтобы не разошлось с ним по порядку
+        outbox.put(user_id, "✅ Оплата файла прошла успешно! Вот ваш файл", file_id=target_id)
+        
+        outbox.put(
+            ADMIN_ID,
+            f"💰 Пользователь {user_id} оплатил файл\n"
+            f"📁 File ID: {target_id}\n"
+            f"💳 Сумма: {data.get('amount', 'N/A')}₽"
+        )
+    
+    elif payment_type == "channel":
+        invite_link = await grant_channel_access(int(user_id), target_id, days)
+        
+        period = "навсегда" if days == 0 else f"{days} дней"
+        outbox.put(
+            user_id,
+            f"✅ Оплата доступа к каналу прошла успешно! Доступ предоставлен на {period}.\n"
+            f"Вот ваша ссылка для входа: {invite_link}"
+        )
+        
+        outbox.put(
+            ADMIN_ID,
+            f"💰 Пользователь {user_id} оплатил доступ к каналу\n"
+            f"📢 Канал: {target_id}\n"
+            f"⏰ Срок: {period}\n"
+            f"💳 Сумма: {data.get('amount', 'N/A')}₽"
+        )
+
 @app.post("/webhook")
+@traced("payment.webhook", kind=SPAN_KIND_SERVER)
 async def universal_webhook(request: Request):
+    if shutdown_event.is_set():
+        return JSONResponse({"status": "error", "message": "Shutting down"}, status_code=503)
+    data = {}
     try:
-        logger.info("=== ПОЛУЧЕН ВЕБХУК ОТ PRODAMUS ===")
-        
         form_data = await request.form()
         data = dict(form_data)
+        if traffic_recorder:
+            traffic_recorder.record("pay", data)
         
-        logger.info(f"Данные вебхука: {data}")
+        # Полные данные платежа (с контактами покупателя) — только на уровне DEBUG
+        logger.debug("Данные вебхука: %s", data)
+        logger.info(
+            "Платёж %s: статус %s", data.get("order_num") or data.get("order_id"), data.get("payment_status"),
+            extra={"order_id": data.get("order_id"), "order_num": data.get("order_num"), "amount": data.get("amount")}
+        )
         
         if data.get('payment_status') != 'success':
-            logger.warning(f"Платеж не успешен: {data.get('payment_status')}")
+            logger.warning("Платеж не успешен: %s", data.get('payment_status'))
             return {"status": "error", "message": "Payment not successful"}
         
         payment_type, user_id, target_id, days = extract_payment_info(data)
+        trace_set(order_num=data.get("order_num"), payment_type=payment_type, user_id=user_id, target_id=target_id)
         
-        logger.info(f"Извлечено: type={payment_type}, user_id={user_id}, target_id={target_id}, days={days}")
+        logger.info(
+            "Извлечено: type=%s, user_id=%s, target_id=%s, days=%s", payment_type, user_id, target_id, days,
+            extra={"payment_type": payment_type, "user_id": user_id, "target_id": target_id, "days": days}
+        )
+        order_key = payment_order_key(data)
+        if payment_recorded(order_key):
+            # Доступ по этому заказу уже выдан — повторно не продлеваем и не шлём файл
+            logger.warning("Повторный вебхук заказа %s — платёж уже учтён", order_key)
+            return {"status": "success", "message": "Duplicate payment"}
+        if order_key in payments_in_progress:
+            # Первая доставка ещё выдаёт доступ; платёжная система повторит вебхук позже
+            return JSONResponse({"status": "error", "message": "Payment in progress"}, status_code=409)
         
-        if payment_type == "file":
-            if user_id not in paid_files:
-                paid_files[user_id] = {}
-            paid_files[user_id][target_id] = "forever"
-            save_data()
-            
-            await bot.send_message(user_id, "✅ Оплата файла прошла успешно! Вот ваш файл:")
-            await send_file_to_user(user_id, target_id, "✅ Ваш файл")
-            
-            await bot.send_message(
-                ADMIN_ID,
-                f"💰 Пользователь {user_id} оплатил файл\n"
-                f"📁 File ID: {target_id}\n"
-                f"💳 Сумма: {data.get('amount', 'N/A')}₽"
-            )
-            
-        elif payment_type == "channel":
-            invite_link = await grant_channel_access(int(user_id), target_id, days)
-            
-            period = "навсегда" if days == 0 else f"{days} дней"
-            await bot.send_message(
-                user_id,
-                f"✅ Оплата доступа к каналу прошла успешно! Доступ предоставлен на {period}.\n"
-                f"Вот ваша ссылка для входа: {invite_link}"
-            )
-            
-            await bot.send_message(
-                ADMIN_ID,
-                f"💰 Пользователь {user_id} оплатил доступ к каналу\n"
-                f"📢 Канал: {target_id}\n"
-                f"⏰ Срок: {period}\n"
-                f"💳 Сумма: {data.get('amount', 'N/A')}₽"
-            )
+        if order_key:
+            payments_in_progress.add(order_key)
+        try:
+            await fulfil_payment(payment_type, user_id, target_id, days, data)
+        finally:
+            payments_in_progress.discard(order_key)
+        # Учтённым заказ становится только после выдачи: если она упала, повтор вебхука выполнит её заново
+        record_payment(payment_type, user_id, target_id, days, data, order_key)
         
         return {"status": "success"}
         
     except Exception as e:
-        logger.error(f"Ошибка вебхука: {e}", exc_info=True)
-        await bot.send_message(ADMIN_ID, f"🚨 Ошибка вебхука: {e}\n\nДанные: {data}")
+        trace_error(e)
+        logger.error("Ошибка вебхука: %s", e, exc_info=True)
+        outbox.put(
+            ADMIN_ID,
+            f"🚨 Ошибка вебхука: {html.escape(str(e)[:200])}\n\n"
+            f"Данные: {html.escape(str(data)[:OUTBOX_ALERT_TEXT_LIMIT])}"
+        )
         return {"status": "error", "message": str(e)}
 
+# === Повторные доставки апдейтов ===
+class SeenUpdates:
+    """update_id недавно принятых апдейтов.
+    
+    Если вебхук отвечает медленно, Telegram доставляет тот же апдейт повторно — такой апдейт
+    отбрасываем за O(1), не запуская обработчики (и не тратя квоту Sheets) второй раз.
+    Записи живут SEEN_UPDATES_TTL секунд, хранится не больше SEEN_UPDATES_LIMIT, список переживает перезапуск.
+    """
+    
+    def __init__(self, path: str, ttl: float, limit: int):
+        self.path = path
+        self.ttl = ttl
+        self.limit = limit
+        self.seen = OrderedDict()  # update_id -> время приёма, от старых к новым
+        self.duplicates = 0
+        self.dirty = False
+    
+    def _evict(self, now: float):
+        while self.seen and (len(self.seen) > self.limit or next(iter(self.seen.values())) < now - self.ttl):
+            self.seen.popitem(last=False)
+    
+    def add(self, update_id: int) -> bool:
+        """Отмечает апдейт принятым. False — он уже был"""
+        now = time.time()
+        self._evict(now)
+        if update_id in self.seen:
+            self.duplicates += 1
+            return False
+        self.seen[update_id] = now
+        self.dirty = True
+        return True
+    
+    def forget(self, update_id: int):
+        """Обработка упала — повторная доставка должна пройти"""
+        if self.seen.pop(update_id, None) is not None:
+            self.dirty = True
+    
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                self.seen = OrderedDict((update_id, ts) for update_id, ts in json.load(f))
+            self._evict(time.time())
+        except Exception as e:
+            logger.error("Ошибка загрузки принятых апдейтов: %s", e)
+    
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(list(self.seen.items()), f)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except Exception as e:
+            logger.error("Ошибка сохранения принятых апдейтов: %s", e)
+
+seen_updates = SeenUpdates(SEEN_UPDATES_FILE, SEEN_UPDATES_TTL, SEEN_UPDATES_LIMIT)
+
+async def save_seen_updates():
+    seen_updates.save()
+
+# === Периодические задачи ===
+# (название, функция, интервал в секундах, запускать ли сразу при старте).
+# Один бот крутит их сам (run_periodic), хост нескольких ботов — общим планировщиком (host.py)
+PERIODIC_JOBS = [
+    ("check_expired_access", check_expired_access, 60, True),
+    # Сверка небольшими порциями, чтобы полный проход был растянут во времени
+    ("reconcile_membership", reconcile_membership_batch, RECONCILE_INTERVAL, False),
+    ("compact_posts", compact_posts, POSTS_COMPACT_INTERVAL, False),
+    ("channel_info", refresh_channel_info, CHANNEL_INFO_TTL, True),
+    ("seen_updates", save_seen_updates, SEEN_UPDATES_SAVE_INTERVAL, False),
+    ("traces", span_exporter.flush, TRACE_FLUSH_INTERVAL, False),
+]
+
+async def run_periodic_job(name: str, job: Callable[[], Awaitable[Any]]):
+    """Один запуск периодической задачи: ошибка не должна остановить расписание"""
+    try:
+        await job()
+    except Exception as e:
+        logger.error("❌ [BACKGROUND] Ошибка задачи %s: %s", name, e)
+
+async def run_periodic(name: str, job: Callable[[], Awaitable[Any]], interval: float, immediately: bool):
+    logger.info("[BACKGROUND] Запущена задача %s (каждые %s с)", name, interval)
+    if not immediately and await sleep_or_shutdown(interval):
+        return
+    while True:
+        await run_periodic_job(name, job)
+        if await sleep_or_shutdown(interval):
+            break
+
 # === Webhook настройки ===
 WEBHOOK_PATH = f"/webhook/{BOT_TOKEN}"
 WEBHOOK_URL = f"https://{os.getenv('RENDER_EXTERNAL_HOSTNAME')}{WEBHOOK_PATH}"
 
 @app.on_event("startup")
 async def startup():
+    # Сначала локальное состояние — бот обслуживает запросы сразу
+    load_local_state()
+    
     if os.getenv("RENDER"):
         await bot.set_webhook(WEBHOOK_URL)
-        logger.info(f"Webhook установлен: {WEBHOOK_URL}")
+        logger.info("Webhook установлен: %s", WEBHOOK_URL)
+    
+    # Google Sheets подключаем и сверяем в фоне
+    spawn_background(connect_and_reconcile(), "connect_and_reconcile")
+    spawn_background(outbox.run(), "outbox")
+    
+    # На хосте периодические задачи и сторож event loop общие — их запускает host.py
+    if not TENANT:
+        for name, job, interval, immediately in PERIODIC_JOBS:
+            spawn_background(run_periodic(name, job, interval, immediately), name)
+        spawn_background(loop_watchdog.run(), "loop_watchdog")
+    
+    boot_stats["ready_after"] = round(time.monotonic() - boot_stats["started"], 3)
+    logger.info("Бот запущен за %s с!", boot_stats['ready_after'])
+
+def checkpoint_state():
+    """Сохраняет всё локальное состояние на диск"""
+    save_data()
+    save_reconcile_state()
+    save_payment_rollups()
+    seen_updates.save()
+    span_exporter.flush_sync()
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Плавная остановка: не берём новую работу, доделываем начатое, сохраняем, отменяем остальное"""
+    started = time.monotonic()
+    deadline = started + SHUTDOWN_TIMEOUT
+    shutdown_event.set()
+    logger.info("⏹ Остановка: новые задачи не принимаются, фоновых задач: %s", len(background_tasks))
+    
+    # Фоновые задачи видят shutdown_event и завершают текущий шаг
+    pending = set(background_tasks)
+    if pending:
+        _, pending = await asyncio.wait(pending, timeout=max(deadline - time.monotonic(), 0))
+    
+    if not await sheets.drain(deadline - time.monotonic()):
+        logger.error("⏹ Не дождались записи в Google Sheets: %s", sheets.pending_writes)
     
-    load_data()
+    for task in pending:
+        logger.warning("⏹ Отменяем задачу %s", task.get_name())
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
     
-    # ЗАПУСКАЕМ ФОНОВУЮ ЗАДАЧУ В ТОМ ЖЕ EVENT LOOP
-    asyncio.create_task(check_expired_access_task())
+    # Сохраняем после отмены: отменённые задачи могли успеть изменить состояние
+    checkpoint_state()
+    if traffic_recorder:
+        traffic_recorder.close()
     
-    logger.info("Бот запущен!")
+    if not TENANT:
+        await bot.session.close()  # общую сессию хоста закрывает host.py
+    logger.info("⏹ Остановка завершена за %.2f с", time.monotonic() - started)
 
 @app.post(WEBHOOK_PATH)
+@traced("telegram.update", kind=SPAN_KIND_SERVER)
 async def telegram_webhook(request: Request):
+    if shutdown_event.is_set():
+        # Telegram повторит доставку, когда поднимется новый экземпляр
+        return JSONResponse({"ok": False}, status_code=503)
     data = await request.json()
+    if traffic_recorder:
+        traffic_recorder.record("tg", data)
     update = types.Update(**data)
-    await dp.feed_update(bot, update)
+    # Тип берём из ключей апдейта: update.event_type падает на типах, неизвестных этой версии aiogram
+    trace_set(update_id=update.update_id, update_type=next((key for key in data if key != "update_id"), None))
+    if not seen_updates.add(update.update_id):
+        logger.info("Повторная доставка апдейта %s отброшена", update.update_id, extra=SAMPLED)
+        return {"ok": True}
+    try:
+        await dp.feed_update(bot, update)
+    except Exception:
+        seen_updates.forget(update.update_id)
+        raise
     return {"ok": True}
 
+# === API проверки доступа для сайта и платформы курсов ===
+def access_api_error(request: Request) -> Optional[JSONResponse]:
+    """Проверка Bearer-токена. None — запрос разрешён"""
+    if not ACCESS_API_TOKEN:
+        return JSONResponse({"error": "Access API disabled"}, status_code=503)
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), ACCESS_API_TOKEN.encode()):
+        return JSONResponse({"error": "Unauthorized"}, status_code=401, headers={"WWW-Authenticate": "Bearer"})
+    return None
+
+def expiry_json(expiry) -> Optional[str]:
+    return expiry.isoformat() if isinstance(expiry, datetime) else expiry
+
+def user_entitlements(user_id: str, now: datetime, channel_id: Optional[str] = None) -> dict:
+    """Действующие доступы пользователя: истёкшие, но ещё не снятые проверкой, не считаются.
+    С channel_id — только этот канал, без файлов.
+    """
+    def active(entries: dict) -> dict:
+        return {
+            target: expiry_json(expiry)
+            for target, expiry in entries.items()
+            if expiry == "forever" or (isinstance(expiry, datetime) and expiry > now)
+        }
+    
+    channels = active(channel_access.get(user_id, {}))
+    files = active(paid_files.get(user_id, {}))
+    if channel_id:
+        channels = {k: v for k, v in channels.items() if k == channel_id}
+        files = {}
+    return {
+        "user_id": user_id,
+        "has_access": bool(channels or files),
+        "channels": channels,
+        "files": files,
+    }
+
+def etag_response(request: Request, body: dict) -> JSONResponse:
+    """Ответ с ETag по содержимому; при совпадении If-None-Match — 304 без тела"""
+    payload = json.dumps(body, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    etag = '"' + hashlib.sha256(payload.encode()).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+    return Response(payload, media_type="application/json", headers=headers)
+
+@app.get("/api/access/{user_id}")
+async def api_access(user_id: str, request: Request, channel_id: Optional[str] = None):
+    """Доступы одного пользователя; ?channel_id= — только один канал"""
+    error = access_api_error(request)
+    if error:
+        return error
+    if not user_id.isdigit():
+        return JSONResponse({"error": "user_id must be numeric"}, status_code=400)
+    
+    return etag_response(request, user_entitlements(user_id, datetime.now(), channel_id))
+
+@app.post("/api/access/batch")
+async def api_access_batch(request: Request):
+    """Пакетная проверка: {"user_ids": [...], "channel_id": необязательно} → {"users": {user_id: ...}}"""
+    error = access_api_error(request)
+    if error:
+        return error
+    
+    try:
+        data = await request.json()
+        user_ids = [str(user_id) for user_id in data["user_ids"]]
+        # В JSON id канала часто приходит числом — ключи доступов строковые
+        channel_id = str(data["channel_id"]) if data.get("channel_id") is not None else None
+    except Exception:
+        return JSONResponse({"error": "Expected JSON body {\"user_ids\": [...]}"}, status_code=400)
+    if len(user_ids) > ACCESS_API_BATCH_LIMIT:
+        return JSONResponse({"error": f"At most {ACCESS_API_BATCH_LIMIT} user_ids per request"}, status_code=413)
+    if not all(user_id.isdigit() for user_id in user_ids):
+        return JSONResponse({"error": "user_ids must be numeric"}, status_code=400)
+    
+    now = datetime.now()
+    users = {user_id: user_entitlements(user_id, now, channel_id) for user_id in user_ids}
+    return etag_response(request, {"users": users})
+
 @app.get("/")
 async def health_check():
-    return {"status": "ok", "sheets": bool(ws), "paid_files_count": len(paid_files), "channel_access_count": len(channel_access)}
+    return {"status": "ok", "sheets": sheets.ready, "sheets_reconciled": sheets_reconciled.is_set(), "pending_registrations": len(pending_registrations), "paid_files_count": len(paid_files), "channel_access_count": len(channel_access), "unreachable_users_count": len(unreachable_users), "sheets_quota": sheets.stats(), "throttled": dict(throttling.dropped), "duplicate_updates": seen_updates.duplicates, "tracing": span_exporter.stats(), "outbox": outbox.stats(), "loop_lag": loop_watchdog.stats(), "access_state": {"version": access_state.version, "applied": access_state.applied, "queued": access_state.queue.qsize()}, "boot": {k: v for k, v in boot_stats.items() if k != "started"}}
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,226 @@
+"""Воспроизведение записанного трафика и сравнение двух сборок.
+
+Журнал пишет сам бот, если заданы переменные TRAFFIC_RECORD_FILE и TRAFFIC_RECORD_SALT
+(см. TrafficRecorder в main.py): апдейты Telegram и платежи с псевдонимами вместо id пользователей
+и с отметкой времени. Соль одна на весь журнал — тогда псевдонимы не меняются между перезапусками.
+
+replay.py поднимает `main.app` под uvicorn с FakeBotAPI и FakeWorksheet (как loadtest.py)
+и отправляет записи журнала в том же темпе, что и в оригинале, или ускоренно (--speed).
+Отчёт — задержки по потокам и число вызовов Bot API / Google Sheets.
+
+Пример сравнения двух сборок:
+    python replay.py run traffic.jsonl --speed 10 --app-dir ../build-a --out a.json
+    python replay.py run traffic.jsonl --speed 10 --app-dir ../build-b --out b.json
+    python replay.py compare a.json b.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import aiohttp
+import uvicorn
+
+from fakes import FakeBotAPI, FakeWorksheet, seed_rows
+from loadtest import StreamStats
+
+BOT_TOKEN = "123456:replay"
+STREAMS = {"tg": "telegram", "pay": "payment"}
+
+
+def read_journal(path: str):
+    """(meta, записи) — записи отсортированы по времени"""
+    meta, entries = {}, []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry["k"] == "meta":
+                # При нескольких запусках бота журнал дописывается — время каждого запуска с нуля
+                offset = entries[-1]["t"] if entries else 0.0
+                meta = {**entry, "offset": offset}
+                continue
+            entry["t"] += meta.get("offset", 0.0)
+            entries.append(entry)
+    entries.sort(key=lambda e: e["t"])
+    return meta, entries
+
+
+def journal_user_ids(entries) -> set:
+    """Псевдонимы пользователей, писавших боту в журнале"""
+    user_ids = set()
+    for entry in entries:
+        if entry["k"] != "tg":
+            continue
+        for kind in ("message", "callback_query"):
+            sender = entry["d"].get(kind, {}).get("from")
+            if sender and not sender.get("is_bot"):
+                user_ids.add(str(sender["id"]))
+    return user_ids
+
+
+async def run(args) -> dict:
+    meta, entries = read_journal(os.path.abspath(args.journal))
+    if args.limit:
+        entries = entries[:args.limit]
+
+    if args.app_dir:
+        sys.path.insert(0, os.path.abspath(args.app_dir))
+    workdir = tempfile.mkdtemp(prefix="replay_")
+    os.chdir(workdir)
+
+    fake_api = FakeBotAPI(port=args.bot_api_port, latency=args.bot_latency)
+    await fake_api.start()
+
+    os.environ.update({"BOT_TOKEN": BOT_TOKEN, "GSHEET_ID": "replay", "TELEGRAM_API_URL": fake_api.url})
+    if meta.get("admin"):
+        os.environ["ADMIN_ID"] = str(meta["admin"])
+    for name in ("RENDER", "TRAFFIC_RECORD_FILE"):
+        os.environ.pop(name, None)
+    import main
+
+    if not args.verbose:
+        for name in ("main", "aiogram", "aiogram.event", "uvicorn.error"):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+    channel_id = main.CHANNELS["main"]
+    rows = seed_rows(args.users, args.posts, channel_id)
+    if args.known_users:
+        # Пользователи из журнала уже есть в таблице — как в проде, где большинство пишет не впервые
+        rows += [[user_id] + [""] * 9 for user_id in sorted(journal_user_ids(entries))]
+    sheet = FakeWorksheet(rows, latency=args.sheets_latency)
+    main.connect_sheets = lambda: sheet
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    while not main.sheets_reconciled.is_set():
+        await asyncio.sleep(0.05)
+
+    base = f"http://127.0.0.1:{args.port}"
+    stats = {kind: StreamStats(name) for kind, name in STREAMS.items()}
+
+    async def send(session: aiohttp.ClientSession, entry: dict):
+        stream = stats[entry["k"]]
+        started = time.perf_counter()
+        try:
+            if entry["k"] == "tg":
+                async with session.post(f"{base}/webhook/{BOT_TOKEN}", json=entry["d"]) as resp:
+                    await resp.read()
+                    ok = resp.status == 200
+            else:
+                async with session.post(f"{base}/webhook", data=entry["d"]) as resp:
+                    await resp.read()
+                    ok = resp.status == 200
+        except Exception:
+            ok = False
+        stream.latencies.append(time.perf_counter() - started)
+        if not ok:
+            stream.errors += 1
+
+    tasks = []
+    first = entries[0]["t"] if entries else 0.0
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    started = time.perf_counter()
+    async with aiohttp.ClientSession(connector=connector) as session:
+        for entry in entries:
+            if entry["k"] not in stats:
+                continue
+            delay = started + (entry["t"] - first) / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            stats[entry["k"]].sent += 1
+            tasks.append(asyncio.create_task(send(session, entry)))
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    server.should_exit = True
+    await server_task
+    await fake_api.stop()
+
+    return {
+        "journal": os.path.abspath(args.journal),
+        "app_dir": os.path.dirname(os.path.abspath(main.__file__)),
+        "speed": args.speed,
+        "entries": len(entries),
+        "elapsed_s": round(elapsed, 2),
+        "streams": [s.summary(elapsed) for s in stats.values()],
+        "bot_api_calls": dict(fake_api.calls),
+        "sheets_calls": sheet.spreadsheet.call_counts(),
+    }
+
+
+def delta(old: float, new: float) -> str:
+    change = f"{new - old:+g}"
+    if old:
+        change += f" ({(new - old) / old:+.1%})"
+    return change
+
+
+def compare(a: dict, b: dict):
+    print(f"A: {a['app_dir']}\nB: {b['app_dir']}")
+    print(f"Записей: {a['entries']} / {b['entries']}, длительность: {a['elapsed_s']} / {b['elapsed_s']} с\n")
+
+    print(f"{'поток':<10}{'метрика':<12}{'A':>10}{'B':>10}  изменение")
+    streams_b = {s["stream"]: s for s in b["streams"]}
+    for sa in a["streams"]:
+        sb = streams_b.get(sa["stream"])
+        if not sb:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms", "error_rate"):
+            print(f"{sa['stream']:<10}{key:<12}{sa[key]:>10}{sb[key]:>10}  {delta(sa[key], sb[key])}")
+
+    for title, key in (("Bot API", "bot_api_calls"), ("Sheets", "sheets_calls")):
+        print(f"\n{title}:")
+        for method in sorted(set(a[key]) | set(b[key])):
+            old, new = a[key].get(method, 0), b[key].get(method, 0)
+            marker = "" if old == new else "  ←"
+            print(f"  {method:<28}{old:>8}{new:>8}  {delta(old, new)}{marker}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="воспроизвести журнал")
+    run_parser.add_argument("journal", help="файл журнала (TRAFFIC_RECORD_FILE)")
+    run_parser.add_argument("--speed", type=float, default=1.0, help="ускорение относительно записи")
+    run_parser.add_argument("--limit", type=int, default=0, help="воспроизвести только первые N записей")
+    run_parser.add_argument("--app-dir", help="каталог сборки с main.py (по умолчанию — текущая)")
+    run_parser.add_argument("--users", type=int, default=1000, help="пользователей в таблице")
+    run_parser.add_argument("--posts", type=int, default=20, help="постов в таблице")
+    run_parser.add_argument("--known-users", action="store_true", help="занести пользователей из журнала в таблицу")
+    run_parser.add_argument("--bot-latency", type=float, default=0.05, help="задержка ответа Bot API, с")
+    run_parser.add_argument("--sheets-latency", type=float, default=0.2, help="задержка вызова Google Sheets, с")
+    run_parser.add_argument("--connections", type=int, default=100, help="максимум одновременных соединений")
+    run_parser.add_argument("--port", type=int, default=8092)
+    run_parser.add_argument("--bot-api-port", type=int, default=8093)
+    run_parser.add_argument("--out", help="сохранить отчёт в JSON для compare")
+    run_parser.add_argument("--verbose", action="store_true", help="не приглушать логи бота")
+
+    compare_parser = commands.add_parser("compare", help="сравнить два отчёта")
+    compare_parser.add_argument("a")
+    compare_parser.add_argument("b")
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        with open(args.a) as fa, open(args.b) as fb:
+            compare(json.load(fa), json.load(fb))
+        return
+
+    out = os.path.abspath(args.out) if args.out else None
+    report = asyncio.run(run(args))
+    if out:
+        with open(out, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
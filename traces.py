@@ -0,0 +1,110 @@
+"""Просмотр трасс, записанных ботом (TRACE_FILE в формате OTLP/JSON).
+
+Печатает самые медленные трассы деревом спанов: смещение от начала трассы, длительность
+и полоса на шкале времени — критический путь видно сразу. Ошибочные спаны помечены «!».
+
+Примеры:
+    python traces.py traces.jsonl --slowest 5
+    python traces.py traces.jsonl --name payment.webhook --slowest 3
+    python traces.py traces.jsonl --trace 4bf92f3577b34da6a3ce929d0e0e4736
+"""
+import argparse
+import json
+from collections import defaultdict
+
+BAR_WIDTH = 40
+
+
+def attribute_value(value: dict):
+    for key in ("stringValue", "intValue", "doubleValue", "boolValue"):
+        if key in value:
+            return value[key]
+    return None
+
+
+def read_spans(path: str) -> dict:
+    """{trace_id: [спаны]} из строк-запросов экспорта OTLP/JSON"""
+    traces = defaultdict(list)
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for resource in json.loads(line).get("resourceSpans", []):
+                for scope in resource.get("scopeSpans", []):
+                    for span in scope.get("spans", []):
+                        span["start"] = int(span["startTimeUnixNano"])
+                        span["end"] = int(span["endTimeUnixNano"])
+                        span["attrs"] = {a["key"]: attribute_value(a["value"]) for a in span.get("attributes", [])}
+                        traces[span["traceId"]].append(span)
+    return traces
+
+
+def trace_root(spans: list) -> dict:
+    ids = {span["spanId"] for span in spans}
+    roots = [span for span in spans if span.get("parentSpanId") not in ids]
+    return min(roots, key=lambda span: span["start"])
+
+
+def print_trace(trace_id: str, spans: list):
+    root = trace_root(spans)
+    started = min(span["start"] for span in spans)
+    total = max(max(span["end"] for span in spans) - started, 1)
+    children = defaultdict(list)
+    for span in spans:
+        children[span.get("parentSpanId")].append(span)
+
+    attrs = ", ".join(f"{k}={v}" for k, v in root["attrs"].items())
+    print(f"\n{trace_id}  {root['name']}  {total / 1e6:.1f} мс  {attrs}")
+
+    def walk(span: dict, depth: int):
+        offset = (span["start"] - started) / 1e6
+        duration = (span["end"] - span["start"]) / 1e6
+        left = int((span["start"] - started) / total * BAR_WIDTH)
+        width = max(1, int((span["end"] - span["start"]) / total * BAR_WIDTH))
+        bar = " " * left + "█" * min(width, BAR_WIDTH - left)
+        mark = "!" if span.get("status", {}).get("code") == 2 else " "
+        name = "  " * depth + span["name"]
+        print(f"{mark} {name:<48}{offset:>9.1f}{duration:>9.1f}  |{bar:<{BAR_WIDTH}}|")
+        if mark == "!":
+            print(f"  {'  ' * depth}  {span['status'].get('message', '')}")
+        for child in sorted(children[span["spanId"]], key=lambda s: s["start"]):
+            walk(child, depth + 1)
+
+    print(f"  {'спан':<48}{'от, мс':>9}{'мс':>9}")
+    walk(root, 0)
+    # Спаны без записанного родителя (например, не попавшие в файл при остановке) — отдельными ветками
+    ids = {span["spanId"] for span in spans}
+    for orphan in sorted(spans, key=lambda s: s["start"]):
+        if orphan is not root and orphan.get("parentSpanId") not in ids:
+            walk(orphan, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="файл трасс (TRACE_FILE)")
+    parser.add_argument("--slowest", type=int, default=5, help="сколько самых медленных трасс показать")
+    parser.add_argument("--name", help="только трассы с таким корневым спаном, например payment.webhook")
+    parser.add_argument("--trace", help="показать одну трассу по trace_id (из лога)")
+    args = parser.parse_args()
+
+    traces = read_spans(args.file)
+    if args.trace:
+        if args.trace not in traces:
+            parser.error(f"трасса {args.trace} не найдена")
+        print_trace(args.trace, traces[args.trace])
+        return
+
+    ranked = []
+    for trace_id, spans in traces.items():
+        root = trace_root(spans)
+        if args.name and root["name"] != args.name:
+            continue
+        ranked.append((max(s["end"] for s in spans) - min(s["start"] for s in spans), trace_id))
+    ranked.sort(reverse=True)
+    print(f"Трасс: {len(ranked)}")
+    for _, trace_id in ranked[:args.slowest]:
+        print_trace(trace_id, traces[trace_id])
+
+
+if __name__ == "__main__":
+    main()